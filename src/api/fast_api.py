@@ -1,12 +1,40 @@
+import datetime
 import logging
 import tempfile
 from typing import Any, Union, List
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse
 
+from api.serialization import stream_json_array
 from database.db import DB
-from database.models import Trigger, Destination
+from database.models import Trigger, Destination, Fingerprint, Task, InferenceEndpoint, RefingerprintRequest
+
+MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+
+
+def config_page_limit(after_id: Union[int, None], limit: Union[int, None]) -> Union[int, None]:
+    """
+    Configuration listings return the whole table to clients that send neither after_id nor limit, as they did
+    before paging. A client paging with after_id alone gets DEFAULT_PAGE_SIZE items.
+    """
+    if limit is None and after_id is not None:
+        return DEFAULT_PAGE_SIZE
+    return limit
+
+
+def page_response(items: List, limit: Union[int, None]) -> StreamingResponse:
+    """
+    Streams a page as a json array. A full page carries the id to pass as after_id for the next one in the
+    X-Next-After-Id header. With limit None, items are everything there is.
+    """
+    headers = {}
+    if len(items) == limit:
+        headers["X-Next-After-Id"] = str(items[-1].id)
+    return StreamingResponse(stream_json_array(items), media_type="application/json", headers=headers)
+
 
 class DicomNodeAPI(FastAPI):
     def __init__(self, db: DB, log_level, **extra: Any):
@@ -27,13 +55,23 @@ class DicomNodeAPI(FastAPI):
                             description: Union[str, None] = None,
                             delete_locally: Union[bool, None] = None,
                             delete_remotely: Union[bool, None] = None,
+                            allow_compressed: Union[bool, None] = None,
+                            priority: Union[int, None] = None,
+                            weight: Union[float, None] = None,
+                            batch_window: Union[float, None] = Query(None, ge=0),
+                            max_batch_size: Union[int, None] = Query(None, ge=1),
                             ):
             return self.db.add_fingerprint(version=version,
                                            description=description,
                                            inference_server_url=inference_server_url,
                                            human_readable_id=human_readable_id,
                                            delete_remotely=delete_remotely,
-                                           delete_locally=delete_locally)
+                                           delete_locally=delete_locally,
+                                           allow_compressed=allow_compressed,
+                                           priority=priority,
+                                           weight=weight,
+                                           batch_window=batch_window,
+                                           max_batch_size=max_batch_size)
 
         @self.post("/destination_fingerprint_association/")
         def add_destination_fingerprint_association(fingerprint_id: int,
@@ -42,28 +80,97 @@ class DicomNodeAPI(FastAPI):
                                                           destination_id=destination_id)
 
         @self.get("/fingerprints/")
-        def get_fingerprints():
-            return list(self.db.get_fingerprints())
+        def get_fingerprints(after_id: Union[int, None] = None,
+                             limit: Union[int, None] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+            limit = config_page_limit(after_id, limit)
+            return page_response(self.db.generic_get_page(Fingerprint, after_id, limit), limit)
 
         @self.get("/triggers/")
-        def get_triggers():
-            return list(self.db.generic_get_all(Trigger))
+        def get_triggers(after_id: Union[int, None] = None,
+                         limit: Union[int, None] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+            limit = config_page_limit(after_id, limit)
+            return page_response(self.db.generic_get_page(Trigger, after_id, limit), limit)
 
         @self.get("/destinations/")
-        def get_destinations():
-            return list(self.db.generic_get_all(Destination))
+        def get_destinations(after_id: Union[int, None] = None,
+                             limit: Union[int, None] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+            limit = config_page_limit(after_id, limit)
+            return page_response(self.db.generic_get_page(Destination, after_id, limit), limit)
+
+        @self.get("/inference_endpoints/")
+        def get_inference_endpoints(after_id: Union[int, None] = None,
+                                    limit: Union[int, None] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+            limit = config_page_limit(after_id, limit)
+            return page_response(self.db.generic_get_page(InferenceEndpoint, after_id, limit), limit)
+
+        @self.get("/tasks/")
+        def get_tasks(after_id: Union[int, None] = None,
+                      limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                      status: Union[int, None] = None,
+                      fingerprint_id: Union[int, None] = None,
+                      since: Union[datetime.datetime, None] = None,
+                      until: Union[datetime.datetime, None] = None):
+            return page_response(self.db.get_tasks_page(after_id=after_id,
+                                                        limit=limit,
+                                                        status=status,
+                                                        fingerprint_id=fingerprint_id,
+                                                        since=since,
+                                                        until=until), limit)
+
+        @self.get("/catalog/series/")
+        def get_catalog_series(after_id: Union[int, None] = None,
+                               limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                               study_instance_uid: Union[str, None] = None,
+                               series_instance_uid: Union[str, None] = None,
+                               sop_class_uid: Union[str, None] = None,
+                               since: Union[datetime.datetime, None] = None,
+                               until: Union[datetime.datetime, None] = None):
+            # Received series, filtered on the indexed columns and a received range [since, until)
+            return page_response(self.db.get_catalog_page(after_id=after_id,
+                                                          limit=limit,
+                                                          study_instance_uid=study_instance_uid,
+                                                          series_instance_uid=series_instance_uid,
+                                                          sop_class_uid=sop_class_uid,
+                                                          since=since,
+                                                          until=until), limit)
+
+        @self.get("/catalog/usage/")
+        def get_catalog_usage(group_by: str = Query("sop_class_uid", regex="^(sop_class_uid|day)$"),
+                              since: Union[datetime.datetime, None] = None,
+                              until: Union[datetime.datetime, None] = None):
+            return self.db.get_catalog_usage(group_by=group_by, since=since, until=until)
+
+        @self.get("/catalog/refingerprint/")
+        def get_refingerprint_requests(after_id: Union[int, None] = None,
+                                       limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+            return page_response(self.db.generic_get_page(RefingerprintRequest, after_id, limit), limit)
+
+        @self.post("/catalog/refingerprint/")
+        def add_refingerprint_request(fingerprint_id: int,
+                                      since: Union[datetime.datetime, None] = None,
+                                      until: Union[datetime.datetime, None] = None):
+            # Runs the fingerprint against stored series received in [since, until). Picked up by a daemon.
+            if self.db.get_fingerprint(fingerprint_id) is None:
+                raise HTTPException(status_code=404, detail=f"No fingerprint with id {fingerprint_id}")
+            return self.db.add_refingerprint_request(fingerprint_id=fingerprint_id, since=since, until=until)
 
         @self.post("/triggers/")
         def add_trigger(fingerprint_id: Union[int, None] = None,
                         study_description_pattern: Union[str, None] = None,
                         series_description_pattern: Union[str, None] = None,
                         sop_class_uid_exact: Union[str, None] = None,
-                        exclude_pattern: Union[str, None] = None):
-            return self.db.add_trigger(fingerprint_id=fingerprint_id,
-                                       study_description_pattern=study_description_pattern,
-                                       series_description_pattern=series_description_pattern,
-                                       sop_class_uid_exact=sop_class_uid_exact,
-                                       exclude_pattern=exclude_pattern)
+                        exclude_pattern: Union[str, None] = None,
+                        ignore_case: Union[bool, None] = None):
+            # Patterns are regular expressions. Invalid ones are rejected, and matching hits the compile cache.
+            try:
+                return self.db.add_trigger(fingerprint_id=fingerprint_id,
+                                           study_description_pattern=study_description_pattern,
+                                           series_description_pattern=series_description_pattern,
+                                           sop_class_uid_exact=sop_class_uid_exact,
+                                           exclude_pattern=exclude_pattern,
+                                           ignore_case=ignore_case)
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e))
 
         @self.post("/destinations/")
         def add_destinations(scu_ip: str,
@@ -77,6 +184,34 @@ class DicomNodeAPI(FastAPI):
                                            fingerprint_id=fingerprint_id)
 
 
+        @self.post("/inference_endpoints/")
+        def add_inference_endpoint(fingerprint_id: int,
+                                   url: str,
+                                   weight: float = Query(1.0, gt=0),
+                                   enabled: bool = True):
+            # Replica of the fingerprint's inference server. Tasks are spread over all enabled endpoints of a fingerprint
+            if self.db.get_fingerprint(fingerprint_id) is None:
+                raise HTTPException(status_code=404, detail=f"No fingerprint with id {fingerprint_id}")
+            return self.db.add_inference_endpoint(fingerprint_id=fingerprint_id,
+                                                  url=url,
+                                                  weight=weight,
+                                                  enabled=enabled)
+
+        @self.post("/tasks/{task_id}/priority/")
+        def set_task_priority(task_id: int, priority: int):
+            # Overrides the fingerprint's priority for this task, e.g. to rush a single study
+            if self.db.generic_get(Task, task_id) is None:
+                raise HTTPException(status_code=404, detail=f"No task with id {task_id}")
+            return self.db.update_task(task_id=task_id, priority=priority)
+
+        @self.post("/tasks/callback/")
+        def task_finished_callback(uid: str):
+            # Called by inference servers when a task is finished. Worst case of a bogus call is an early poll.
+            tasks = self.db.notify_task_finished(inference_server_uid=uid)
+            if not tasks:
+                raise HTTPException(status_code=404, detail=f"No task waiting for inference with uid {uid}")
+            return {"ids": [task.id for task in tasks], "inference_server_uid": uid}
+
         @self.delete("/triggers/{trigger_id}")
         def delete_trigger(trigger_id: int):
             return self.db.delete_trigger(trigger_id=trigger_id)
@@ -85,6 +220,10 @@ class DicomNodeAPI(FastAPI):
         def delete_destination(destination_id: int):
             return self.db.delete_destination(destination_id=destination_id)
 
+        @self.delete("/inference_endpoints/{endpoint_id}")
+        def delete_inference_endpoint(endpoint_id: int):
+            return self.db.delete_inference_endpoint(endpoint_id=endpoint_id)
+
         @self.delete("/fingerprints/{fingerprint_id}")
         def delete_destination(fingerprint_id: int):
             return self.db.delete_fingerprint(fingerprint_id=fingerprint_id)
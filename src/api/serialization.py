@@ -0,0 +1,45 @@
+import datetime
+import json
+from typing import Iterable, AsyncIterator
+
+try:
+    import orjson  # Optional. Serializes large pages several times faster than json.
+except ImportError:
+    orjson = None
+
+
+def to_jsonable(obj):
+    """
+    Loaded columns and relationships of ORM objects as dicts, matching FastAPI's default encoding of them.
+    Relationships that were not loaded are left out rather than lazy loaded.
+    """
+    if isinstance(obj, (list, tuple)):
+        return [to_jsonable(o) for o in obj]
+    if hasattr(obj, "_sa_instance_state"):
+        return {key: to_jsonable(value) for key, value in vars(obj).items() if not key.startswith("_sa")}
+    return obj
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+
+async def stream_json_array(items: Iterable) -> AsyncIterator[bytes]:
+    """
+    Encodes and sends items one at a time, so the encoded response is never built as one buffer. The items
+    themselves are loaded before the response starts.
+    """
+    yield b"["
+    for i, item in enumerate(items):
+        if i:
+            yield b","
+        yield dumps(to_jsonable(item))
+    yield b"]"
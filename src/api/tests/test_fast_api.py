@@ -0,0 +1,123 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from fastapi.testclient import TestClient
+
+from api.fast_api import DicomNodeAPI
+from database.db import DB
+from dicom_networking.scp import Assoc, SeriesInstance
+
+
+class TestDicomNodeAPI(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = DB(base_dir=self.tmp_dir)
+        self.client = TestClient(DicomNodeAPI(db=self.db, log_level=20))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fingerprints_keep_triggers_and_destinations(self):
+        fp = self.db.add_fingerprint(human_readable_id="test", inference_server_url="http://inference-server")
+        self.db.add_trigger(fingerprint_id=fp.id, sop_class_uid_exact="1.2.3")
+        self.db.add_destination(scu_ip="localhost", scu_port=104, scu_ae_title="STORESCP", fingerprint_id=fp.id)
+
+        res = self.client.get("/fingerprints/")
+        self.assertEqual(200, res.status_code)
+        fps = res.json()
+        self.assertEqual(1, len(fps))
+        self.assertEqual("test", fps[0]["human_readable_id"])
+        self.assertEqual("1.2.3", fps[0]["triggers"][0]["sop_class_uid_exact"])
+        self.assertEqual(104, fps[0]["destinations"][0]["scu_port"])
+        self.assertNotIn("X-Next-After-Id", res.headers)
+
+    def test_tasks_keyset_pagination(self):
+        fp = self.db.add_fingerprint(human_readable_id="test", inference_server_url="http://inference-server")
+        tasks = [self.db.add_task(fingerprint_id=fp.id) for _ in range(5)]
+
+        ids = []
+        params = {"limit": 2}
+        while True:
+            res = self.client.get("/tasks/", params=params)
+            self.assertEqual(200, res.status_code)
+            ids += [t["id"] for t in res.json()]
+            if "X-Next-After-Id" not in res.headers:
+                break
+            params["after_id"] = res.headers["X-Next-After-Id"]
+        self.assertEqual([t.id for t in tasks], ids)
+
+    def test_tasks_filters(self):
+        fp = self.db.add_fingerprint(human_readable_id="test", inference_server_url="http://inference-server")
+        other_fp = self.db.add_fingerprint(human_readable_id="other", inference_server_url="http://inference-server")
+        task = self.db.add_task(fingerprint_id=fp.id)
+        self.db.add_task(fingerprint_id=other_fp.id)
+        self.db.update_task(task.id, status=3)
+
+        res = self.client.get("/tasks/", params={"status": 3})
+        self.assertEqual([task.id], [t["id"] for t in res.json()])
+        self.assertNotIn("fingerprint", res.json()[0])
+
+        res = self.client.get("/tasks/", params={"fingerprint_id": other_fp.id})
+        self.assertEqual(1, len(res.json()))
+        self.assertEqual(other_fp.id, res.json()[0]["fingerprint_id"])
+
+        res = self.client.get("/tasks/", params={"since": task.timestamp.isoformat()})
+        self.assertEqual(2, len(res.json()))
+        res = self.client.get("/tasks/", params={"until": task.timestamp.isoformat()})
+        self.assertEqual(0, len(res.json()))
+
+    def test_catalog(self):
+        assoc = Assoc(assoc_id="1",
+                      timestamp=datetime.datetime(2024, 1, 1),
+                      path="/storage/1",
+                      series_instances={"1.2.3": SeriesInstance(series_instance_uid="1.2.3",
+                                                                study_instance_uid="1.2",
+                                                                study_description="Study",
+                                                                series_description="Series",
+                                                                sop_class_uid="1.2.840.10008.5.1.4.1.1.2",
+                                                                path="/storage/1/1.2.840.10008.5.1.4.1.1.2/1.2.3",
+                                                                instance_count=5,
+                                                                bytes=500)})
+        self.db.add_catalog_series([assoc])
+
+        res = self.client.get("/catalog/series/", params={"study_instance_uid": "1.2"})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(["1.2.3"], [s["series_instance_uid"] for s in res.json()])
+        self.assertEqual([], self.client.get("/catalog/series/", params={"study_instance_uid": "9.9"}).json())
+
+        res = self.client.get("/catalog/usage/", params={"group_by": "day"})
+        self.assertEqual([{"day": "2024-01-01", "series": 1, "instances": 5, "duplicate_instances": 0, "bytes": 500}],
+                         res.json())
+        self.assertEqual(422, self.client.get("/catalog/usage/", params={"group_by": "week"}).status_code)
+
+    def test_refingerprint_request(self):
+        self.assertEqual(404, self.client.post("/catalog/refingerprint/", params={"fingerprint_id": 1}).status_code)
+        fp = self.db.add_fingerprint(human_readable_id="test", inference_server_url="http://inference-server")
+        res = self.client.post("/catalog/refingerprint/", params={"fingerprint_id": fp.id,
+                                                                  "since": "2024-01-01T00:00:00"})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(fp.id, res.json()["fingerprint_id"])
+        self.assertIsNone(res.json()["owner_id"])
+        self.assertEqual([res.json()["id"]], [r["id"] for r in self.client.get("/catalog/refingerprint/").json()])
+
+    def test_configuration_listings_are_unbounded_without_paging(self):
+        for i in range(150):
+            self.db.add_fingerprint(human_readable_id=str(i), inference_server_url="http://inference-server")
+
+        res = self.client.get("/fingerprints/")
+        self.assertEqual(150, len(res.json()))
+        self.assertNotIn("X-Next-After-Id", res.headers)
+
+        res = self.client.get("/fingerprints/", params={"after_id": 10})
+        self.assertEqual(100, len(res.json()))
+        self.assertEqual(str(res.json()[-1]["id"]), res.headers["X-Next-After-Id"])
+
+    def test_limit_is_bounded(self):
+        self.assertEqual(422, self.client.get("/tasks/", params={"limit": 0}).status_code)
+        self.assertEqual(422, self.client.get("/tasks/", params={"limit": 100000}).status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+"""
+Microbenchmark of fingerprint matching.
+
+Measures slow_fingerprint and fast_fingerprint as the number of fingerprints, triggers per fingerprint and series per
+association grow. SOPClassUIDs and descriptions are drawn from a distribution resembling a radiotherapy clinic.
+One json line per case is written to --output.
+
+A candidate matcher (module:function with the signature of slow_fingerprint) is checked for equivalent results with
+slow_fingerprint on every case and timed alongside it.
+
+Run from src/:
+    python -m benchmarks.fingerprint_bench --output fingerprint_bench.jsonl
+    python -m benchmarks.fingerprint_bench --candidate my_module:faster_fingerprint
+"""
+import argparse
+import datetime
+import importlib
+import json
+import random
+import time
+from types import SimpleNamespace
+from typing import List, Callable, Dict, Union
+
+from daemon.fingerprinting.fingerprint import fast_fingerprint, slow_fingerprint
+from database.models import Trigger
+from dicom_networking.scp import Assoc, SeriesInstance
+
+# (SOPClassUID, weight)
+SOP_CLASS_UIDS = [("1.2.840.10008.5.1.4.1.1.2", 50),  # CT Image Storage
+                  ("1.2.840.10008.5.1.4.1.1.4", 25),  # MR Image Storage
+                  ("1.2.840.10008.5.1.4.1.1.481.3", 8),  # RT Structure Set Storage
+                  ("1.2.840.10008.5.1.4.1.1.481.2", 5),  # RT Dose Storage
+                  ("1.2.840.10008.5.1.4.1.1.481.5", 4),  # RT Plan Storage
+                  ("1.2.840.10008.5.1.4.1.1.128", 5),  # PET Image Storage
+                  ("1.2.840.10008.5.1.4.1.1.88.33", 3)]  # Comprehensive SR Storage
+
+STUDY_DESCRIPTIONS = ["CT Thorax", "CT Head and Neck", "MR Brain", "RT Planning Pelvis", "PET/CT Whole Body",
+                      "MR Prostate", "CT Abdomen", "RT Planning Breast", "MR Rectum", "CT Thorax 4D"]
+SERIES_DESCRIPTIONS = ["Thorax 3mm", "Head 2mm", "T1 AX POST", "T2 TSE SAG", "FLAIR", "DWI b1000", "ADC",
+                       "Planning CT", "Average 4D", "RTSTRUCT", "RTDOSE", "Localizer", "Scout", "T1 MPRAGE",
+                       "Pelvis 2mm", "Body 3mm", "AC CT", "PET WB"]
+
+
+def weighted_sop_class_uid(rng: random.Random) -> str:
+    uids, weights = zip(*SOP_CLASS_UIDS)
+    return rng.choices(uids, weights=weights)[0]
+
+
+def make_assoc(rng: random.Random, series: int) -> Assoc:
+    series_instances = {}
+    study_description = rng.choice(STUDY_DESCRIPTIONS)
+    for i in range(series):
+        series_instance_uid = f"1.2.826.0.1.3680043.{rng.randrange(10 ** 9)}.{i}"
+        series_instances[series_instance_uid] = SeriesInstance(series_instance_uid=series_instance_uid,
+                                                               study_description=study_description,
+                                                               series_description=rng.choice(SERIES_DESCRIPTIONS),
+                                                               sop_class_uid=weighted_sop_class_uid(rng),
+                                                               path=f"/tmp/{i}")
+    return Assoc(assoc_id=str(rng.randrange(10 ** 6)),
+                 timestamp=datetime.datetime.now(),
+                 path="/tmp",
+                 series_instances=series_instances)
+
+
+def make_trigger(rng: random.Random, assoc: Assoc, matching: bool) -> Trigger:
+    """
+    A trigger with a realistic mix of patterns. Matching triggers are derived from a series of assoc.
+    """
+    if matching:
+        series_instance = rng.choice(list(assoc.series_instances.values()))
+        sop_class_uid = series_instance.sop_class_uid
+        study_description = series_instance.study_description
+        series_description = series_instance.series_description
+    else:
+        sop_class_uid = weighted_sop_class_uid(rng)
+        study_description = rng.choice(STUDY_DESCRIPTIONS)
+        series_description = rng.choice(SERIES_DESCRIPTIONS)
+
+    return Trigger(sop_class_uid_exact=sop_class_uid,
+                   study_description_pattern=study_description.split()[0] if rng.random() < 0.3 else None,
+                   series_description_pattern=series_description.split()[0] if rng.random() < 0.3 else None,
+                   exclude_pattern="Localizer" if rng.random() < 0.2 else None)
+
+
+def make_fingerprints(rng: random.Random,
+                      assoc: Assoc,
+                      fingerprints: int,
+                      triggers: int,
+                      match_probability: float):
+    fps = []
+    for i in range(fingerprints):
+        matching = rng.random() < match_probability
+        fps.append(SimpleNamespace(id=i,
+                                   triggers=[make_trigger(rng, assoc, matching) for _ in range(triggers)]))
+    return fps
+
+
+def time_matcher(matcher: Callable, fps: List, assoc: Assoc, min_time: float, max_repeats: int) -> float:
+    """
+    :return: seconds per association, i.e. matching assoc against all fps once
+    """
+    repeats = 0
+    start = time.perf_counter()
+    while True:
+        for fp in fps:
+            matcher(fp=fp, assoc=assoc)
+        repeats += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or repeats >= max_repeats:
+            return elapsed / repeats
+
+
+def match_signature(matches) -> Union[List[str], None]:
+    if matches is None:
+        return None
+    return [series_instance.series_instance_uid for series_instance in matches]
+
+
+def run_case(fingerprints: int,
+             triggers: int,
+             series: int,
+             match_probability: float = 0.5,
+             seed: int = 42,
+             candidate: Union[Callable, None] = None,
+             min_time: float = 0.2,
+             max_repeats: int = 1000) -> Dict:
+    rng = random.Random(seed)
+    assoc = make_assoc(rng, series)
+    fps = make_fingerprints(rng, assoc, fingerprints, triggers, match_probability)
+
+    def fast_then_slow(fp, assoc):
+        if fast_fingerprint(fp=fp, assoc=assoc):
+            return slow_fingerprint(fp=fp, assoc=assoc)
+
+    result = {"fingerprints": fingerprints,
+              "triggers_per_fingerprint": triggers,
+              "series_per_association": series,
+              "match_probability": match_probability,
+              "seed": seed,
+              "matches": len([fp for fp in fps if slow_fingerprint(fp=fp, assoc=assoc) is not None]),
+              "seconds_per_association": {}}
+    for name, matcher in [("slow_fingerprint", slow_fingerprint),
+                          ("fast_fingerprint", fast_fingerprint),
+                          ("fast_then_slow", fast_then_slow)]:
+        result["seconds_per_association"][name] = time_matcher(matcher, fps, assoc, min_time, max_repeats)
+
+    if candidate is not None:
+        expected = [match_signature(slow_fingerprint(fp=fp, assoc=assoc)) for fp in fps]
+        actual = [match_signature(candidate(fp=fp, assoc=assoc)) for fp in fps]
+        result["candidate_equivalent"] = expected == actual
+        result["seconds_per_association"]["candidate"] = time_matcher(candidate, fps, assoc, min_time, max_repeats)
+        result["candidate_speedup"] = result["seconds_per_association"]["slow_fingerprint"] / \
+                                      result["seconds_per_association"]["candidate"]
+    return result
+
+
+def scaling_cases(scales: List[int], fingerprints: int, triggers: int, series: int):
+    """
+    Grows one dimension at a time while holding the others at their baseline.
+    """
+    for scale in scales:
+        yield scale, triggers, series
+    for scale in scales:
+        yield fingerprints, scale, series
+    for scale in scales:
+        yield fingerprints, triggers, scale
+
+
+def load_candidate(spec: str) -> Callable:
+    module_name, function_name = spec.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100, 1000, 10000])
+    parser.add_argument("--fingerprints", type=int, default=10, help="Baseline number of fingerprints")
+    parser.add_argument("--triggers", type=int, default=3, help="Baseline triggers per fingerprint")
+    parser.add_argument("--series", type=int, default=10, help="Baseline series per association")
+    parser.add_argument("--match-probability", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds spent timing each matcher")
+    parser.add_argument("--candidate", default=None, help="module:function to compare against slow_fingerprint")
+    parser.add_argument("--output", default=None, help="Append json lines to this file")
+    args = parser.parse_args()
+
+    candidate = load_candidate(args.candidate) if args.candidate else None
+    for fingerprints, triggers, series in scaling_cases(args.scales, args.fingerprints, args.triggers, args.series):
+        result = run_case(fingerprints=fingerprints,
+                          triggers=triggers,
+                          series=series,
+                          match_probability=args.match_probability,
+                          seed=args.seed,
+                          candidate=candidate,
+                          min_time=args.min_time)
+        line = json.dumps(result)
+        print(line)
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
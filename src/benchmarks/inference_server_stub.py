@@ -0,0 +1,133 @@
+import json
+import secrets
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict
+from urllib.parse import urlparse, parse_qs
+
+
+class StubTask:
+    __slots__ = ("uid", "human_readable_id", "tar", "finished_at")
+
+    def __init__(self, uid: str, human_readable_id: str, tar: bytes, finished_at: float):
+        self.uid = uid
+        self.human_readable_id = human_readable_id
+        self.tar = tar
+        self.finished_at = finished_at
+
+
+class InferenceServerStub(ThreadingHTTPServer):
+    """
+    Local stand-in for an inference server with MockClient semantics: outputs are the uploaded tar, which becomes
+    available inference_time seconds after upload. Serves the endpoints used by Client and AsyncClient.
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = "localhost", port: int = 0, inference_time: float = 0):
+        super().__init__((host, port), InferenceServerStubHandler)
+        self.inference_time = inference_time
+        self.tasks: Dict[str, StubTask] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_task(self, human_readable_id: str, tar: bytes) -> str:
+        uid = secrets.token_urlsafe()
+        with self.lock:
+            self.tasks[uid] = StubTask(uid=uid,
+                                       human_readable_id=human_readable_id,
+                                       tar=tar,
+                                       finished_at=time.monotonic() + self.inference_time)
+        return uid
+
+    def status_code(self, uid: str) -> int:
+        task = self.tasks.get(uid)
+        if task is None:
+            return 500
+        elif task.finished_at > time.monotonic():
+            return 554  # On its way
+        return 200
+
+
+class InferenceServerStubHandler(BaseHTTPRequestHandler):
+    server: InferenceServerStub
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+    def reply(self, status_code: int, content: bytes = b"", content_type="application/json"):
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def reply_json(self, status_code: int, obj):
+        self.reply(status_code, json.dumps(obj).encode())
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def read_tar_file(self, body: bytes) -> bytes:
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        message = BytesParser(policy=HTTP).parsebytes(header + body)
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "tar_file":
+                return part.get_payload(decode=True)
+        raise ValueError("No tar_file in upload")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        body = self.read_body()
+        if url.path == "/api/tasks/":
+            uid = self.server.add_task(human_readable_id=params.get("human_readable_id", [""])[0],
+                                       tar=self.read_tar_file(body))
+            self.reply_json(200, {"uid": uid})
+        elif url.path == "/api/tasks/statuses/":
+            uids = json.loads(body)["uids"]
+            self.reply_json(200, {uid: self.server.status_code(uid) for uid in uids})
+        else:
+            self.reply_json(404, "Not found")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == "/api/tasks/outputs/":
+            uid = params.get("uid", [""])[0]
+            status_code = self.server.status_code(uid)
+            if status_code == 200:
+                self.reply(200, self.server.tasks[uid].tar, content_type="application/octet-stream")
+            else:
+                self.reply_json(status_code, "Task is not finished")
+        elif url.path in ["/", "/api/"]:
+            self.reply_json(200, "Inference server stub")
+        else:
+            self.reply_json(404, "Not found")
+
+    def do_DELETE(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        uid = params.get("uid", [""])[0]
+        with self.server.lock:
+            task = self.server.tasks.pop(uid, None)
+        if task is None:
+            self.reply_json(404, f"Task {uid} not found")
+        else:
+            self.reply_json(200, "Task successfully deleted")
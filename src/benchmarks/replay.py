@@ -0,0 +1,221 @@
+"""
+Replays an ingest trace (see dicom_networking.trace) as synthetic C-STORE traffic.
+
+Every association of the trace is sent at its original offset from the start of the trace, divided by --speed.
+Series keep their SOP class, instance count and approximate instance size. Series and studies which recur in the
+trace recur in the replay with the same UIDs, and instances the node saw as resends are resent as identical copies.
+Descriptions are replayed when the trace holds them, so fingerprints match as they did in production.
+
+Sends to a local SCP unless --host and --port point to a running node, e.g. to benchmark its daemon.
+
+Run from src/:
+    python -m benchmarks.replay ingest_trace.jsonl --speed 10
+    python -m benchmarks.replay ingest_trace.jsonl --host localhost --port 10000 --ae-title DICOM_RECEIVER
+"""
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from typing import Dict, List, Union, Tuple
+
+from pydicom.uid import generate_uid
+
+from benchmarks.report import summarize, print_report, free_port
+from benchmarks.synthetic import synthetic_instance
+from dicom_networking.scp import SCP
+from dicom_networking.scu import post_folder_to_dicom_node
+from dicom_networking.trace import read_trace
+
+HEADER_BYTES = 512  # Approximate encoded size of a synthetic instance without pixel data
+
+
+def instance_shape(instance_bytes: float) -> Tuple[int, int]:
+    """
+    :return: (rows, columns) of a square 16 bit synthetic image of about instance_bytes
+    """
+    side = max(int(math.sqrt(max(instance_bytes - HEADER_BYTES, 2) / 2)), 1)
+    return side, side
+
+
+def load_associations(path: str, max_associations: Union[int, None] = None) -> Tuple[List[Dict], Dict[str, int]]:
+    """
+    :return: (association entries in order of arrival, number of matches per fingerprint in the trace)
+    """
+    associations, matches = [], {}
+    for entry in read_trace(path):
+        if entry["type"] == "association":
+            associations.append(entry)
+        elif entry["type"] == "match":
+            matches[entry["fingerprint"]] = matches.get(entry["fingerprint"], 0) + 1
+    associations.sort(key=lambda entry: entry["started"])
+    return associations[:max_associations], matches
+
+
+class TrafficGenerator:
+    """
+    Writes the instances of trace associations. Keys of the trace map to the same generated UIDs throughout a replay.
+    """
+    def __init__(self, work_dir: str):
+        self.work_dir = work_dir
+        self.uids: Dict[str, str] = {}
+        self.series_files: Dict[str, List[str]] = {}  # Dict[series key: files sent before]
+
+    def uid(self, key: str) -> str:
+        if key not in self.uids:
+            self.uids[key] = generate_uid()
+        return self.uids[key]
+
+    def generate(self, index: int, entry: Dict) -> Tuple[str, int, int]:
+        """
+        :return: (folder of the association, instances, bytes)
+        """
+        folder = os.path.join(self.work_dir, str(index))
+        instances, size = 0, 0
+        for series_number, series in enumerate(entry["series"]):
+            series_folder = os.path.join(folder, str(series_number))
+            os.makedirs(series_folder, exist_ok=True)
+            previous = self.series_files.get(series["series"], [])
+            resent = min(series["duplicate_count"], len(previous))
+            rows, columns = instance_shape(series["bytes"] / max(series["instance_count"], 1))
+
+            files = []
+            for i in range(series["instance_count"]):
+                path = os.path.join(series_folder, f"{i}.dcm")
+                if i < resent:
+                    shutil.copyfile(previous[i], path)
+                else:
+                    ds = synthetic_instance(sop_class_uid=series["sop_class_uid"],
+                                            study_instance_uid=self.uid(series["study"]),
+                                            series_instance_uid=self.uid(series["series"]),
+                                            study_description=series.get("study_description", "Replayed Study"),
+                                            series_description=series.get("series_description", "Replayed Series"),
+                                            rows=rows,
+                                            columns=columns,
+                                            instance_number=i + 1)
+                    ds.save_as(path, write_like_original=False)
+                files.append(path)
+                size += os.path.getsize(path)
+            instances += len(files)
+            self.series_files[series["series"]] = previous + files[resent:]
+        return folder, instances, size
+
+
+def run_replay(trace_path: str,
+               speed: float = 1,
+               max_associations: Union[int, None] = None,
+               max_concurrent: int = 16,
+               host: Union[str, None] = None,
+               port: Union[int, None] = None,
+               ae_title: str = "REPLAY_TARGET",
+               work_dir: Union[str, None] = None) -> Dict:
+    """
+    :param speed: 10 replays an hour of traffic in 6 minutes
+    :param max_concurrent: associations in flight at most. Later ones start late when exceeded, which is reported.
+    :param host: send to an SCP running elsewhere, on port, instead of a local one
+    """
+    if host is not None and port is None:
+        raise ValueError("A port is required with a host")
+    associations, matches = load_associations(trace_path, max_associations)
+    remove_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="replay_")
+
+    # Everything is written before the clock starts
+    generator = TrafficGenerator(os.path.join(work_dir, "associations"))
+    generated = [generator.generate(i, entry) for i, entry in enumerate(associations)]
+    first = datetime.datetime.fromisoformat(associations[0]["started"]) if associations else None
+    offsets = [(datetime.datetime.fromisoformat(entry["started"]) - first).total_seconds() / speed
+               for entry in associations]
+
+    scp = None
+    if host is None:
+        scp = SCP(ae_title=ae_title,
+                  ip="localhost",
+                  port=free_port(),
+                  temporary_storage=os.path.join(work_dir, "received"),
+                  log_level=logging.WARNING,
+                  pynetdicom_log_level="none")
+        scp.run_scp(blocking=False)
+        host, port = scp.ip, scp.port
+
+    start = time.monotonic()
+
+    def send(i):
+        delay = start + offsets[i] - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        lag = time.monotonic() - start - offsets[i]
+        began = time.monotonic()
+        ok = post_folder_to_dicom_node(scu_ip=host, scu_port=port, scu_ae_title=ae_title, dicom_dir=generated[i][0])
+        return lag, time.monotonic() - began, ok
+
+    pool = ThreadPool(max(min(max_concurrent, len(associations)), 1))
+    results = pool.map(send, range(len(associations)))
+    elapsed = time.monotonic() - start
+    pool.close()
+    pool.join()
+
+    if scp is not None:
+        scp.ae.shutdown()
+    if remove_work_dir:
+        shutil.rmtree(work_dir)
+
+    instances = sum([g[1] for g in generated])
+    return {
+        "parameters": {"trace": trace_path, "speed": speed, "max_associations": max_associations,
+                       "max_concurrent": max_concurrent, "local_scp": scp is not None},
+        "associations": len(associations),
+        "failed_associations": len([r for r in results if not r[2]]),
+        "instances": instances,
+        "bytes": sum([g[2] for g in generated]),
+        "trace_span_seconds": offsets[-1] * speed if offsets else 0,
+        "replay_seconds": elapsed,
+        "instances_per_second": instances / elapsed if elapsed else 0,
+        "latency_seconds": {
+            "start_lag": summarize([r[0] for r in results]),
+            "association": summarize([r[1] for r in results]),
+            "traced_association": summarize([(datetime.datetime.fromisoformat(entry["released"]) -
+                                              datetime.datetime.fromisoformat(entry["started"])).total_seconds()
+                                             for entry in associations]),
+        },
+        "traced_matches": matches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="Trace written with INGEST_TRACE_PATH")
+    parser.add_argument("--speed", type=float, default=1, help="Replay this many times faster than recorded")
+    parser.add_argument("--max-associations", type=int, default=None)
+    parser.add_argument("--max-concurrent", type=int, default=16, help="Associations in flight at most")
+    parser.add_argument("--host", default=None, help="Target SCP. A local SCP is started if not given")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--ae-title", default="REPLAY_TARGET")
+    parser.add_argument("--work-dir", default=None, help="Kept after the run if given")
+    parser.add_argument("--output", default=None, help="Write the report as json to this file")
+    args = parser.parse_args()
+    if args.host is not None and args.port is None:
+        parser.error("--port is required with --host")
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run_replay(trace_path=args.trace,
+                        speed=args.speed,
+                        max_associations=args.max_associations,
+                        max_concurrent=args.max_concurrent,
+                        host=args.host,
+                        port=args.port,
+                        ae_title=args.ae_title,
+                        work_dir=args.work_dir)
+    print_report("Replay", report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import json
+import math
+import socket
+from typing import List, Dict
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest-rank percentile. q in [0, 100].
+    """
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    return {"count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": max(values)}
+
+
+def print_report(title: str, report: Dict):
+    print(f"===== {title} =====")
+    print(json.dumps(report, indent=2, default=str))
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
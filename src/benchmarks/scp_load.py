@@ -0,0 +1,211 @@
+"""
+Load generator and C-STORE latency benchmark of the SCP receiver.
+
+N concurrent associations each send M synthetic instances of a given size and SOP class to an SCP. Reports C-STORE
+response latency percentiles, instances/s, bytes/s and, for a local SCP, CPU and wall time spent per instance in
+SCP.handle_store. Storage modes (with or without the deduplication index) and PDU sizes can be compared without
+production traffic.
+
+Run from src/:
+    python -m benchmarks.scp_load --associations 8 --instances 200 --rows 512 --columns 512
+    python -m benchmarks.scp_load --maximum-pdu-size 16384 --dedup
+    python -m benchmarks.scp_load --host 10.0.0.5 --port 104 --ae-title RECEIVER  # An SCP running elsewhere
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from typing import Dict, List, Union
+
+from pynetdicom import AE
+
+from benchmarks.report import summarize, print_report, free_port
+from benchmarks.synthetic import generate_study, CT_IMAGE_STORAGE
+from dicom_networking.dedup import InstanceIndex
+from dicom_networking.scp import SCP
+from dicom_networking.scu import DicomFile, scan_folder, requested_contexts, send_file
+
+
+def timed_handler(handler, cpu_seconds: List[float], wall_seconds: List[float]):
+    """
+    Wraps an SCP event handler and records the CPU time of its thread and the wall time of every call.
+    """
+    @functools.wraps(handler)
+    def wrapper(event):
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        try:
+            return handler(event)
+        finally:
+            wall_seconds.append(time.perf_counter() - wall)
+            cpu_seconds.append(time.thread_time() - cpu)
+    return wrapper
+
+
+def send_association(host: str,
+                     port: int,
+                     ae_title: str,
+                     dicom_files: List[DicomFile],
+                     maximum_pdu_size: int) -> Dict:
+    """
+    Sends dicom_files on one association with the contexts and send path of dicom_networking.scu.
+    :return: whether the association was established, its setup and per C-STORE latencies in seconds, and failed
+    C-STOREs
+    """
+    ae = AE()
+    ae.maximum_pdu_size = maximum_pdu_size
+    ae.requested_contexts = requested_contexts(dicom_files)
+
+    start = time.perf_counter()
+    assoc = ae.associate(host, port, ae_title=ae_title)
+    setup = time.perf_counter() - start
+    if not assoc.is_established:
+        return {"established": False, "setup": setup, "latencies": [], "failed": len(dicom_files)}
+
+    latencies, failed = [], 0
+    try:
+        for dicom_file in dicom_files:
+            start = time.perf_counter()
+            status = send_file(assoc, dicom_file)
+            latencies.append(time.perf_counter() - start)
+            if not status or status.Status != 0x0000:
+                failed += 1
+    finally:
+        assoc.release()
+    return {"established": True, "setup": setup, "latencies": latencies, "failed": failed}
+
+
+def run_benchmark(associations: int = 4,
+                  instances: int = 100,
+                  rows: int = 256,
+                  columns: int = 256,
+                  sop_class_uid: str = CT_IMAGE_STORAGE,
+                  maximum_pdu_size: int = 0,
+                  dedup: bool = False,
+                  host: Union[str, None] = None,
+                  port: Union[int, None] = None,
+                  ae_title: str = "LOAD_TARGET",
+                  work_dir: Union[str, None] = None) -> Dict:
+    """
+    :param maximum_pdu_size: of the local SCP and the senders. 0 for unlimited.
+    :param dedup: give the local SCP a deduplication index
+    :param host: send to an SCP running elsewhere, on port, instead of a local one. No handle_store timings then.
+    """
+    if host is not None and port is None:
+        raise ValueError("A port is required with a host")
+    remove_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="scp_load_")
+
+    # Every association sends its own study, so nothing is a resend of another association's instances
+    studies = []
+    for i in range(associations):
+        study_dir = os.path.join(work_dir, "studies", str(i))
+        generate_study(study_dir,
+                       series=1,
+                       instances_per_series=instances,
+                       sop_class_uids=[sop_class_uid],
+                       rows=rows,
+                       columns=columns)
+        studies.append(scan_folder(study_dir))
+    sent_bytes = sum([os.path.getsize(f.path) for dicom_files in studies for f in dicom_files])
+
+    scp = None
+    cpu_seconds, wall_seconds = [], []
+    if host is None:
+        scp = SCP(ae_title=ae_title,
+                  ip="localhost",
+                  port=free_port(),
+                  temporary_storage=os.path.join(work_dir, "received"),
+                  log_level=logging.WARNING,
+                  pynetdicom_log_level="none",
+                  instance_index=InstanceIndex(os.path.join(work_dir, "instances.db")) if dedup else None,
+                  maximum_pdu_size=maximum_pdu_size)
+        scp.handle_store = timed_handler(scp.handle_store, cpu_seconds, wall_seconds)
+        scp.run_scp(blocking=False)
+        host, port = scp.ip, scp.port
+
+    pool = ThreadPool(associations)
+    process_cpu = time.process_time()
+    start = time.perf_counter()
+    results = pool.map(functools.partial(send_association, host, port, ae_title,
+                                         maximum_pdu_size=maximum_pdu_size), studies)
+    elapsed = time.perf_counter() - start
+    process_cpu = time.process_time() - process_cpu
+    pool.close()
+    pool.join()
+
+    if scp is not None:
+        scp.ae.shutdown()
+        if scp.instance_index is not None:
+            scp.instance_index.close()
+    if remove_work_dir:
+        shutil.rmtree(work_dir)
+
+    latencies = [latency for result in results for latency in result["latencies"]]
+    stored = sum([len(result["latencies"]) - result["failed"] for result in results if result["established"]])
+    report = {
+        "parameters": {"associations": associations, "instances": instances, "rows": rows, "columns": columns,
+                       "sop_class_uid": sop_class_uid, "maximum_pdu_size": maximum_pdu_size, "dedup": dedup,
+                       "local_scp": scp is not None},
+        "elapsed_seconds": elapsed,
+        "stored_instances": stored,
+        "failed_instances": associations * instances - stored,
+        "rejected_associations": len([result for result in results if not result["established"]]),
+        "instances_per_second": stored / elapsed,
+        "bytes_per_second": sent_bytes / elapsed,
+        "latency_seconds": {
+            "association_setup": summarize([result["setup"] for result in results]),
+            "c_store": summarize(latencies),
+        },
+        # Senders and, for a local SCP, the receiver share this process
+        "process_cpu_seconds_per_instance": process_cpu / max(len(latencies), 1),
+    }
+    if scp is not None:
+        report["handle_store"] = {"cpu_seconds_per_instance": sum(cpu_seconds) / max(len(cpu_seconds), 1),
+                                  "wall_seconds": summarize(wall_seconds)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--associations", type=int, default=4, help="Concurrent associations")
+    parser.add_argument("--instances", type=int, default=100, help="Instances per association")
+    parser.add_argument("--rows", type=int, default=256)
+    parser.add_argument("--columns", type=int, default=256)
+    parser.add_argument("--sop-class-uid", default=CT_IMAGE_STORAGE)
+    parser.add_argument("--maximum-pdu-size", type=int, default=0, help="Bytes. 0 for unlimited")
+    parser.add_argument("--dedup", action="store_true", help="Local SCP keeps a deduplication index")
+    parser.add_argument("--host", default=None, help="Target SCP. A local SCP is started if not given")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--ae-title", default="LOAD_TARGET")
+    parser.add_argument("--work-dir", default=None, help="Kept after the run if given")
+    parser.add_argument("--output", default=None, help="Write the report as json to this file")
+    args = parser.parse_args()
+    if args.host is not None and args.port is None:
+        parser.error("--port is required with --host")
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run_benchmark(associations=args.associations,
+                           instances=args.instances,
+                           rows=args.rows,
+                           columns=args.columns,
+                           sop_class_uid=args.sop_class_uid,
+                           maximum_pdu_size=args.maximum_pdu_size,
+                           dedup=args.dedup,
+                           host=args.host,
+                           port=args.port,
+                           ae_title=args.ae_title,
+                           work_dir=args.work_dir)
+    print_report("SCP load", report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import os
+from typing import List
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+
+
+def synthetic_instance(sop_class_uid: str,
+                       study_instance_uid: str,
+                       series_instance_uid: str,
+                       study_description: str = "Synthetic Study",
+                       series_description: str = "Synthetic Series",
+                       rows: int = 512,
+                       columns: int = 512,
+                       instance_number: int = 1) -> Dataset:
+    """
+    A minimal image instance of the given SOP class with 16 bit pixel data. No patient data.
+    """
+    sop_instance_uid = generate_uid()
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = sop_class_uid
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.StudyInstanceUID = study_instance_uid
+    ds.SeriesInstanceUID = series_instance_uid
+    ds.StudyDescription = study_description
+    ds.SeriesDescription = series_description
+    ds.InstanceNumber = instance_number
+    ds.PatientID = "SYNTHETIC"
+    ds.PatientName = "Synthetic^Patient"
+
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = (instance_number % 256).to_bytes(1, "little") * (rows * columns * 2)
+    return ds
+
+
+def generate_study(path: str,
+                   series: int = 1,
+                   instances_per_series: int = 100,
+                   sop_class_uids: List[str] = (CT_IMAGE_STORAGE,),
+                   study_description: str = "Synthetic Study",
+                   rows: int = 512,
+                   columns: int = 512) -> List[str]:
+    """
+    Writes a study to path/<series_number>/<instance_number>.dcm. SOP classes of the series cycle through
+    sop_class_uids.
+    :return: paths of all written files
+    """
+    study_instance_uid = generate_uid()
+    paths = []
+    for series_number in range(series):
+        sop_class_uid = sop_class_uids[series_number % len(sop_class_uids)]
+        series_instance_uid = generate_uid()
+        series_path = os.path.join(path, str(series_number))
+        os.makedirs(series_path, exist_ok=True)
+
+        for instance_number in range(1, instances_per_series + 1):
+            ds = synthetic_instance(sop_class_uid=sop_class_uid,
+                                    study_instance_uid=study_instance_uid,
+                                    series_instance_uid=series_instance_uid,
+                                    study_description=study_description,
+                                    series_description=f"Synthetic Series {series_number}",
+                                    rows=rows,
+                                    columns=columns,
+                                    instance_number=instance_number)
+            p = os.path.join(series_path, f"{instance_number}.dcm")
+            ds.save_as(p, write_like_original=False)
+            paths.append(p)
+    return paths
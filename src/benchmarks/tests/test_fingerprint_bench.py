@@ -0,0 +1,20 @@
+import unittest
+
+from benchmarks.fingerprint_bench import run_case
+from daemon.fingerprinting.fingerprint import slow_fingerprint
+
+
+class TestFingerprintBench(unittest.TestCase):
+    def test_equivalent_candidate(self):
+        result = run_case(fingerprints=20, triggers=2, series=5, candidate=slow_fingerprint, min_time=0)
+        self.assertTrue(result["candidate_equivalent"])
+        self.assertGreater(result["matches"], 0)
+        self.assertIn("candidate", result["seconds_per_association"])
+
+    def test_non_equivalent_candidate(self):
+        result = run_case(fingerprints=20, triggers=2, series=5, candidate=lambda fp, assoc: None, min_time=0)
+        self.assertFalse(result["candidate_equivalent"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import json
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.inference_server_stub import InferenceServerStub
+from client.client import Client
+from database.db import DB
+
+
+class TestInferenceServerStub(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stub = InferenceServerStub().start()
+        self.db = DB(base_dir=self.tmp_dir)
+        fp = self.db.add_fingerprint(human_readable_id="test", inference_server_url=self.stub.url)
+        self.task = self.db.add_task(fingerprint_id=fp.id)
+        with open(self.task.tar_path, "bw") as f:
+            f.write(b"input tar")
+        self.client = Client()
+
+    def tearDown(self) -> None:
+        self.stub.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def post_task(self):
+        res = self.client.post_task(self.task)
+        self.assertTrue(res.ok)
+        self.task.inference_server_uid = json.loads(res.content)["uid"]
+        return self.task.inference_server_uid
+
+    def test_post_and_get_task(self):
+        uid = self.post_task()
+        self.assertEqual("test", self.stub.tasks[uid].human_readable_id)
+
+        res = self.client.get_task(self.task)
+        self.assertTrue(res.ok)
+        self.assertEqual(b"input tar", res.content)
+
+    def test_pending_task(self):
+        self.stub.inference_time = 3600
+        uid = self.post_task()
+
+        self.assertEqual(554, self.client.get_task(self.task).status_code)
+        res = self.client.get_task_statuses(self.stub.url, [uid, "unknown"])
+        self.assertEqual({uid: 554, "unknown": 500}, json.loads(res.content))
+
+    def test_delete_task(self):
+        self.post_task()
+        self.assertEqual(200, self.client.delete_task(self.task).status_code)
+        self.assertEqual(0, len(self.stub.tasks))
+        self.assertEqual(404, self.client.delete_task(self.task).status_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from benchmarks.replay import run_replay, instance_shape
+from benchmarks.report import free_port
+from benchmarks.synthetic import generate_study
+from dicom_networking.scp import SCP
+from dicom_networking.scu import post_folder_to_dicom_node
+from dicom_networking.trace import TraceWriter, read_trace, load_salt, SALT_BYTES, SALT_SUFFIX
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp(prefix="replay_test_")
+        self.trace_path = os.path.join(self.tmp_dir, "trace.jsonl")
+        self.scp = SCP(ae_title="TRACED",
+                       ip="localhost",
+                       port=free_port(),
+                       temporary_storage=os.path.join(self.tmp_dir, "received"),
+                       log_level=logging.WARNING,
+                       pynetdicom_log_level="none",
+                       trace=TraceWriter(self.trace_path))
+        self.scp.run_scp(blocking=False)
+
+    def tearDown(self) -> None:
+        self.scp.ae.shutdown()
+        shutil.rmtree(self.tmp_dir)
+
+    def record(self, associations: int):
+        study_dir = os.path.join(self.tmp_dir, "study")
+        generate_study(study_dir, series=2, instances_per_series=3, rows=16, columns=16,
+                       study_description="Private Study")
+        for _ in range(associations):
+            self.assertTrue(post_folder_to_dicom_node(self.scp.ip, self.scp.port, self.scp.ae_title, study_dir))
+        for _ in range(100):
+            if os.path.exists(self.trace_path) and len(list(read_trace(self.trace_path))) == associations:
+                break
+            time.sleep(0.05)
+        return list(read_trace(self.trace_path))
+
+    def test_trace_holds_metadata_only(self):
+        entries = self.record(associations=1)
+        self.assertEqual(1, len(entries))
+        self.assertEqual("association", entries[0]["type"])
+        self.assertEqual(2, len(entries[0]["series"]))
+        self.assertEqual([3, 3], [series["instance_count"] for series in entries[0]["series"]])
+        self.assertEqual(1, len({series["study"] for series in entries[0]["series"]}))
+
+        with open(self.trace_path) as f:
+            content = f.read()
+        self.assertNotIn("Private Study", content)
+        received = self.scp.get_incoming_queue().get(timeout=5)
+        for series_instance in received.series_instances.values():
+            self.assertNotIn(series_instance.series_instance_uid, content)
+            self.assertNotIn(series_instance.study_instance_uid, content)
+
+    def test_replay(self):
+        entries = self.record(associations=2)
+        self.assertEqual(entries[0]["series"][0]["series"], entries[1]["series"][0]["series"])
+
+        report = run_replay(self.trace_path, speed=100)
+        self.assertEqual(2, report["associations"])
+        self.assertEqual(0, report["failed_associations"])
+        self.assertEqual(12, report["instances"])
+        self.assertEqual(2, report["latency_seconds"]["start_lag"]["count"])
+
+    def test_host_requires_port(self):
+        self.assertRaises(ValueError, run_replay, self.trace_path, host="localhost")
+
+    def test_instance_shape(self):
+        rows, columns = instance_shape(512 + 2 * 64 * 64)
+        self.assertEqual((64, 64), (rows, columns))
+        self.assertEqual((1, 1), instance_shape(0))
+
+
+class TestSalt(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp(prefix="salt_test_")
+        self.trace_path = os.path.join(self.tmp_dir, "trace.jsonl")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_processes_share_one_salt(self):
+        with multiprocessing.Pool(8) as pool:
+            salts = pool.map(load_salt, [self.trace_path] * 32)
+        self.assertEqual(1, len(set(salts)))
+        self.assertEqual(SALT_BYTES, len(salts[0]))
+        self.assertEqual(["trace.jsonl.salt"], os.listdir(self.tmp_dir))  # No temporary files left behind
+
+    def test_corrupt_salt_is_rejected(self):
+        with open(self.trace_path + SALT_SUFFIX, "wb"):
+            pass
+        self.assertRaises(ValueError, load_salt, self.trace_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from benchmarks.report import free_port
+from benchmarks.scp_load import run_benchmark
+
+
+class TestSCPLoad(unittest.TestCase):
+    def test_local_scp(self):
+        report = run_benchmark(associations=2, instances=3, rows=16, columns=16, maximum_pdu_size=4096)
+        self.assertEqual(6, report["stored_instances"])
+        self.assertEqual(0, report["failed_instances"])
+        self.assertEqual(6, report["latency_seconds"]["c_store"]["count"])
+        self.assertEqual(6, report["handle_store"]["wall_seconds"]["count"])
+        self.assertGreater(report["handle_store"]["cpu_seconds_per_instance"], 0)
+        self.assertGreater(report["bytes_per_second"], 0)
+
+    def test_dedup_storage_mode(self):
+        report = run_benchmark(associations=1, instances=2, rows=16, columns=16, dedup=True)
+        self.assertEqual(2, report["stored_instances"])
+
+    def test_rejected_associations_count_as_failed(self):
+        # Nothing listens on the port, so every association is rejected
+        report = run_benchmark(associations=2, instances=3, rows=16, columns=16, host="localhost", port=free_port())
+        self.assertEqual(0, report["stored_instances"])
+        self.assertEqual(6, report["failed_instances"])
+        self.assertEqual(2, report["rejected_associations"])
+
+    def test_host_requires_port(self):
+        self.assertRaises(ValueError, run_benchmark, host="localhost")
+
+
+if __name__ == '__main__':
+    unittest.main()
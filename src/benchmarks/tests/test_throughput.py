@@ -0,0 +1,19 @@
+import unittest
+
+from benchmarks.throughput import run_benchmark
+
+
+class TestThroughput(unittest.TestCase):
+    def test_run_benchmark(self):
+        report = run_benchmark(studies=2, instances=2, senders=2, rows=8, columns=8, timeout=60)
+
+        self.assertEqual(2, report["completed_studies"])
+        self.assertEqual(4, report["delivered_instances"])
+        latencies = report["latency_seconds"]
+        for stage in ["created_to_posted", "posted_to_downloaded", "downloaded_to_delivered", "delivered_to_cleaned"]:
+            self.assertEqual(2, latencies[stage]["count"])
+            self.assertGreaterEqual(latencies[stage]["p50"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
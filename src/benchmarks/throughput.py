@@ -0,0 +1,217 @@
+"""
+End-to-end throughput benchmark of the dicom node.
+
+Synthetic studies are pushed into an SCP over C-STORE by concurrent senders, routed through the Daemon against a
+local inference server stand-in and delivered to a local receiving SCP. Reports studies/hour, instances/s and
+per-stage latency percentiles. Stage latencies are measured from the times the daemon writes each status of a task,
+not from when the benchmark notices them.
+
+Run from src/:
+    python -m benchmarks.throughput --studies 20 --senders 4 --instances 50
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from typing import Dict, Union
+
+from benchmarks.inference_server_stub import InferenceServerStub
+from benchmarks.report import summarize, print_report, free_port
+from benchmarks.synthetic import generate_study, CT_IMAGE_STORAGE
+from client.async_client import AsyncClient
+from client.client import Client
+from daemon.daemon import Daemon
+from database.db import DB
+from dicom_networking.scp import SCP
+from dicom_networking.scu import post_folder_to_dicom_node
+
+
+# Stages by the status the daemon writes when a task completes them
+STAGE_STATUSES = {1: "posted", 2: "downloaded", 3: "delivered", 10: "cleaned"}
+
+
+class RecordingDB(DB):
+    """
+    Records when each status of a task is written, so stage transitions are timed as they happen.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transitions: Dict[int, Dict[str, datetime.datetime]] = {}  # Dict[task id: Dict[stage: first reached]]
+
+    def record(self, task_id: int, status: Union[int, None]):
+        if status in STAGE_STATUSES:
+            self.transitions.setdefault(task_id, {}).setdefault(STAGE_STATUSES[status], datetime.datetime.now())
+
+    def update_task(self, task_id: int, *args, **kwargs):
+        task = super().update_task(task_id, *args, **kwargs)
+        self.record(task_id, kwargs.get("status"))
+        return task
+
+    def update_tasks(self, updates: Dict[int, Dict]):
+        super().update_tasks(updates)
+        for task_id, values in updates.items():
+            self.record(task_id, values.get("status"))
+
+    def cleaned(self) -> int:
+        return len([stamps for stamps in self.transitions.values() if "cleaned" in stamps])
+
+
+def count_files(path: str) -> int:
+    return sum([len(files) for _, _, files in os.walk(path)])
+
+
+def run_benchmark(studies: int = 10,
+                  series: int = 1,
+                  instances: int = 50,
+                  senders: int = 4,
+                  rows: int = 256,
+                  columns: int = 256,
+                  inference_time: float = 0,
+                  async_client: bool = True,
+                  timeout: float = 600,
+                  work_dir: str = None) -> Dict:
+    remove_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="dicom_node_benchmark_")
+    study_dirs = []
+    for i in range(studies):
+        study_dir = os.path.join(work_dir, "studies", str(i))
+        generate_study(study_dir, series=series, instances_per_series=instances, rows=rows, columns=columns)
+        study_dirs.append(study_dir)
+
+    stub = InferenceServerStub(inference_time=inference_time).start()
+    db = RecordingDB(base_dir=os.path.join(work_dir, "database"))
+    scp = SCP(ae_title="SOURCE",
+              ip="localhost",
+              port=free_port(),
+              temporary_storage=os.path.join(work_dir, "source"),
+              log_level=logging.WARNING,
+              pynetdicom_log_level="none")
+    destination_dir = os.path.join(work_dir, "destination")
+    destination = SCP(ae_title="DESTINATION",
+                      ip="localhost",
+                      port=free_port(),
+                      temporary_storage=destination_dir,
+                      log_level=logging.WARNING,
+                      pynetdicom_log_level="none")
+    scp.run_scp(blocking=False)
+    destination.run_scp(blocking=False)
+
+    fp = db.add_fingerprint(human_readable_id="benchmark", inference_server_url=stub.url)
+    db.add_trigger(fingerprint_id=fp.id, sop_class_uid_exact=CT_IMAGE_STORAGE)
+    db.add_destination(scu_ip=destination.ip,
+                       scu_port=destination.port,
+                       scu_ae_title=destination.ae_title,
+                       fingerprint_id=fp.id)
+
+    client = AsyncClient() if async_client else Client()
+    daemon = Daemon(client=client, db=db, scp=scp, run_interval=0.05, log_level=logging.WARNING)
+
+    # Senders run in the background while this thread drives the daemon stages
+    ingest_latencies = []
+
+    def send(study_dir):
+        start = time.monotonic()
+        post_folder_to_dicom_node(scu_ip=scp.ip, scu_port=scp.port, scu_ae_title=scp.ae_title, dicom_dir=study_dir)
+        ingest_latencies.append(time.monotonic() - start)
+
+    pool = ThreadPool(senders)
+    start = time.monotonic()
+    sending = pool.map_async(send, study_dirs)
+    ingest_done = None
+
+    while db.cleaned() < studies and time.monotonic() - start < timeout:
+        if ingest_done is None and sending.ready():
+            ingest_done = time.monotonic()
+        for stage in [daemon.fingerprint,
+                      daemon.post_tasks,
+                      daemon.get_tasks,
+                      daemon.post_to_final_destinations,
+                      daemon.clean_up]:
+            stage()
+    elapsed = time.monotonic() - start
+    ingest_done = ingest_done or elapsed + start
+
+    # Creation and upload times as the daemon stored them
+    seen: Dict[int, Dict[str, datetime.datetime]] = {}
+    for task in db.get_tasks():
+        seen[task.id] = {"created": task.timestamp, **db.transitions.get(task.id, {})}
+        if task.posted_at:
+            seen[task.id]["posted"] = task.posted_at
+
+    pool.close()
+    pool.join()
+    if async_client:
+        daemon.loop.run_until_complete(client.aclose())
+    scp.ae.shutdown()
+    destination.ae.shutdown()
+    stub.stop()
+
+    def stage_latencies(begin, end):
+        return [(s[end] - s[begin]).total_seconds() for s in seen.values() if begin in s and end in s]
+
+    sent_instances = studies * series * instances
+    completed = len([s for s in seen.values() if "cleaned" in s])
+    delivered_instances = count_files(destination_dir)
+    if remove_work_dir:
+        shutil.rmtree(work_dir)
+
+    return {
+        "parameters": {"studies": studies, "series": series, "instances": instances, "senders": senders,
+                       "rows": rows, "columns": columns, "inference_time": inference_time,
+                       "async_client": async_client},
+        "elapsed_seconds": elapsed,
+        "completed_studies": completed,
+        "studies_per_hour": completed / elapsed * 3600,
+        "ingest_instances_per_second": sent_instances / (ingest_done - start),
+        "delivered_instances": delivered_instances,
+        "delivered_instances_per_second": delivered_instances / elapsed,
+        "latency_seconds": {
+            "ingest_association": summarize(ingest_latencies),
+            "created_to_posted": summarize(stage_latencies("created", "posted")),
+            "posted_to_downloaded": summarize(stage_latencies("posted", "downloaded")),
+            "downloaded_to_delivered": summarize(stage_latencies("downloaded", "delivered")),
+            "delivered_to_cleaned": summarize(stage_latencies("delivered", "cleaned")),
+            "created_to_delivered": summarize(stage_latencies("created", "delivered")),
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=10)
+    parser.add_argument("--series", type=int, default=1, help="Series per study")
+    parser.add_argument("--instances", type=int, default=50, help="Instances per series")
+    parser.add_argument("--senders", type=int, default=4, help="Concurrent C-STORE senders")
+    parser.add_argument("--rows", type=int, default=256)
+    parser.add_argument("--columns", type=int, default=256)
+    parser.add_argument("--inference-time", type=float, default=0, help="Seconds the stub spends per task")
+    parser.add_argument("--sync-client", action="store_true", help="Use the blocking Client")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--work-dir", default=None, help="Kept after the run if given")
+    parser.add_argument("--output", default=None, help="Write the report as json to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run_benchmark(studies=args.studies,
+                           series=args.series,
+                           instances=args.instances,
+                           senders=args.senders,
+                           rows=args.rows,
+                           columns=args.columns,
+                           inference_time=args.inference_time,
+                           async_client=not args.sync_client,
+                           timeout=args.timeout,
+                           work_dir=args.work_dir)
+    print_report("Throughput", report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import logging
+from typing import Union, List
+from urllib.parse import urljoin
+
+import httpx
+
+from client.client import task_url
+from decorators.logging import log
+
+
+class AsyncClient:
+    """
+    Coroutine counterpart of Client. Same post_task/get_task/get_task_statuses/delete_task semantics, but many
+    requests can be in flight on one event loop. The underlying connection pool is bound to the event loop of
+    the first request, so an AsyncClient must only be used from one loop.
+    """
+    def __init__(self,
+                 cert: Union[str, bool] = True,
+                 log_level=10,
+                 callback_url: Union[str, None] = None,
+                 transport: Union[httpx.AsyncBaseTransport, None] = None,
+                 connect_timeout: float = 10,
+                 read_timeout: float = 600):
+        self.cert = cert
+        self.callback_url = callback_url
+        # read_timeout also bounds each write and the wait for a pooled connection. Uploads can be large.
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.transport = transport
+        self._session = None
+
+        LOG_FORMAT = ('%(levelname)s:%(asctime)s:%(message)s')
+        logging.basicConfig(level=log_level, format=LOG_FORMAT)
+
+    @property
+    def session(self) -> httpx.AsyncClient:
+        if self._session is None:
+            self._session = httpx.AsyncClient(verify=self.cert,
+                                              timeout=self.timeout,
+                                              transport=self.transport)
+        return self._session
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    @log
+    async def post_task(self,
+                        task,
+                        inference_server_url: Union[str, None] = None,
+                        tar_path: Union[str, None] = None) -> httpx.Response:
+        url = urljoin(inference_server_url or task.fingerprint.inference_server_url, "/api/tasks/")
+        logging.debug("[ ] Posting task %s to %s", task.id, url)
+        params = {"human_readable_id": task.fingerprint.human_readable_id}
+        if self.callback_url:
+            params["callback_url"] = self.callback_url
+
+        with open(tar_path or task.tar_path, "br") as tar_file:
+            res = await self.session.post(url=url,
+                                          params=params,
+                                          files={"tar_file": tar_file})
+            logging.debug("[X] Posting task %s to %s", task.id, url)
+
+        return res
+
+    @log
+    async def get_task(self, task) -> httpx.Response:
+        url = urljoin(task_url(task), "/api/tasks/outputs/")
+        logging.debug("[ ] Getting task %s from %s", task.inference_server_uid, url)
+
+        res = await self.session.get(url=url,
+                                     params={"uid": task.inference_server_uid})
+        logging.debug("[X] Getting task %s from %s", task.inference_server_uid, url)
+
+        return res
+
+    @log
+    async def get_task_statuses(self, inference_server_url: str, uids: List[str]) -> httpx.Response:
+        url = urljoin(inference_server_url, "/api/tasks/statuses/")
+        logging.debug("[ ] Getting statuses of %s tasks from %s", len(uids), url)
+
+        res = await self.session.post(url=url,
+                                      json={"uids": uids})
+        logging.debug("[X] Getting statuses of %s tasks from %s", len(uids), url)
+
+        return res
+
+    @log
+    async def delete_task(self, task) -> httpx.Response:
+        url = urljoin(task_url(task), "/api/tasks/")
+        logging.debug("[ ] Deleting task %s from %s", task.inference_server_uid, url)
+
+        res = await self.session.delete(url=url,
+                                        params={"uid": task.inference_server_uid})
+        return res
+
+    @log
+    async def probe(self, inference_server_url: str) -> httpx.Response:
+        """
+        Health check. Any answer below 500 means the server is up.
+        """
+        url = urljoin(inference_server_url, "/api/")
+        return await self.session.get(url=url, timeout=self.timeout.connect)
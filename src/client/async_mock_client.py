@@ -0,0 +1,35 @@
+import asyncio
+from typing import List, Union
+
+import requests
+
+from client.mock_client import MockClient
+
+
+class AsyncMockClient(MockClient):
+    """
+    MockClient with coroutine methods. Each call yields to the event loop once, so concurrent calls interleave.
+    """
+    async def post_task(self,
+                        task,
+                        inference_server_url: Union[str, None] = None,
+                        tar_path: Union[str, None] = None,
+                        success=True) -> requests.Response:
+        await asyncio.sleep(0)
+        return super().post_task(task, inference_server_url=inference_server_url, tar_path=tar_path, success=success)
+
+    async def get_task(self, task, error_code=False) -> requests.Response:
+        await asyncio.sleep(0)
+        return super().get_task(task, error_code=error_code)
+
+    async def get_task_statuses(self, inference_server_url: str, uids: List[str]) -> requests.Response:
+        await asyncio.sleep(0)
+        return super().get_task_statuses(inference_server_url, uids)
+
+    async def delete_task(self, task) -> requests.Response:
+        await asyncio.sleep(0)
+        return super().delete_task(task)
+
+    async def probe(self, inference_server_url: str) -> requests.Response:
+        await asyncio.sleep(0)
+        return super().probe(inference_server_url)
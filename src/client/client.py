@@ -1,5 +1,5 @@
 import logging
-from typing import Union
+from typing import Union, List
 from urllib.parse import urljoin
 
 import requests
@@ -7,46 +7,102 @@ import requests
 from decorators.logging import log
 
 
+def task_url(task) -> str:
+    """
+    :return: the inference server a task was posted to
+    """
+    return task.inference_server_url or task.fingerprint.inference_server_url
+
+
 class Client:
-    def __init__(self, cert: Union[str, bool] = True, log_level=10):
+    def __init__(self,
+                 cert: Union[str, bool] = True,
+                 log_level=10,
+                 callback_url: Union[str, None] = None,
+                 connect_timeout: float = 10,
+                 read_timeout: float = 600):
         self.cert = cert
+        self.callback_url = callback_url  # Inference server calls this with ?uid=... when a task is finished
+        # Bounds time spent on unreachable or hanging servers. read_timeout is between bytes, not for a whole upload.
+        self.timeout = (connect_timeout, read_timeout)
 
         LOG_FORMAT = ('%(levelname)s:%(asctime)s:%(message)s')
         logging.basicConfig(level=log_level, format=LOG_FORMAT)
 
     @log
-    def post_task(self, task) -> requests.Response:
-        url = urljoin(task.fingerprint.inference_server_url, "/api/tasks/")
-        logging.debug(f"[ ] Posting task {task.__dict__} to {url}")
-        with open(task.tar_path, "br") as tar_file:
+    def post_task(self,
+                  task,
+                  inference_server_url: Union[str, None] = None,
+                  tar_path: Union[str, None] = None) -> requests.Response:
+        """
+        :param inference_server_url: endpoint to post to. The fingerprint's inference_server_url if None
+        :param tar_path: upload this instead of task.tar_path, e.g. a batch of tasks packed by daemon.batching
+        """
+        url = urljoin(inference_server_url or task.fingerprint.inference_server_url, "/api/tasks/")
+        logging.debug("[ ] Posting task %s to %s", task.id, url)
+        params = {"human_readable_id": task.fingerprint.human_readable_id}
+        if self.callback_url:
+            params["callback_url"] = self.callback_url
+
+        with open(tar_path or task.tar_path, "br") as tar_file:
             res = requests.post(url=url,
-                                params={"human_readable_id": task.fingerprint.human_readable_id},
+                                params=params,
                                 files={"tar_file": tar_file},
-                                verify=self.cert)
+                                verify=self.cert,
+                                timeout=self.timeout)
             assert isinstance(res, requests.Response)
-            logging.debug(f"[X] Posting task {task.__dict__} to {url}")
+            logging.debug("[X] Posting task %s to %s", task.id, url)
 
         return res
     @log
 
     def get_task(self, task) -> requests.Response:
-        url = urljoin(task.fingerprint.inference_server_url, "/api/tasks/outputs/")
-        logging.debug(f"[ ] Getting task {task.inference_server_uid} from {url}")
+        url = urljoin(task_url(task), "/api/tasks/outputs/")
+        logging.debug("[ ] Getting task %s from %s", task.inference_server_uid, url)
 
         res = requests.get(url=url,
                            params={"uid": task.inference_server_uid},
-                           verify=self.cert)
-        logging.debug(f"[X] Getting task {task.inference_server_uid} from {url}")
+                           verify=self.cert,
+                           timeout=self.timeout)
+        logging.debug("[X] Getting task %s from %s", task.inference_server_uid, url)
 
         return res
+
+    @log
+    def get_task_statuses(self, inference_server_url: str, uids: List[str]) -> requests.Response:
+        """
+        Lightweight polling of many tasks in one request. Nothing is downloaded.
+        The response maps each uid to the status code the outputs endpoint would return for it
+        (200 when finished, 551/554 when on its way, 405/500/552/553 when failed).
+        """
+        url = urljoin(inference_server_url, "/api/tasks/statuses/")
+        logging.debug("[ ] Getting statuses of %s tasks from %s", len(uids), url)
+
+        res = requests.post(url=url,
+                            json={"uids": uids},
+                            verify=self.cert,
+                            timeout=self.timeout)
+        logging.debug("[X] Getting statuses of %s tasks from %s", len(uids), url)
+
+        return res
+
     @log
     def delete_task(self, task) -> requests.Response:
-        url = urljoin(task.fingerprint.inference_server_url, "/api/tasks/")
-        logging.debug(f"[ ] Deleting task {task.inference_server_uid} from {url}")
+        url = urljoin(task_url(task), "/api/tasks/")
+        logging.debug("[ ] Deleting task %s from %s", task.inference_server_uid, url)
 
         res = requests.delete(url=url,
                               params={"uid": task.inference_server_uid},
-                              verify=self.cert)
+                              verify=self.cert,
+                              timeout=self.timeout)
         return res
 
+    @log
+    def probe(self, inference_server_url: str) -> requests.Response:
+        """
+        Health check. Any answer below 500 means the server is up.
+        """
+        url = urljoin(inference_server_url, "/api/")
+        return requests.get(url=url, verify=self.cert, timeout=self.timeout[0])
+
 
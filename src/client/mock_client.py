@@ -1,7 +1,7 @@
 import json
 import secrets
 import shutil
-from typing import Union
+from typing import Union, List
 
 import requests
 
@@ -9,11 +9,33 @@ import requests
 class MockClient:
     def __init__(self, cert: Union[str, bool] = True):
         self.tasks = {}
+        self.statuses = {}  # Dict[uid: status_code]. Tasks not in here are reported finished (200)
+        self.get_task_calls = 0
+        self.get_task_statuses_calls = 0
+        self.delete_task_calls = 0
+        self.failing_deletes = 0  # Number of upcoming delete_task calls which fail with 500
+        self.failing_urls = set()  # Inference servers which answer posts and probes with 503
+        self.probe_calls = 0
+        self.outputs = {}  # Dict[uid: bytes]
+        self.posted_urls = []  # inference_server_url of every post_task call
+
+    def post_task(self,
+                  task,
+                  inference_server_url: Union[str, None] = None,
+                  tar_path: Union[str, None] = None,
+                  success=True) -> requests.Response:
+        self.posted_urls.append(inference_server_url)
+        if inference_server_url in self.failing_urls:
+            res = requests.Response()
+            res.status_code = 503
+            res._content = json.dumps('Inference server is unavailable')
+            return res
 
-    def post_task(self, task, success=True) -> requests.Response:
         uid = secrets.token_urlsafe()
         task.inference_server_uid = uid
         self.tasks[uid] = task
+        with open(tar_path or task.tar_path, "br") as r:
+            self.outputs[uid] = r.read()  # Echoes the upload as output
         res_t = {"uid": uid,
                            "inference_server_tar": task.inference_server_tar,
                            "tar_path": task.tar_path}
@@ -30,29 +52,56 @@ class MockClient:
 
 
     def get_task(self, task, error_code=False) -> requests.Response:
+        self.get_task_calls += 1
         res = requests.Response()
+        error_code = error_code or self.statuses.get(task.inference_server_uid, False)
         if error_code:
             res.status_code = error_code
             res._content = json.dumps('There is a little black spot on the sun to day')
         else:
-            t = self.tasks[task.inference_server_uid]
-            print(t)
-            print(f"HERE: {t}")
             res.status_code = 200
-            with open(t.tar_path, "br") as r:
-                res._content = r.read()
+            res._content = self.outputs[task.inference_server_uid]
+        return res
+
+    def get_task_statuses(self, inference_server_url: str, uids: List[str]) -> requests.Response:
+        self.get_task_statuses_calls += 1
+        statuses = {}
+        for uid in uids:
+            if uid in self.tasks:
+                statuses[uid] = self.statuses.get(uid, 200)
+            else:
+                statuses[uid] = 500
+
+        res = requests.Response()
+        res.status_code = 200
+        res._content = json.dumps(statuses)
+        return res
+
+    def probe(self, inference_server_url: str) -> requests.Response:
+        self.probe_calls += 1
+        res = requests.Response()
+        res.status_code = 503 if inference_server_url in self.failing_urls else 200
+        res._content = json.dumps('Inference server stub')
         return res
 
     def delete_task(self, task) -> requests.Response:
+        self.delete_task_calls += 1
+        if self.failing_deletes > 0:
+            self.failing_deletes -= 1
+            res = requests.Response()
+            res.status_code = 500
+            res._content = json.dumps('Inference server is having a bad day')
+            return res
         try:
             del self.tasks[task.inference_server_uid]
+            self.outputs.pop(task.inference_server_uid, None)
             res = requests.Response()
             res.status_code = 200
             res._content = json.dumps('Task successfully deleted')
-        except Exception as e:
+        except KeyError as e:
             res = requests.Response()
-            res.status_code = 500
-            res._content = json.dumps(e)
+            res.status_code = 404
+            res._content = json.dumps(f"Task {e} not found")
         return res
 
 
@@ -0,0 +1,78 @@
+import asyncio
+import json
+import shutil
+import tempfile
+import unittest
+
+import httpx
+
+from client.async_client import AsyncClient
+from database.db import DB
+
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = DB(base_dir=self.tmp_dir)
+        fp = self.db.add_fingerprint(human_readable_id="test", inference_server_url="http://inference-server")
+        self.task = self.db.add_task(fingerprint_id=fp.id)
+        self.task.inference_server_uid = "ABC"
+        with open(self.task.tar_path, "bw") as f:
+            f.write(b"input")
+
+        self.requests = []
+        self.client = AsyncClient(transport=httpx.MockTransport(self.handler))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if request.method == "POST" and request.url.path == "/api/tasks/":
+            return httpx.Response(200, json={"uid": "ABC"})
+        elif request.method == "POST" and request.url.path == "/api/tasks/statuses/":
+            return httpx.Response(200, json={uid: 551 for uid in json.loads(request.content)["uids"]})
+        elif request.method == "GET" and request.url.path == "/api/tasks/outputs/":
+            return httpx.Response(200, content=b"output")
+        elif request.method == "DELETE":
+            return httpx.Response(200, json="Task successfully deleted")
+        return httpx.Response(404)
+
+    def run_client(self, coro):
+        async def run():
+            try:
+                return await coro
+            finally:
+                await self.client.aclose()
+        return asyncio.run(run())
+
+    def test_post_task(self):
+        res = self.run_client(self.client.post_task(self.task))
+        self.assertEqual("ABC", res.json()["uid"])
+        self.assertEqual("test", self.requests[0].url.params["human_readable_id"])
+        self.assertIn(b"input", self.requests[0].content)
+
+    def test_get_task(self):
+        res = self.run_client(self.client.get_task(self.task))
+        self.assertEqual(b"output", res.content)
+        self.assertEqual("ABC", self.requests[0].url.params["uid"])
+
+    def test_get_task_statuses(self):
+        res = self.run_client(self.client.get_task_statuses("http://inference-server", ["ABC", "DEF"]))
+        self.assertEqual({"ABC": 551, "DEF": 551}, res.json())
+
+    def test_delete_task(self):
+        res = self.run_client(self.client.delete_task(self.task))
+        self.assertEqual(200, res.status_code)
+        self.assertEqual("DELETE", self.requests[0].method)
+
+    def test_concurrent_requests(self):
+        async def get_many():
+            return await asyncio.gather(*[self.client.get_task(self.task) for _ in range(50)])
+        responses = self.run_client(get_many())
+        self.assertEqual(50, len(responses))
+        self.assertTrue(all(res.status_code == 200 for res in responses))
+
+
+if __name__ == '__main__':
+    unittest.main()
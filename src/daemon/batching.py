@@ -0,0 +1,81 @@
+import datetime
+import json
+import tarfile
+from io import BytesIO
+from typing import List, Tuple, Dict
+
+MANIFEST = "manifest.json"
+
+
+def group_batches(tasks: List, now: datetime.datetime) -> Tuple[List[List], List]:
+    """
+    Splits tasks into uploads. Tasks of fingerprints without a batch_window are uploaded alone. Tasks of batching
+    fingerprints are packed up to max_batch_size per upload. A batch which is not full is held back until its
+    oldest task has waited batch_window seconds, so tasks arriving close together share one upload.
+    :return: (uploads as lists of tasks, tasks held back)
+    """
+    uploads, held = [], []
+    by_fingerprint: Dict[int, List] = {}
+    for task in tasks:
+        if task.fingerprint.batch_window:
+            by_fingerprint.setdefault(task.fingerprint_id, []).append(task)
+        else:
+            uploads.append([task])
+
+    for fingerprint_tasks in by_fingerprint.values():
+        fp = fingerprint_tasks[0].fingerprint
+        size = max(fp.max_batch_size or 1, 1)
+        for i in range(0, len(fingerprint_tasks), size):
+            batch = fingerprint_tasks[i:i + size]
+            oldest = min(task.timestamp for task in batch)
+            if len(batch) < size and (now - oldest).total_seconds() < fp.batch_window:
+                held += batch
+            else:
+                uploads.append(batch)
+    return uploads, held
+
+
+def batch_member_path(task) -> str:
+    return str(task.id)
+
+
+def pack_batch(tar_path: str, tasks: List):
+    """
+    Writes one upload holding the inputs of all tasks. The input of each task is put in its own folder, listed in
+    manifest.json as {"tasks": [{"task_id": ..., "path": ...}]}. Inference servers are expected to return the
+    outputs of each task in the same folder.
+    """
+    manifest = {"tasks": []}
+    with tarfile.open(tar_path, mode="w") as batch:
+        for task in tasks:
+            prefix = batch_member_path(task)
+            with tarfile.open(task.tar_path) as tf:
+                for member in tf.getmembers():
+                    f = tf.extractfile(member) if member.isfile() else None
+                    member.name = f"{prefix}/{member.name}"
+                    batch.addfile(member, f)
+            manifest["tasks"].append({"task_id": task.id, "path": prefix})
+
+        data = json.dumps(manifest).encode()
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(data)
+        batch.addfile(info, BytesIO(data))
+
+
+def split_batch(batch_tar: BytesIO, task, tar_path: str):
+    """
+    Writes the outputs of task in a batch output to tar_path, without its folder prefix.
+    :raises tarfile.TarError: if the batch output is not a tar
+    :raises ValueError: if the batch output holds no folder of task
+    """
+    prefix = f"{batch_member_path(task)}/"
+    batch_tar.seek(0)
+    with tarfile.open(fileobj=batch_tar) as batch:
+        members = [member for member in batch.getmembers() if member.name.startswith(prefix)]
+        if not members:
+            raise ValueError(f"Batch output holds no outputs of task {task.id}")
+        with tarfile.open(tar_path, mode="w") as tf:
+            for member in members:
+                f = batch.extractfile(member) if member.isfile() else None
+                member.name = member.name[len(prefix):]
+                tf.addfile(member, f)
@@ -0,0 +1,34 @@
+import itertools
+import os
+from typing import Iterable, Iterator
+
+from dicom_networking.scp import Assoc, SeriesInstance
+
+
+def catalog_associations(rows: Iterable) -> Iterator[Assoc]:
+    """
+    Rebuilds the associations of catalogued series, as the SCP released them, for fingerprinting.
+    Series whose files are gone are left out, and associations without any series left are skipped.
+    :param rows: database.models.CatalogSeries with the series of an association next to each other
+    """
+    for (received, assoc_id), series_rows in itertools.groupby(rows, key=lambda row: (row.received, row.assoc_id)):
+        series_instances = {}
+        for row in series_rows:
+            if not os.path.exists(row.path):
+                continue
+            series_instances[row.series_instance_uid] = SeriesInstance(series_instance_uid=row.series_instance_uid,
+                                                                       study_instance_uid=row.study_instance_uid,
+                                                                       study_description=row.study_description,
+                                                                       series_description=row.series_description,
+                                                                       sop_class_uid=row.sop_class_uid,
+                                                                       path=row.path,
+                                                                       instance_count=row.instance_count,
+                                                                       bytes=row.bytes,
+                                                                       duplicate_count=row.duplicate_count)
+        if not series_instances:
+            continue
+        yield Assoc(assoc_id=assoc_id,
+                    timestamp=received,
+                    path=os.path.dirname(os.path.dirname(next(iter(series_instances.values())).path)),
+                    series_instances=series_instances,
+                    duplicate=all(s.duplicate_count == s.instance_count for s in series_instances.values()))
@@ -1,34 +1,104 @@
+import asyncio
 import datetime
 import json
 import logging
 import os
 import queue
+import secrets
 import shutil
+import socket
 import tarfile
 import tempfile
 import threading
 import tarfile
-import time
 from io import BytesIO
-from typing import List
+from typing import List, Dict, Union, Tuple, Iterator, Callable
 
+from pydicom.errors import InvalidDicomError
+
+from client.client import task_url
+from daemon.batching import group_batches, pack_batch, split_batch
+from daemon.catalog import catalog_associations
 from daemon.fingerprinting.fingerprint import fast_fingerprint, slow_fingerprint
+from daemon.health import CircuitBreaker, CircuitOpenError, server_unavailable
+from daemon.leases import LeaseKeeper
+from daemon.polling import PollSchedule
+from daemon.result_cache import ResultCache, content_key
+from daemon.routing import EndpointRouter
+from daemon.scheduling import PriorityScheduler
+from daemon.storage import StorageTiers
 from database.db import DB
-from database.models import Task
+from database.models import Fingerprint, Task
 from decorators.logging import log
-from dicom_networking.scp import SCP
+from dicom_networking.scp import SCP, Assoc
 from dicom_networking.scu import post_folder_to_dicom_node
+from dicom_networking.trace import TraceWriter
+from dicom_networking.transfer_syntaxes import is_uncompressed, to_uncompressed
+
+
+def response_ok(res) -> bool:
+    # Works for both requests and httpx responses. Exceptions from map_client count as failed requests.
+    return not isinstance(res, Exception) and res.status_code < 400
+
 
 class Daemon(threading.Thread):
-    def __init__(self, client, db: DB, scp: SCP, run_interval: int = 10, timeout: int = 7200, log_level=10):
+    def __init__(self,
+                 client,
+                 db: DB,
+                 scp: Union[SCP, None] = None,
+                 run_interval: int = 10,
+                 timeout: int = 7200,
+                 log_level=10,
+                 poll_schedule: Union[PollSchedule, None] = None,
+                 max_concurrent_requests: int = 32,
+                 incoming_queue=None,
+                 worker_id: Union[str, None] = None,
+                 lease_duration: float = 600,
+                 claim_batch_size: int = 100,
+                 storage_tiers: Union[StorageTiers, None] = None,
+                 skip_duplicate_associations: bool = False,
+                 result_cache: Union[ResultCache, None] = None,
+                 scheduler: Union[PriorityScheduler, None] = None,
+                 router: Union[EndpointRouter, None] = None,
+                 circuit_breaker: Union[CircuitBreaker, None] = None,
+                 trace: Union[TraceWriter, None] = None,
+                 catalog_batch_size: int = 100):
         super().__init__()
         self.client = client
         self.db = db
         self.scp = scp
+        # Released associations. From the SCP in this process unless another queue (e.g. SpoolQueue) is given.
+        self.incoming_queue = incoming_queue if incoming_queue is not None else scp.get_incoming_queue()
         self.run_interval = run_interval
+        self.poll_schedule = poll_schedule or PollSchedule(base_interval=run_interval)
         self.timeout = datetime.timedelta(seconds=timeout)
         self.running = True
 
+        # Network stages of async clients are multiplexed on this loop. Only ever run from one thread at a time.
+        self.loop = asyncio.new_event_loop()
+        self.max_concurrent_requests = max_concurrent_requests
+
+        # Stages only act on tasks leased to this worker, so several daemons can share one database.
+        # A lease must outlive the slowest batch of a stage. Leases of crashed workers are free once expired.
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}"
+        self.lease_duration = lease_duration
+        self.claim_batch_size = claim_batch_size
+        self.scheduler = scheduler or PriorityScheduler()  # Order of uploads and deliveries
+        self.router = router or EndpointRouter()  # Spreads tasks over the inference endpoints of a fingerprint
+        # Requests to inference servers with an open circuit are skipped. Their tasks wait until a probe succeeds.
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+        self.trace = trace  # Records fingerprint matches next to the SCP's associations. Off when None
+        self.catalog_batch_size = catalog_batch_size  # Released associations per catalog write
+
+        self.storage_tiers = storage_tiers  # Moves finished task folders off the fast tier. Off when None
+
+        # Associations the SCP flagged as resends of instances it already has do not create tasks
+        self.skip_duplicate_associations = skip_duplicate_associations
+
+        # Outputs of earlier tasks with identical input and fingerprint version. Hits skip the inference server
+        self.result_cache = result_cache
+
         LOG_FORMAT = ('%(levelname)s:%(asctime)s:%(message)s')
         logging.basicConfig(level=log_level, format=LOG_FORMAT)
         self.logger = logging.getLogger(__name__)
@@ -36,57 +106,370 @@ class Daemon(threading.Thread):
 
     @log
     def kill(self):
-        self.logger.debug(f"Killing daemon")
+        self.logger.debug("Killing daemon")
         self.running = False
 
     @log
-    def tar_dirs(self, tar_path, paths: List):
+    def map_client(self,
+                   method_name: str,
+                   args: List[Tuple],
+                   endpoint: Union[Callable[[Tuple], str], None] = None) -> List:
+        """
+        Calls self.client.<method_name>(*a) for each a in args and returns the responses in order.
+        Async clients get all calls in flight at once, bounded by max_concurrent_requests.
+        Exceptions are logged and returned in place of a response.
+        :param endpoint: inference server url of the call with args a. Outcomes of calls are then recorded in the
+        circuit breaker, and calls to servers with an open circuit return CircuitOpenError without being sent.
+        """
+        method = getattr(self.client, method_name)
+        if asyncio.iscoroutinefunction(method):
+            responses = self.loop.run_until_complete(self.gather_client_calls(method, args, endpoint))
+        else:
+            responses = []
+            for a in args:
+                url = endpoint(a) if endpoint else None
+                if url is not None and not self.circuit_breaker.available(url):
+                    responses.append(CircuitOpenError(url))
+                    continue
+                try:
+                    res = method(*a)
+                except Exception as e:
+                    res = e
+                self.record_health(url, res)
+                responses.append(res)
+
+        skipped = 0
+        for res in responses:
+            if isinstance(res, CircuitOpenError):
+                skipped += 1
+            elif isinstance(res, Exception):
+                self.logger.error("Request %s failed with: %s", method_name, res)
+        if skipped:
+            self.logger.warning("Skipped %s %s requests to inference servers with an open circuit",
+                                skipped, method_name)
+        return responses
+
+    async def gather_client_calls(self, method, args: List[Tuple], endpoint=None) -> List:
+        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+        async def call(a):
+            url = endpoint(a) if endpoint else None
+            async with semaphore:
+                # Checked once a slot is free, so calls queued behind failing ones are not sent to a dead server
+                if url is not None and not self.circuit_breaker.available(url):
+                    return CircuitOpenError(url)
+                try:
+                    res = await method(*a)
+                except Exception as e:
+                    res = e
+                self.record_health(url, res)
+                return res
+
+        return await asyncio.gather(*[call(a) for a in args], return_exceptions=True)
+
+    def record_health(self, url: Union[str, None], res):
+        if url is None:
+            return
+        if server_unavailable(res):
+            self.circuit_breaker.record_failure(url)
+        else:
+            self.circuit_breaker.record_success(url)
+
+    @log
+    def probe_endpoints(self):
+        """
+        Probes inference servers whose circuit has been open for its reset timeout. Reachable ones take tasks again.
+        """
+        urls = self.circuit_breaker.due_probes()
+        if not urls:
+            return
+        responses = self.map_client("probe", [(url,) for url in urls])
+        for url, res in zip(urls, responses):
+            self.record_health(url, res)
+            if self.circuit_breaker.available(url):
+                self.logger.info("Inference server %s is reachable again", url)
+            else:
+                self.logger.warning("Inference server %s is still unavailable", url)
+
+    def claimed_batches(self,
+                        statuses: List[int],
+                        scheduled: bool = False,
+                        batch_size: Union[int, None] = None,
+                        **filters) -> Iterator[List[Task]]:
+        """
+        Claims tasks with a status in statuses in batches of claim_batch_size, in one pass in id order. Tasks left
+        unfinished by a batch are picked up on the next pass. Leases are renewed while the caller works on a batch and
+        released when it is done with it.
+        :param scheduled: claim in the order of self.scheduler instead, and hand out batches in that order
+        :param batch_size: claim this many tasks per batch instead of claim_batch_size
+        :param filters: further filters of DB.claim_tasks
+        """
+        after_id = 0
+        seen = []
+        while True:
+            if scheduled:  # Order is recomputed per batch, so newly arrived urgent tasks go next
+                order = {"order_by": self.scheduler.order_by(datetime.datetime.now()), "exclude_ids": seen}
+            else:
+                order = {"after_id": after_id}
+            tasks = self.db.claim_tasks(owner_id=self.worker_id,
+                                        lease_duration=self.lease_duration,
+                                        limit=batch_size or self.claim_batch_size,
+                                        statuses=statuses,
+                                        **order,
+                                        **filters)
+            if not tasks:
+                return
+            keeper = LeaseKeeper(self.db, self.worker_id, [task.id for task in tasks], self.lease_duration)
+            keeper.start()
+            try:
+                yield tasks
+            finally:
+                keeper.stop()
+                self.db.release_tasks(self.worker_id, [task.id for task in tasks])
+            after_id = tasks[-1].id
+            seen += [task.id for task in tasks]
+
+    @log
+    def tar_dirs(self, tar_path, paths: List, allow_compressed: bool = True):
         with tarfile.TarFile.open(tar_path, mode="w") as tf:
             for path in paths:
-                tf.add(path, arcname=os.path.basename(path))
+                if allow_compressed:
+                    tf.add(path, arcname=os.path.basename(path))
+                else:
+                    self.tar_dir_uncompressed(tf, path)
+
+    def tar_dir_uncompressed(self, tf: tarfile.TarFile, path: str):
+        """
+        Adds path like tf.add, but with files in compressed transfer syntaxes converted to Explicit VR Little Endian.
+        """
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                arcname = os.path.join(os.path.basename(path), os.path.relpath(file_path, path))
+                try:
+                    if is_uncompressed(file_path):
+                        tf.add(file_path, arcname=arcname)
+                        continue
+                    data = to_uncompressed(file_path)
+                except InvalidDicomError:
+                    tf.add(file_path, arcname=arcname)
+                    continue
+                except Exception as e:  # Typically no pixel data handler for the transfer syntax is installed
+                    self.logger.error("Could not decompress %s. Adding it as received: %s", file_path, e)
+                    tf.add(file_path, arcname=arcname)
+                    continue
+
+                info = tarfile.TarInfo(arcname)
+                info.size = len(data)
+                info.mtime = int(os.path.getmtime(file_path))
+                tf.addfile(info, BytesIO(data))
     @log
     def fingerprint(self):
         fps = list(self.db.get_fingerprints())
+        received = []  # Catalogued in one transaction per round
         waiting = True
-        while waiting:
-            try:
-                assoc = self.scp.get_incoming_queue().get(timeout=self.run_interval)
-                self.logger.info(f"Running fingerprinting on assoc_id: {assoc}")
-
-                for fp in fps:
-                    # if fast_fingerprint(assoc=assoc, fp=fp):
-                    matching_series_instances = slow_fingerprint(assoc=assoc, fp=fp)
-                    if matching_series_instances:
-                        task = self.db.add_task(fingerprint_id=fp.id)
-                        self.logger.info(f"Fingerprint match: {task.__dict__}")
-
-                        matching_series_instance_paths = list([os.path.dirname(matching_series_instance.path) for matching_series_instance in
-                                          matching_series_instances])
-
-                        self.logger.info(f"tarping up {matching_series_instance_paths} for task: {task.__dict__}")
-                        self.tar_dirs(tar_path=task.tar_path,
-                                      paths=matching_series_instance_paths)
-                # Escape function if incomings are all fingerprinted
-                if self.scp.get_incoming_queue().empty():
+        try:
+            while waiting:
+                try:
+                    assoc = self.incoming_queue.get(timeout=self.run_interval)
+                    self.logger.info("Running fingerprinting on assoc_id: %s", assoc)
+                    self.match_fingerprints(assoc, fps, trace=True)
+                    received.append(assoc)
+                    if len(received) >= self.catalog_batch_size:
+                        self.catalog_received(received)
+                        received = []
+                    # Escape function if incomings are all fingerprinted
+                    if self.incoming_queue.empty():
+                        waiting = False
+
+                # Escape if nothing has arrived in a while.
+                except queue.Empty:
                     waiting = False
+        finally:
+            self.catalog_received(received)
+
+    def catalog_received(self, received: List[Assoc]):
+        """
+        Catalogues fingerprinted associations and only then marks them done on the incoming queue. A SpoolQueue
+        hands associations of a worker which died before this to another worker.
+        """
+        self.db.add_catalog_series(received)
+        for _ in received:
+            self.incoming_queue.task_done()
+
+    def match_fingerprints(self, assoc: Assoc, fps: List, trace: bool = False) -> List[Task]:
+        """
+        Creates a task, with its input tarred up, for every fingerprint in fps matching assoc.
+        :param trace: record matches in the ingest trace, if there is one
+        :return: the created tasks
+        """
+        if assoc.duplicate:
+            self.logger.info("Association %s only holds instances received before", assoc.assoc_id)
+            if self.skip_duplicate_associations:
+                return []
+
+        tasks = []
+        for fp in fps:
+            # if fast_fingerprint(assoc=assoc, fp=fp):
+            matching_series_instances = slow_fingerprint(assoc=assoc, fp=fp)
+            if not matching_series_instances:
+                continue
+            if trace and self.trace is not None:
+                self.trace.match(assoc, fp, matching_series_instances)
+            # Leased to this worker until its input is written, so no other worker posts it before
+            task = self.db.add_task(fingerprint_id=fp.id, owner_id=self.worker_id, lease_duration=self.lease_duration)
+            tasks.append(task)
+            self.logger.info("Fingerprint match: task %s of fingerprint %s", task.id, fp.id)
+
+            matching_series_instance_paths = list([os.path.dirname(matching_series_instance.path) for matching_series_instance in
+                              matching_series_instances])
+            keeper = LeaseKeeper(self.db, self.worker_id, [task.id], self.lease_duration)
+            keeper.start()
+            try:
+                if self.fetch_cached_result(task, fp, matching_series_instance_paths):
+                    continue
+
+                self.logger.info("tarping up %s for task: %s", matching_series_instance_paths, task.id)
+                self.tar_dirs(tar_path=task.tar_path,
+                              paths=matching_series_instance_paths,
+                              allow_compressed=fp.allow_compressed)
+            except Exception as e:
+                self.logger.error("Could not write the input of task %s: %s", task.id, e)
+                self.db.update_task(task_id=task.id, status=-1)  # Tag for deletion
+            finally:
+                keeper.stop()
+                self.db.release_tasks(self.worker_id, [task.id])
+        return tasks
+
+    @log
+    def refingerprint(self):
+        """
+        Runs requested fingerprints against series in the catalog, e.g. after a fingerprint was changed or added,
+        so stored data need not be sent again. Series whose files were cleaned up are skipped.
+        """
+        request = self.db.claim_refingerprint_request(owner_id=self.worker_id)
+        while request is not None:
+            fp = self.db.get_fingerprint(request.fingerprint_id)
+            task_count = 0
+            try:
+                if fp is None:
+                    self.logger.error("Re-fingerprinting request %s: no fingerprint with id %s",
+                                      request.id, request.fingerprint_id)
+                else:
+                    for assoc in catalog_associations(self.db.iter_catalog_series(since=request.since,
+                                                                                  until=request.until)):
+                        task_count += len(self.match_fingerprints(assoc, [fp]))
+                    self.logger.info("Re-fingerprinting request %s created %s tasks", request.id, task_count)
+            except Exception as e:
+                self.logger.error("Re-fingerprinting request %s failed after %s tasks: %s", request.id, task_count, e)
+            finally:
+                self.db.finish_refingerprint_request(request.id, task_count)
+            request = self.db.claim_refingerprint_request(owner_id=self.worker_id)
 
-            # Escape if nothing has arrived in a while.
-            except queue.Empty:
-                waiting = False
+    @log
+    def fetch_cached_result(self, task: Task, fp, paths: List[str]) -> bool:
+        """
+        On a result cache hit the task gets the cached output and is ready for delivery (2) right away.
+        :return: True on a hit
+        """
+        if self.result_cache is None:
+            return False
+        cache_key = content_key(fp.human_readable_id, fp.version, paths)
+        if self.result_cache.fetch(cache_key, task.inference_server_tar):
+            self.logger.info("Result cache hit for task %s. Skipping inference", task.id)
+            self.db.update_tasks({task.id: {"cache_key": cache_key, "status": 2}})
+            return True
+        self.db.update_tasks({task.id: {"cache_key": cache_key}})
+        task.cache_key = cache_key
+        return False
 
     @log
     def post_tasks(self):
-        tasks = list(self.db.get_tasks_by_kwargs({"status": 0}))
-        for task in tasks:
-            # Post to inference_server
-            res = self.client.post_task(task)
-            self.logger.debug(res)
-            if res.ok:
-                res_task = json.loads(res.content)
-                print(res_task)
-                self.db.update_task(task_id=task.id, status=1, inference_server_uid=res_task["uid"])
-            else:
-                self.db.update_task(task_id=task.id, status=-1)  # Tag for deletion
+        for tasks in self.claimed_batches([0], scheduled=True, batching=False):
+            self.post_task_batch(tasks)
+
+        # Tasks of batching fingerprints are claimed per fingerprint, in whole batches, so no batch is split over two
+        # claimed pages. They go after the tasks of other fingerprints in a round.
+        for fp in self.db.get_fingerprints().filter(Fingerprint.batch_window > 0):
+            size = max(fp.max_batch_size or 1, 1)
+            for tasks in self.claimed_batches([0],
+                                              scheduled=True,
+                                              batch_size=max(self.claim_batch_size // size, 1) * size,
+                                              fingerprint_id=fp.id):
+                self.post_task_batch(tasks)
+
+    @log
+    def post_task_batch(self, tasks: List[Task]):
+        """
+        Posts tasks to an endpoint of their fingerprint's pool, alone or packed in batches (see daemon.batching).
+        Batches are only formed within the given tasks, so post_tasks claims those of a batching fingerprint together.
+        Endpoints with an open circuit are passed over. Uploads whose endpoint is unavailable (exception, 502, 503
+        or 504) are posted to the next best endpoint in the following round. Other errors, such as a 500 for a
+        task the server can not handle, fail the upload. Tasks no endpoint is available for stay queued, until
+        they time out.
+        """
+        uploads, held = group_batches(tasks, datetime.datetime.now())
+        if held:
+            self.logger.info("Holding %s tasks back for their batching window", len(held))
+
+        outstanding = self.db.count_outstanding_tasks()
+        failed_urls = [set() for _ in uploads]
+        pending = list(range(len(uploads)))
+        with tempfile.TemporaryDirectory(dir=self.db.data_dir) as batch_dir:
+            tar_paths = {}  # Dict[upload index: packed batch]
+            while pending:
+                routed = []
+                unavailable = self.circuit_breaker.open_urls()
+                for i in pending:
+                    url = self.router.route(uploads[i][0].fingerprint,
+                                            outstanding,
+                                            exclude=failed_urls[i] | unavailable)
+                    if url is not None:
+                        routed.append((i, url))
+                        continue
+                    for task in uploads[i]:
+                        if self.is_retirement_ready(task.timestamp):
+                            self.logger.error("Task %s timed out waiting for an inference server", task.id)
+                            self.db.update_task(task_id=task.id, status=-1)  # Tag for deletion
+                        else:
+                            self.logger.info("No inference server available for task %s. Keeping it queued", task.id)
+
+                args = []
+                for i, url in routed:
+                    if len(uploads[i]) > 1 and i not in tar_paths:
+                        tar_paths[i] = os.path.join(batch_dir, f"{i}.tar")
+                        pack_batch(tar_paths[i], uploads[i])
+                    args.append((uploads[i][0], url, tar_paths.get(i)))
+
+                # Post to inference_server
+                responses = self.map_client("post_task", args, endpoint=lambda a: a[1])
+                pending = []
+                for (i, url), res in zip(routed, responses):
+                    self.logger.debug(res)
+                    upload = uploads[i]
+                    if response_ok(res):
+                        res_task = json.loads(res.content)
+                        posted_at = datetime.datetime.now()
+                        next_poll = self.poll_schedule.first_poll(posted_at,
+                                                                  upload[0].fingerprint.average_inference_duration)
+                        self.db.update_tasks({task.id: {"status": 1,
+                                                        "inference_server_uid": res_task["uid"],
+                                                        "inference_server_url": url,
+                                                        "batch_size": len(upload),
+                                                        "posted_at": posted_at,
+                                                        "next_poll": next_poll} for task in upload})
+                        continue
+
+                    outstanding[url] -= 1
+                    if server_unavailable(res):
+                        if not isinstance(res, CircuitOpenError):
+                            self.logger.warning("Posting tasks %s to %s failed. Failing over",
+                                                [task.id for task in upload], url)
+                        failed_urls[i].add(url)
+                        pending.append(i)
+                    else:  # Rejected. Tag for deletion
+                        self.db.update_tasks({task.id: {"status": -1} for task in upload})
 
     @log
     def is_retirement_ready(self, timestamp: datetime.datetime):
@@ -94,96 +477,287 @@ class Daemon(threading.Thread):
 
     @log
     def retire_tasks(self):
-        tasks = list(self.db.get_tasks())
-        for task in tasks:
-            if task.status not in [10, 11, -1]:
-                if self.is_retirement_ready(task.timestamp):
-                    self.logger.info(f"Retiring task: {task.__dict__}")
-                    self.db.update_task(task_id=task.id,
-                                        status=-1)
+        retired = self.db.retire_tasks(before=datetime.datetime.now() - self.timeout, final_statuses=[10, 11, -1])
+        if retired:
+            self.logger.info("Retired %s tasks", retired)
 
 
     @log
     def get_tasks(self):
-        tasks = list(self.db.get_tasks_by_kwargs({"status": 1}))
+        for tasks in self.claimed_batches([1], due_at=datetime.datetime.now()):
+            self.poll_tasks(tasks)
+
+    @log
+    def poll_tasks(self, tasks: List[Task]):
+        groups = self.group_by_inference_server(tasks)
+        responses = self.map_client("get_task_statuses",
+                                    [(inference_server_url, [task.inference_server_uid for task in server_tasks])
+                                     for inference_server_url, server_tasks in groups.items()],
+                                    endpoint=lambda a: a[0])
+
+        finished_tasks = []
+        for (inference_server_url, server_tasks), res in zip(groups.items(), responses):
+            if server_unavailable(res):  # Poll again next round rather than one by one
+                continue
+            statuses = self.parse_task_statuses(inference_server_url, res)
+            if statuses is None:  # Inference server does not support batched polling. Poll one by one.
+                finished_tasks += server_tasks
+                continue
+
+            # Only download outputs of tasks which are reported finished
+            for task in server_tasks:
+                status_code = statuses.get(task.inference_server_uid)
+                if status_code == 200:
+                    finished_tasks.append(task)
+                else:
+                    self.handle_task_status(task, status_code)
+
+        self.get_outputs(finished_tasks)
+
+    @log
+    def group_by_inference_server(self, tasks: List[Task]) -> Dict[str, List[Task]]:
+        groups = {}
         for task in tasks:
-            print(task.inference_server_uid)
-            res = self.client.get_task(task)
-
-            if res.ok:
-                self.logger.info(f"Task: {task.inference_server_uid} was retrieved successfully")
-                with open(task.inference_server_tar, "bw") as f:
-                    f.write(res.content)
-                self.db.update_task(task_id=task.id, status=2)  # Ready to post to destinations
-
-            elif res.status_code in [551, 554]:
-                self.logger.info(
-                    f"Task: {task.inference_server_uid}, seems to be on the way, but not finished yet")
-
-            elif res.status_code in [405, 500, 552, 553]:
-                self.logger.error(
-                    f"Task: {task.inference_server_uid}, has failed with status code {res.status_code}")
-                self.db.update_task(task.id, status=3)
-            else:
-                self.logger.info(
-                    f"This status code should not be possible for Task: {task.inference_server_uid}. Go talk to an admin")
+            groups.setdefault(task_url(task), []).append(task)
+        return groups
+
+    @log
+    def parse_task_statuses(self, inference_server_url: str, res) -> Union[Dict[str, int], None]:
+        if isinstance(res, Exception):
+            return None
+
+        if not response_ok(res):
+            self.logger.info("Batched polling not available on %s (status code %s)",
+                             inference_server_url, res.status_code)
+            return None
+        return json.loads(res.content)
+
+    @log
+    def get_outputs(self, tasks: List[Task]):
+        # Tasks uploaded in one batch share their uid. Their output is downloaded once and split.
+        by_uid: Dict[str, List[Task]] = {}
+        for task in tasks:
+            by_uid.setdefault(task.inference_server_uid, []).append(task)
+        downloads = [uid_tasks[0] for uid_tasks in by_uid.values()]
+
+        responses = self.map_client("get_task", [(task,) for task in downloads], endpoint=lambda a: task_url(a[0]))
+        for download, res in zip(downloads, responses):
+            if isinstance(res, Exception):  # Try again next round
+                continue
+
+            for task in by_uid[download.inference_server_uid]:
+                if response_ok(res):
+                    try:
+                        self.store_output(task, res.content)
+                    except (tarfile.TarError, ValueError) as e:
+                        self.logger.error("Task: %s has no usable output: %s", task.id, e)
+                        self.db.update_task(task_id=task.id, status=3)
+                        continue
+                    self.logger.info("Task: %s was retrieved successfully", task.inference_server_uid)
+                    self.db.update_task(task_id=task.id, status=2)  # Ready to post to destinations
+                    self.update_inference_duration(task)
+                else:
+                    self.handle_task_status(task, res.status_code)
+
+    def store_output(self, task: Task, content: bytes):
+        """
+        :raises tarfile.TarError, ValueError: if a batch output is not a tar or holds nothing for task
+        """
+        if task.batch_size > 1:
+            split_batch(BytesIO(content), task, task.inference_server_tar)
+        else:
+            with open(task.inference_server_tar, "bw") as f:
+                f.write(content)
+        if self.result_cache is not None and task.cache_key:
+            self.result_cache.put(task.cache_key, task.inference_server_tar)
+
+    @log
+    def handle_task_status(self, task: Task, status_code: Union[int, None]):
+        if status_code in [551, 554]:
+            poll_count = task.poll_count + 1
+            next_poll = self.poll_schedule.next_poll(now=datetime.datetime.now(),
+                                                     posted_at=task.posted_at,
+                                                     poll_count=poll_count,
+                                                     expected_duration=task.fingerprint.average_inference_duration)
+            self.logger.info("Task: %s, seems to be on the way, but not finished yet. Polling again at %s",
+                             task.inference_server_uid, next_poll)
+            self.db.update_task(task.id, next_poll=next_poll, poll_count=poll_count)
+
+        elif status_code in [405, 500, 552, 553]:
+            self.logger.error("Task: %s, has failed with status code %s", task.inference_server_uid, status_code)
+            self.db.update_task(task.id, status=3)
+        else:
+            self.logger.info("This status code should not be possible for Task: %s. Go talk to an admin",
+                             task.inference_server_uid)
+
+    @log
+    def update_inference_duration(self, task: Task):
+        if task.posted_at is None:
+            return
+        duration = (datetime.datetime.now() - task.posted_at).total_seconds()
+        self.router.observe(task_url(task), duration)
+        fp = self.db.get_fingerprint(task.fingerprint_id)
+        self.db.update_fingerprint(fp.id,
+                                   average_inference_duration=self.poll_schedule.update_average(
+                                       fp.average_inference_duration, duration))
 
     @log
     def post_to_final_destinations(self):
-        tasks = list(self.db.get_tasks_by_kwargs({"status": 2}))
+        for tasks in self.claimed_batches([2], scheduled=True):
+            self.post_batch_to_final_destinations(tasks)
+
+    @log
+    def post_batch_to_final_destinations(self, tasks: List[Task]):
         for task in tasks:
-            self.logger.info(f"Posting task {task.__dict__} to final destination")
+            self.logger.info("Posting task %s to final destination", task.id)
             with tempfile.TemporaryDirectory() as tmp_dir:
                 shutil.unpack_archive(task.inference_server_tar, extract_dir=tmp_dir)
                 if len(task.fingerprint.destinations) == 0:
                     self.db.update_task(task.id, status=3)
                 else:
                     for destination in task.fingerprint.destinations:
-                        post_folder_to_dicom_node(scu_ip=destination.scu_ip,
-                                                  scu_port=destination.scu_port,
-                                                  scu_ae_title=destination.scu_ae_title,
-                                                  dicom_dir=tmp_dir)
+                        if not post_folder_to_dicom_node(scu_ip=destination.scu_ip,
+                                                         scu_port=destination.scu_port,
+                                                         scu_ae_title=destination.scu_ae_title,
+                                                         dicom_dir=tmp_dir):
+                            self.logger.error("Task %s was not fully delivered to %s on %s:%s", task.id,
+                                              destination.scu_ae_title, destination.scu_ip, destination.scu_port)
                         self.db.update_task(task.id, status=3)
 
     @log
     def clean_up(self):
         # Succesful tasks
-        tasks = list(self.db.get_tasks_by_kwargs({"status": 3}))
-        self.delete_files(tasks, 10)  # Final success status
+        for tasks in self.claimed_batches([3]):
+            self.delete_files(tasks, 10)  # Final success status
 
-        tasks = list(self.db.get_tasks_by_kwargs({"status": -1}))
-        self.delete_files(tasks, 11)  # Final status for failed tasks
+        for tasks in self.claimed_batches([-1]):
+            self.delete_files(tasks, 11)  # Final status for failed tasks
 
     @log
     def delete_files(self, tasks: List[Task], final_task_status: int):
+        updates = {}  # Dict[task_id: Dict[column: value]]. Written in one transaction.
+        remote_tasks = []
         for task in tasks:
-            self.logger.info(f"Running deletion for {task.__dict__}")
+            self.logger.info("Running deletion for task %s (status %s, uid %s)", task.id, task.status,
+                             task.inference_server_uid)
+            updates[task.id] = {}
             # For local files
             if task.fingerprint.delete_locally and not task.deleted_local:  # Delete if fingerprint dictates to do so
                 if os.path.isfile(task.tar_path):
-                    self.logger.info(f"Deleting {task.tar_path}")
+                    self.logger.info("Deleting %s", task.tar_path)
                     os.remove(task.tar_path)
                 if os.path.isfile(task.inference_server_tar):
-                    self.logger.info(f"Deleting {task.inference_server_tar}")
+                    self.logger.info("Deleting %s", task.inference_server_tar)
                     os.remove(task.inference_server_tar)
-                self.db.update_task(task.id, deleted_local=True)
+                updates[task.id]["deleted_local"] = True
 
-            # For remote files (on inference server)
+            # For remote files (on inference server). Tasks which never made it there have nothing to delete.
             if task.fingerprint.delete_remotely and not task.deleted_remote:
-                self.logger.info(f"Deleting remotely: {task.inference_server_uid}")
-                self.client.delete_task(task)
-                self.db.update_task(task.id, deleted_remote=True)
+                if task.inference_server_uid:
+                    remote_tasks.append(task)
+                else:
+                    updates[task.id]["deleted_remote"] = True
+
+        # Members of a batch share their uid. It is deleted once, by the last member to be cleaned up.
+        in_use = self.db.inference_server_uids_in_use([task.inference_server_uid for task in remote_tasks],
+                                                      exclude_ids=[task.id for task in tasks])
+        by_uid: Dict[str, List[Task]] = {}
+        for task in remote_tasks:
+            if task.inference_server_uid in in_use:
+                self.logger.info("Leaving %s on the inference server for other tasks of its batch",
+                                 task.inference_server_uid)
+                updates[task.id]["deleted_remote"] = True
+            else:
+                by_uid.setdefault(task.inference_server_uid, []).append(task)
+
+        deletes = [uid_tasks[0] for uid_tasks in by_uid.values()]
+        failed_delete_ids = self.delete_remote(deletes)
+        failed_uids = set(task.inference_server_uid for task in deletes if task.id in failed_delete_ids)
+        failed_ids = set()
+        for uid, uid_tasks in by_uid.items():
+            for task in uid_tasks:
+                if uid in failed_uids:
+                    self.logger.error("Could not delete remotely: %s", uid)
+                    failed_ids.add(task.id)
+                else:
+                    updates[task.id]["deleted_remote"] = True
 
+        for task in tasks:
+            # Failed remote deletes keep their status, so they are tried again on next clean up. Until retirement.
+            if task.id in failed_ids and not self.is_retirement_ready(task.timestamp):
+                continue
             # Update status to final_task_status. This indicates that task deletion has been considered
-            self.logger.info(f"Updating {task.__dict__} to status {final_task_status}")
-            self.db.update_task(task.id, status=final_task_status)
+            updates[task.id]["status"] = final_task_status
+
+        self.logger.info("Updating %s tasks after deletion: %s", len(updates), updates)
+        self.db.update_tasks(updates)
+
+    @log
+    def delete_remote(self, tasks: List[Task]) -> set:
+        """
+        Deletes tasks on their inference servers. Deletes go out concurrently. Failed ones are not retried here, so
+        the daemon thread never waits on a backoff. Their tasks keep their status and are retried by the next clean up.
+        :return: ids of tasks which could not be deleted
+        """
+        for inference_server_url, server_tasks in self.group_by_inference_server(tasks).items():
+            self.logger.info("Deleting %s tasks remotely on %s", len(server_tasks), inference_server_url)
+
+        responses = self.map_client("delete_task", [(task,) for task in tasks], endpoint=lambda a: task_url(a[0]))
+        # 404 means it is already gone
+        return set([task.id for task, res in zip(tasks, responses)
+                    if not (response_ok(res) or getattr(res, "status_code", None) == 404)])
+
+    @log
+    def migrate_storage(self):
+        """
+        Moves folders of finished tasks to the bulk tier. Oldest first while the fast tier is above its high
+        watermark, and any which are past max_age.
+        """
+        if self.storage_tiers is None:
+            return
+        started = datetime.datetime.now()
+        draining = self.storage_tiers.above_high_watermark()
+        if not draining:
+            self.storage_tiers.stalled_at = None
+        created_before = None if draining else self.storage_tiers.expired_before(started)
+        if not draining and created_before is None:
+            return
+
+        # A stalled drain moved every task which was final by then, i.e. all created more than the retirement timeout
+        # before it. Only younger ones can have finished since, so the rest of the history is not walked again.
+        stalled_at = self.storage_tiers.stalled_at if draining else None
+        created_after = None if stalled_at is None else stalled_at - self.timeout
+        for tasks in self.claimed_batches([10, 11], in_dir=self.db.data_dir, created_before=created_before,
+                                          created_after=created_after):
+            updates = {}
+            for task in tasks:
+                if draining and self.storage_tiers.below_low_watermark():
+                    draining = False
+                    created_before = self.storage_tiers.expired_before(datetime.datetime.now())
+                if draining or (created_before is not None and task.timestamp < created_before):
+                    self.logger.info("Moving files of task %s to bulk storage", task.id)
+                    updates[task.id] = self.storage_tiers.migrate(task.tar_path, task.inference_server_tar)
+            self.db.update_tasks(updates)
+            if not draining and created_before is None:
+                break
 
+        if draining:
+            if stalled_at is None:
+                self.logger.warning("Fast storage is still at %.2f usage with no finished task folders left to move. "
+                                    "The rest is not task data, e.g. received series, and is never moved",
+                                    self.storage_tiers.fast_tier_usage())
+            self.storage_tiers.stalled_at = started
+        else:
+            self.storage_tiers.stalled_at = None
 
     def run(self):
         while self.running:
             self.retire_tasks()
             self.fingerprint()
+            self.refingerprint()
+            self.probe_endpoints()
             self.post_tasks()
             self.get_tasks()
             self.post_to_final_destinations()
-            self.clean_up()
\ No newline at end of file
+            self.clean_up()
+            self.migrate_storage()
\ No newline at end of file
@@ -1,5 +1,13 @@
-from database.models import Fingerprint
-from dicom_networking.scp import Assoc
+import logging
+from typing import Set, Tuple
+
+from database.patterns import search
+from database.models import Fingerprint, Trigger
+from dicom_networking.scp import Assoc, SeriesInstance
+
+# Triggers with a pattern that does not compile, as (id, patterns, ignore_case). Each is only logged the first time
+# it is skipped, instead of for every series it is evaluated against.
+_skipped_triggers: Set[Tuple] = set()
 
 def fast_fingerprint(fp: Fingerprint, assoc: Assoc):
     """
@@ -24,18 +32,45 @@ def slow_fingerprint(fp: Fingerprint, assoc: Assoc):
     series_instances = [series_instance for _, series_instance in assoc.series_instances.items()]
     for trigger in triggers:
         for series_instance in series_instances:
-            # Check all "in-patterns"
-            if (trigger.sop_class_uid_exact is None or trigger.sop_class_uid_exact == series_instance.sop_class_uid) and \
-               (trigger.series_description_pattern is None or trigger.series_description_pattern in series_instance.series_instance_uid) and \
-               (trigger.study_description_pattern is None or trigger.study_description_pattern in series_instance.study_description):
-                # Check all "out-patterns"
-                if trigger.exclude_pattern is None or \
-                    (series_instance.sop_class_uid is None or trigger.exclude_pattern not in series_instance.sop_class_uid) and \
-                    (series_instance.series_instance_uid is None or trigger.exclude_pattern not in series_instance.series_instance_uid) and \
-                    (series_instance.study_description is None or trigger.exclude_pattern not in series_instance.study_description):
-                    matching_series_instances.append(series_instance)
-                    break
+            if trigger_matches(trigger, series_instance):
+                matching_series_instances.append(series_instance)
+                break
         else:
             return None
 
-    return matching_series_instances
\ No newline at end of file
+    return matching_series_instances
+
+
+def trigger_matches(trigger: Trigger, series_instance: SeriesInstance) -> bool:
+    """
+    Patterns are regular expressions searched anywhere in the text. Case-insensitive if trigger.ignore_case.
+    Triggers with a pattern that does not compile never match.
+    """
+    try:
+        return _trigger_matches(trigger, series_instance)
+    except ValueError as e:
+        key = (trigger.id, trigger.study_description_pattern, trigger.series_description_pattern,
+               trigger.exclude_pattern, trigger.ignore_case)
+        if key not in _skipped_triggers:
+            _skipped_triggers.add(key)
+            logging.getLogger(__name__).error("Skipping trigger %s: %s", trigger.id, e)
+        return False
+
+
+def _trigger_matches(trigger: Trigger, series_instance: SeriesInstance) -> bool:
+    # Check all "in-patterns"
+    if not ((trigger.sop_class_uid_exact is None or trigger.sop_class_uid_exact == series_instance.sop_class_uid) and
+            search(trigger.series_description_pattern, series_instance.series_description, trigger.ignore_case) and
+            search(trigger.study_description_pattern, series_instance.study_description, trigger.ignore_case)):
+        return False
+
+    # Check all "out-patterns"
+    if trigger.exclude_pattern is None:
+        return True
+    for text in [series_instance.sop_class_uid,
+                 series_instance.series_instance_uid,
+                 series_instance.study_description,
+                 series_instance.series_description]:
+        if text is not None and search(trigger.exclude_pattern, text, trigger.ignore_case):
+            return False
+    return True
@@ -4,6 +4,7 @@ import shutil
 import tempfile
 import unittest
 
+from daemon.fingerprinting import fingerprint
 from daemon.fingerprinting.fingerprint import fast_fingerprint, slow_fingerprint
 from database.db import DB
 from dicom_networking.scp import Assoc, SeriesInstance
@@ -75,6 +76,60 @@ class TestFingerprint(unittest.TestCase):
         matches = slow_fingerprint(fp=fp, assoc=self.assoc)
         self.assertIsNone(matches)
 
+    def test_slow_fingerprint_series_description(self):
+        fp = self.get_fingerprint()
+        self.db.add_trigger(fingerprint_id=fp.id, series_description_pattern="anoter")
+        fp = self.db.get_fingerprint(fp.id)
+        matches = slow_fingerprint(fp=fp, assoc=self.assoc)
+        self.assertEqual([self.series_instance2], matches)
+
+    def test_slow_fingerprint_regex(self):
+        fp = self.get_fingerprint()
+        self.db.add_trigger(fingerprint_id=fp.id, study_description_pattern="^Interesting")
+        self.db.add_trigger(fingerprint_id=fp.id, series_description_pattern="What an?o.*series$")
+        fp = self.db.get_fingerprint(fp.id)
+        matches = slow_fingerprint(fp=fp, assoc=self.assoc)
+        self.assertEqual([self.series_instance1, self.series_instance2], matches)
+
+        fp = self.get_fingerprint()
+        self.db.add_trigger(fingerprint_id=fp.id, study_description_pattern="^Study")
+        fp = self.db.get_fingerprint(fp.id)
+        self.assertIsNone(slow_fingerprint(fp=fp, assoc=self.assoc))
+
+    def test_slow_fingerprint_ignore_case(self):
+        fp = self.get_fingerprint()
+        self.db.add_trigger(fingerprint_id=fp.id, series_description_pattern="WHAT A SERIES")
+        fp = self.db.get_fingerprint(fp.id)
+        self.assertIsNone(slow_fingerprint(fp=fp, assoc=self.assoc))
+
+        fp = self.get_fingerprint()
+        self.db.add_trigger(fingerprint_id=fp.id, series_description_pattern="WHAT A SERIES", ignore_case=True)
+        fp = self.db.get_fingerprint(fp.id)
+        self.assertEqual([self.series_instance1], slow_fingerprint(fp=fp, assoc=self.assoc))
+
+    def test_slow_fingerprint_exclude_series_description(self):
+        fp = self.get_fingerprint()
+        self.db.add_trigger(fingerprint_id=fp.id, sop_class_uid_exact="1.2.3", exclude_pattern="a series")
+        fp = self.db.get_fingerprint(fp.id)
+        self.assertIsNone(slow_fingerprint(fp=fp, assoc=self.assoc))
+
+    def test_slow_fingerprint_invalid_pattern(self):
+        # Stored before patterns were validated. The trigger is skipped rather than stopping fingerprinting
+        fp = self.get_fingerprint()
+        self.db.add_trigger(fingerprint_id=fp.id, sop_class_uid_exact="1.2.3")
+        fp = self.db.get_fingerprint(fp.id)
+        fp.triggers[0].study_description_pattern = "("
+        fingerprint._skipped_triggers.clear()
+        with self.assertLogs("daemon.fingerprinting.fingerprint") as logs:
+            for _ in range(3):
+                self.assertIsNone(slow_fingerprint(fp=fp, assoc=self.assoc))
+        self.assertEqual(1, len(logs.records))  # Not once per evaluation
+
+    def test_add_trigger_rejects_invalid_pattern(self):
+        fp = self.get_fingerprint()
+        self.assertRaises(ValueError, self.db.add_trigger, fingerprint_id=fp.id, series_description_pattern="(")
+        self.assertEqual([], self.db.get_fingerprint(fp.id).triggers)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,102 @@
+import threading
+import time
+from typing import Callable, Dict, List
+
+CLOSED = "closed"  # Healthy. Requests go through
+OPEN = "open"  # Unhealthy. Requests are skipped until a probe succeeds
+PROBING = "probing"  # Open and a probe is on its way
+
+# Inference servers use 500 and 55x for the state of single tasks, so only these speak of the server itself
+UNAVAILABLE_STATUS_CODES = [502, 503, 504]
+
+
+def server_unavailable(res) -> bool:
+    """
+    :param res: requests or httpx response, or the exception raised in its place
+    """
+    return isinstance(res, Exception) or res.status_code in UNAVAILABLE_STATUS_CODES
+
+
+class CircuitOpenError(Exception):
+    """
+    Returned by Daemon.map_client in place of a response for requests that were not sent, because the circuit of
+    their inference server is open.
+    """
+
+
+class _Endpoint:
+    __slots__ = ("state", "failures", "opened_at", "reset_timeout")
+
+    def __init__(self, reset_timeout: float):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.reset_timeout = reset_timeout
+
+
+class CircuitBreaker:
+    """
+    Health of inference servers, keyed on url.
+    Passive: failure_threshold consecutive failed requests (exceptions, 502, 503 or 504) open the circuit of a
+    server, so no more requests are spent on it. Any successful request resets the count.
+    Active: reset_timeout seconds after opening, the server is due for a probe. A successful probe closes the
+    circuit, a failed one keeps it open and doubles the time to the next probe, up to max_reset_timeout.
+    """
+    def __init__(self,
+                 failure_threshold: int = 3,
+                 reset_timeout: float = 30,
+                 max_reset_timeout: float = 600,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.clock = clock
+        self.endpoints: Dict[str, _Endpoint] = {}
+        self.lock = threading.Lock()
+
+    def _endpoint(self, url: str) -> _Endpoint:
+        endpoint = self.endpoints.get(url)
+        if endpoint is None:
+            endpoint = self.endpoints[url] = _Endpoint(self.reset_timeout)
+        return endpoint
+
+    def state(self, url: str) -> str:
+        endpoint = self.endpoints.get(url)
+        return CLOSED if endpoint is None else endpoint.state
+
+    def available(self, url: str) -> bool:
+        return self.state(url) == CLOSED
+
+    def open_urls(self) -> set:
+        return set([url for url, endpoint in self.endpoints.items() if endpoint.state != CLOSED])
+
+    def record_success(self, url: str):
+        with self.lock:
+            endpoint = self._endpoint(url)
+            endpoint.state = CLOSED
+            endpoint.failures = 0
+            endpoint.reset_timeout = self.reset_timeout
+
+    def record_failure(self, url: str):
+        with self.lock:
+            endpoint = self._endpoint(url)
+            endpoint.failures += 1
+            if endpoint.state == PROBING:
+                endpoint.reset_timeout = min(endpoint.reset_timeout * 2, self.max_reset_timeout)
+            if endpoint.state != CLOSED or endpoint.failures >= self.failure_threshold:
+                endpoint.state = OPEN
+                endpoint.opened_at = self.clock()
+
+    def due_probes(self) -> List[str]:
+        """
+        :return: urls of open circuits whose reset_timeout has passed. They count as probing until the outcome of
+        the probe is recorded.
+        """
+        now = self.clock()
+        due = []
+        with self.lock:
+            for url, endpoint in self.endpoints.items():
+                if endpoint.state == OPEN and now - endpoint.opened_at >= endpoint.reset_timeout:
+                    endpoint.state = PROBING
+                    due.append(url)
+        return due
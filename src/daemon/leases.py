@@ -0,0 +1,40 @@
+import logging
+import threading
+from typing import List, Union
+
+
+class LeaseKeeper(threading.Thread):
+    """
+    Renews the leases of a claimed batch every interval seconds (a third of the lease by default) until stopped,
+    so a batch that takes longer than lease_duration, e.g. a slow upload, is not claimed by another worker while it
+    is still being worked on. Leases of a crashed worker still expire, as the keeper dies with it.
+    """
+    def __init__(self,
+                 db,
+                 owner_id: str,
+                 task_ids: List[int],
+                 lease_duration: float,
+                 interval: Union[float, None] = None):
+        super().__init__(daemon=True)
+        self.db = db
+        self.owner_id = owner_id
+        self.task_ids = task_ids
+        self.lease_duration = lease_duration
+        self.interval = interval if interval is not None else lease_duration / 3
+        self.stopped = threading.Event()
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                renewed = self.db.renew_leases(self.owner_id, self.task_ids, self.lease_duration)
+            except Exception as e:
+                self.logger.error("Could not renew leases of %s tasks: %s", len(self.task_ids), e)
+                continue
+            if renewed < len(self.task_ids):
+                self.logger.warning("Lost the leases of %s of %s tasks", len(self.task_ids) - renewed,
+                                    len(self.task_ids))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
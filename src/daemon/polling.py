@@ -0,0 +1,55 @@
+import datetime
+import random
+from typing import Union
+
+
+class PollSchedule:
+    """
+    Decides when a task on an inference server should be polled next.
+    Pending tasks are polled near their expected completion time (moving average of earlier inference durations
+    of the same fingerprint). Past that point, or without any history, polling backs off exponentially with jitter.
+    """
+    def __init__(self,
+                 base_interval: float = 10,
+                 max_interval: float = 600,
+                 jitter: float = 0.1,
+                 smoothing: float = 0.2,
+                 initial_delay: float = 0):
+        self.base_interval = base_interval
+        self.initial_delay = initial_delay  # Delay of first poll without history. Raise it when results are pushed.
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.smoothing = smoothing  # Weight of the newest duration in the moving average
+
+    def first_poll(self,
+                   posted_at: datetime.datetime,
+                   expected_duration: Union[float, None] = None) -> datetime.datetime:
+        # Without history, poll after initial_delay. Right away by default like a fixed interval poller would.
+        delay = expected_duration or self.initial_delay
+        return posted_at + datetime.timedelta(seconds=min(delay, self.max_interval))
+
+    def next_poll(self,
+                  now: datetime.datetime,
+                  posted_at: datetime.datetime,
+                  poll_count: int,
+                  expected_duration: Union[float, None] = None) -> datetime.datetime:
+        """
+        :param poll_count: number of times the task has been reported pending so far (>= 1)
+        """
+        remaining = None
+        if expected_duration and posted_at:
+            remaining = (posted_at + datetime.timedelta(seconds=expected_duration) - now).total_seconds()
+
+        if remaining is not None and remaining > self.base_interval:
+            delay = remaining  # Not expected to be done yet. Wait for it.
+        else:
+            delay = self.base_interval * 2 ** max(poll_count - 1, 0)
+
+        delay = min(delay, self.max_interval)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return now + datetime.timedelta(seconds=delay)
+
+    def update_average(self, average: Union[float, None], duration: float) -> float:
+        if average is None:
+            return duration
+        return (1 - self.smoothing) * average + self.smoothing * duration
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import shutil
+import time
+from typing import List, Union
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def content_key(human_readable_id: str, version: str, paths: List[str]) -> str:
+    """
+    Hash of the fingerprint identity and every file below paths, as they would be laid out in a task's input tar.
+    Folder names of the association are left out, so resends of the same series map to the same key.
+    """
+    h = hashlib.sha256()
+    h.update(f"{human_readable_id}\0{version}\0".encode())
+    for path in sorted(paths):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                arcname = os.path.join(os.path.basename(path), os.path.relpath(file_path, path))
+                h.update(f"{arcname}\0".encode())
+                with open(file_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Content addressed store of inference server outputs. One <key>.tar per entry. The modification time is bumped
+    on every hit, so eviction drops the least recently used entries once max_bytes is exceeded, and any entry unused
+    for max_age seconds.
+    """
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 ** 3, max_age: Union[float, None] = 7 * 86400):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.tar")
+
+    def fetch(self, key: str, destination: str) -> bool:
+        """
+        Places the cached output of key at destination. Hard linked when possible, so hits cost no copying.
+        :return: True on a hit
+        """
+        entry = self.entry_path(key)
+        try:
+            if self.max_age is not None and time.time() - os.path.getmtime(entry) > self.max_age:
+                os.remove(entry)
+                return False
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+
+        try:
+            os.link(entry, destination)
+        except FileNotFoundError:  # Evicted in the meantime
+            return False
+        except OSError:  # Other volume
+            shutil.copyfile(entry, destination)
+        return True
+
+    def put(self, key: str, output_tar: str):
+        entry = self.entry_path(key)
+        tmp_path = os.path.join(self.path, f".{key}.tmp")
+        try:
+            os.link(output_tar, tmp_path)
+        except OSError:
+            shutil.copyfile(output_tar, tmp_path)
+        os.replace(tmp_path, entry)  # Never expose half written entries
+        os.utime(entry)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".tar"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        entries.sort()  # Least recently used first
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, name in entries:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            if not expired and total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,64 @@
+import random
+from typing import Dict, List, Union, Iterable, Tuple
+
+STRATEGIES = ["least_outstanding", "weighted"]
+
+
+class EndpointRouter:
+    """
+    Picks the inference endpoint of a fingerprint each task is posted to.
+    least_outstanding: the endpoint with the lowest (outstanding tasks + 1) * turnaround / weight, i.e. the one
+        expected to finish a new task first.
+    weighted: a random endpoint with probability proportional to weight / turnaround.
+    Turnaround is a moving average of observed seconds from post to download per endpoint. Endpoints without
+    observations count as the average of the pool, so new replicas get their share right away.
+    """
+    def __init__(self, strategy: str = "least_outstanding", smoothing: float = 0.2, rng: Union[random.Random, None] = None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown routing strategy {strategy}. Must be one of {STRATEGIES}")
+        self.strategy = strategy
+        self.smoothing = smoothing
+        self.rng = rng or random.Random()
+        self.turnaround: Dict[str, float] = {}
+
+    @staticmethod
+    def pool(fp) -> List[Tuple[str, float]]:
+        """
+        :return: [(url, weight)] of the enabled endpoints of fp. Its inference_server_url if it has none.
+        """
+        endpoints = [(e.url, e.weight or 1.0) for e in fp.endpoints if e.enabled] if fp.endpoints else []
+        return endpoints or [(fp.inference_server_url, 1.0)]
+
+    def observe(self, url: str, duration: float):
+        previous = self.turnaround.get(url)
+        if previous is None:
+            self.turnaround[url] = duration
+        else:
+            self.turnaround[url] = (1 - self.smoothing) * previous + self.smoothing * duration
+
+    def expected_turnaround(self, urls: Iterable[str]) -> Dict[str, float]:
+        urls = list(urls)
+        known = [self.turnaround[url] for url in urls if url in self.turnaround]
+        default = sum(known) / len(known) if known else 1.0
+        return {url: max(self.turnaround.get(url, default), 1e-3) for url in urls}
+
+    def route(self, fp, outstanding: Dict[str, int], exclude: Iterable[str] = ()) -> Union[str, None]:
+        """
+        :param outstanding: tasks in flight per url. Incremented for the chosen url, so routing a batch spreads it.
+        :param exclude: urls which already failed for this task
+        :return: url to post to. None if every endpoint is excluded.
+        """
+        exclude = set(exclude)
+        candidates = [(url, weight) for url, weight in self.pool(fp) if url not in exclude and weight > 0]
+        if not candidates:
+            return None
+
+        turnaround = self.expected_turnaround(url for url, _ in candidates)
+        if self.strategy == "weighted":
+            url = self.rng.choices([url for url, _ in candidates],
+                                   weights=[weight / turnaround[url] for url, weight in candidates])[0]
+        else:
+            url = min(candidates,
+                      key=lambda c: (outstanding.get(c[0], 0) + 1) * turnaround[c[0]] / c[1])[0]
+        outstanding[url] = outstanding.get(url, 0) + 1
+        return url
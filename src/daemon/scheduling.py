@@ -0,0 +1,35 @@
+import datetime
+from typing import List
+
+from sqlalchemy import Integer, cast, func
+
+from database.models import Task, Fingerprint
+
+
+class PriorityScheduler:
+    """
+    Orders claims of the upload and delivery stages.
+    Strict priority first. A task's priority is its own override or its fingerprint's priority, raised by one step
+    for every aging_interval seconds it has waited, so low priority work is never starved.
+    Within one priority, fingerprints take turns in proportion to their weight (weighted round robin over the
+    backlog), so a burst of one fingerprint does not delay all others.
+    """
+    def __init__(self, aging_interval: float = 600):
+        self.aging_interval = aging_interval
+
+    def effective_priority(self, now: datetime.datetime):
+        priority = func.coalesce(Task.priority, Fingerprint.priority, 0)
+        if not self.aging_interval:
+            return priority
+        waited = (func.julianday(now) - func.julianday(Task.timestamp)) * 86400
+        return priority + cast(waited / self.aging_interval, Integer)
+
+    def order_by(self, now: datetime.datetime) -> List:
+        """
+        :return: ORDER BY clauses of DB.claim_tasks. Refer to Task and its Fingerprint.
+        """
+        effective_priority = self.effective_priority(now)
+        turn = func.row_number().over(partition_by=[Task.fingerprint_id, effective_priority], order_by=Task.id)
+        return [effective_priority.desc(),
+                turn / func.coalesce(Fingerprint.weight, 1.0),
+                Task.id]
@@ -0,0 +1,67 @@
+import datetime
+import os
+import shutil
+from typing import Callable, Dict, Union
+
+
+def disk_usage_fraction(path: str) -> float:
+    usage = shutil.disk_usage(path)
+    return usage.used / usage.total
+
+
+class StorageTiers:
+    """
+    Decides when task folders move from the fast tier (DB.data_dir, e.g. NVMe shared with the SCP's temporary storage)
+    to a large bulk tier. Only tasks in a final status are moved, so in flight tars always stay on the fast tier.
+    Above high_watermark usage of the fast tier, the oldest folders are moved until usage is below low_watermark.
+    Folders older than max_age are moved regardless of usage.
+
+    Usage counts the whole fast volume, including received series in the SCP's temporary storage, which are never
+    moved. A drain that moves every finished task folder without getting below low_watermark stalls. Until usage
+    drops below high_watermark again, later drains only look at tasks created since (see stalled_at).
+    """
+    def __init__(self,
+                 fast_dir: str,
+                 bulk_dir: str,
+                 high_watermark: float = 0.8,
+                 low_watermark: float = 0.6,
+                 max_age: Union[float, None] = 86400,
+                 usage: Callable[[str], float] = disk_usage_fraction):
+        if low_watermark > high_watermark:
+            raise ValueError(f"low_watermark {low_watermark} must not exceed high_watermark {high_watermark}")
+        self.fast_dir = fast_dir
+        self.bulk_dir = bulk_dir
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_age = None if max_age is None else datetime.timedelta(seconds=max_age)
+        self.usage = usage
+        # Start of the last drain which moved all it could and stayed above low_watermark. None if not stalled
+        self.stalled_at: Union[datetime.datetime, None] = None
+        os.makedirs(self.bulk_dir, exist_ok=True)
+
+    def fast_tier_usage(self) -> float:
+        return self.usage(self.fast_dir)
+
+    def above_high_watermark(self) -> bool:
+        return self.fast_tier_usage() >= self.high_watermark
+
+    def below_low_watermark(self) -> bool:
+        return self.fast_tier_usage() < self.low_watermark
+
+    def expired_before(self, now: datetime.datetime) -> Union[datetime.datetime, None]:
+        """
+        :return: tasks created before this are due for migration regardless of usage. None if there is no max_age.
+        """
+        return None if self.max_age is None else now - self.max_age
+
+    def migrate(self, tar_path: str, inference_server_tar: str) -> Dict[str, str]:
+        """
+        Moves the task folder holding tar_path and inference_server_tar to the bulk tier.
+        :return: the new paths as Task column updates
+        """
+        folder = os.path.dirname(tar_path)
+        destination = os.path.join(self.bulk_dir, os.path.basename(folder))
+        if os.path.isdir(folder):
+            shutil.move(folder, destination)  # Copies and deletes across volumes
+        return {"tar_path": os.path.join(destination, os.path.basename(tar_path)),
+                "inference_server_tar": os.path.join(destination, os.path.basename(inference_server_tar))}
@@ -0,0 +1,99 @@
+import datetime
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from io import BytesIO
+from types import SimpleNamespace
+
+from daemon.batching import group_batches, pack_batch, split_batch, MANIFEST
+
+NOW = datetime.datetime(2024, 1, 1, 12)
+
+
+def make_task(task_id, fp, age, tar_path=None):
+    return SimpleNamespace(id=task_id,
+                           fingerprint_id=fp.id,
+                           fingerprint=fp,
+                           timestamp=NOW - datetime.timedelta(seconds=age),
+                           tar_path=tar_path)
+
+
+class TestGroupBatches(unittest.TestCase):
+    def test_unbatched_fingerprints_are_uploaded_alone(self):
+        fp = SimpleNamespace(id=1, batch_window=None, max_batch_size=8)
+        tasks = [make_task(i, fp, 0) for i in range(3)]
+        uploads, held = group_batches(tasks, NOW)
+        self.assertEqual([[t] for t in tasks], uploads)
+        self.assertEqual([], held)
+
+    def test_batches_are_held_until_full_or_window_passed(self):
+        fp = SimpleNamespace(id=1, batch_window=30, max_batch_size=2)
+        young = [make_task(i, fp, 5) for i in range(3)]
+        uploads, held = group_batches(young, NOW)
+        self.assertEqual([young[:2]], uploads)  # Full batch goes right away
+        self.assertEqual(young[2:], held)
+
+        old = [make_task(10, fp, 60)]
+        uploads, held = group_batches(old, NOW)
+        self.assertEqual([old], uploads)
+        self.assertEqual([], held)
+
+
+class TestPackAndSplit(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def make_input(self, name, content: bytes) -> str:
+        folder = os.path.join(self.tmp_dir, name)
+        os.makedirs(os.path.join(folder, "series"))
+        with open(os.path.join(folder, "series", "1.dcm"), "wb") as f:
+            f.write(content)
+        tar_path = os.path.join(self.tmp_dir, f"{name}.tar")
+        with tarfile.open(tar_path, mode="w") as tf:
+            tf.add(os.path.join(folder, "series"), arcname="series")
+        return tar_path
+
+    def test_round_trip(self):
+        fp = SimpleNamespace(id=1)
+        tasks = [make_task(7, fp, 0, self.make_input("a", b"a")),
+                 make_task(8, fp, 0, self.make_input("b", b"b"))]
+        batch_path = os.path.join(self.tmp_dir, "batch.tar")
+        pack_batch(batch_path, tasks)
+
+        with tarfile.open(batch_path) as tf:
+            manifest = json.load(tf.extractfile(MANIFEST))
+            self.assertIn("7/series/1.dcm", tf.getnames())
+        self.assertEqual([{"task_id": 7, "path": "7"}, {"task_id": 8, "path": "8"}], manifest["tasks"])
+
+        with open(batch_path, "rb") as f:
+            batch = BytesIO(f.read())
+        for task, content in zip(tasks, [b"a", b"b"]):
+            out_path = os.path.join(self.tmp_dir, f"{task.id}_out.tar")
+            split_batch(batch, task, out_path)
+            with tarfile.open(out_path) as tf:
+                self.assertEqual(["series", "series/1.dcm"], sorted(tf.getnames()))
+                self.assertEqual(content, tf.extractfile("series/1.dcm").read())
+
+    def test_split_batch_rejects_bad_outputs(self):
+        fp = SimpleNamespace(id=1)
+        tasks = [make_task(7, fp, 0, self.make_input("a", b"a")),
+                 make_task(8, fp, 0, self.make_input("b", b"b"))]
+        batch_path = os.path.join(self.tmp_dir, "batch.tar")
+        pack_batch(batch_path, tasks[:1])
+        out_path = os.path.join(self.tmp_dir, "out.tar")
+
+        with open(batch_path, "rb") as f:
+            batch = BytesIO(f.read())
+        self.assertRaises(ValueError, split_batch, batch, tasks[1], out_path)
+        self.assertFalse(os.path.exists(out_path))
+        self.assertRaises(tarfile.TarError, split_batch, BytesIO(b"not a tar"), tasks[0], out_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,24 @@
 import datetime
+import functools
 import os
 import shutil
+import tarfile
 import tempfile
+import time
 import unittest
 
+from fastapi.testclient import TestClient
+from pydicom import dcmread
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian
+
+from api.fast_api import DicomNodeAPI
+from client.async_mock_client import AsyncMockClient
 from client.mock_client import MockClient
 from daemon.daemon import Daemon
+from daemon.health import CircuitBreaker
+from daemon.result_cache import ResultCache
 from database.db import DB
+from database.models import RefingerprintRequest, Task
 from dicom_networking.scp import SCP
 from dicom_networking.scu import post_folder_to_dicom_node
 from dicom_networking.tests.test_scp import get_test_dicom
@@ -81,6 +93,31 @@ class TestDBDaemon(unittest.TestCase):
         self.assertTrue(os.path.isfile(self.db.get_tasks().first().tar_path))
 
 
+    def test_fingerprint_task_unclaimable_until_input_is_written(self):
+        fp = self.db.add_fingerprint(human_readable_id="test",
+                                     inference_server_url="test")
+        self.db.add_trigger(fingerprint_id=fp.id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+        self.assertTrue(post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                                  scu_port=self.scp.port,
+                                                  scu_ae_title=self.scp.ae_title,
+                                                  dicom_dir=self.ct_test))
+
+        claimed_while_tarring = []
+        tar_dirs = self.daemon.tar_dirs
+
+        def claim_then_tar(**kwargs):
+            claimed_while_tarring.extend(self.db.claim_tasks(owner_id="other-worker", lease_duration=60, limit=10,
+                                                             statuses=[0]))
+            tar_dirs(**kwargs)
+
+        self.daemon.tar_dirs = claim_then_tar
+        self.daemon.fingerprint()
+        self.assertEqual([], claimed_while_tarring)
+        task = self.db.get_tasks().first()
+        self.assertIsNone(task.owner_id)
+        self.assertTrue(os.path.isfile(task.tar_path))
+
     def test_fingerprint_multi_model_match(self):
         fp = self.db.add_fingerprint(human_readable_id="test",
                                      inference_server_url="test")
@@ -117,6 +154,35 @@ class TestDBDaemon(unittest.TestCase):
         self.assertEqual(0, self.db.get_tasks().count())
         self.assertEqual(0, len(os.listdir(self.db.data_dir)))
 
+    def test_refingerprint_catalogued_series(self):
+        self.assertTrue(post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                                  scu_port=self.scp.port,
+                                                  scu_ae_title=self.scp.ae_title,
+                                                  dicom_dir=self.ct_test))
+        self.daemon.fingerprint()
+        self.assertEqual(0, self.db.get_tasks().count())
+        catalogued = self.db.get_catalog_page()
+        self.assertEqual(1, len(catalogued))
+        self.assertEqual("1.2.840.10008.5.1.4.1.1.2", catalogued[0].sop_class_uid)
+        self.assertGreater(catalogued[0].instance_count, 0)
+
+        # A fingerprint added after the data arrived
+        fp = self.db.add_fingerprint(human_readable_id="test",
+                                     inference_server_url="test")
+        self.db.add_trigger(fingerprint_id=fp.id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+        request = self.db.add_refingerprint_request(fingerprint_id=fp.id)
+
+        self.daemon.refingerprint()
+        self.assertEqual(1, self.db.get_tasks().count())
+        self.assertTrue(os.path.isfile(self.db.get_tasks().first().tar_path))
+        request = self.db.generic_get(RefingerprintRequest, request.id)
+        self.assertIsNotNone(request.finished_at)
+        self.assertEqual(1, request.task_count)
+
+        self.daemon.refingerprint()  # Requests are only run once
+        self.assertEqual(1, self.db.get_tasks().count())
+
     def test_post_tasks_single_modal(self):
         fp = self.db.add_fingerprint(human_readable_id="test",
                                      inference_server_url="test")
@@ -136,6 +202,200 @@ class TestDBDaemon(unittest.TestCase):
         task = self.db.get_tasks_by_kwargs({"status": 1}).first()
         self.assertIsNotNone(task.inference_server_uid)
 
+    def test_post_tasks_skips_tasks_leased_by_other_workers(self):
+        fp = self.generate_fp()
+        self.db.add_trigger(fingerprint_id=fp.id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+        post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                  scu_port=self.scp.port,
+                                  scu_ae_title=self.scp.ae_title,
+                                  dicom_dir=self.test_case_dir)
+        self.daemon.fingerprint()
+        self.db.claim_tasks(owner_id="other-worker", lease_duration=60, limit=10, statuses=[0])
+
+        self.daemon.post_tasks()
+        self.assertEqual(1, self.db.get_tasks_by_kwargs({"status": 0}).count())
+        self.assertEqual(0, len(self.client.tasks))
+
+        # Once the other worker lets go, the task is posted and its lease released again
+        self.db.release_tasks("other-worker", [task.id for task in self.db.get_tasks()])
+        self.daemon.post_tasks()
+        task = self.db.get_tasks_by_kwargs({"status": 1}).first()
+        self.assertIsNotNone(task)
+        self.assertIsNone(task.owner_id)
+
+    def test_claimed_batches_renew_leases(self):
+        fp = self.generate_fp()
+        task = self.db.add_task(fingerprint_id=fp.id)
+        daemon = Daemon(client=self.client, db=self.db, scp=self.scp, log_level=10, lease_duration=0.3)
+        for tasks in daemon.claimed_batches([0]):
+            time.sleep(1)  # Outlives the lease a few times over
+            self.assertEqual([], self.db.claim_tasks(owner_id="other-worker", lease_duration=60, limit=10,
+                                                     statuses=[0]))
+        self.assertIsNone(self.db.generic_get(Task, task.id).owner_id)
+
+    def test_post_tasks_fails_over_to_healthy_endpoint(self):
+        fp = self.generate_fp()
+        self.db.add_trigger(fingerprint_id=fp.id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+        self.db.add_inference_endpoint(fingerprint_id=fp.id, url="http://replica-a")
+        self.db.add_inference_endpoint(fingerprint_id=fp.id, url="http://replica-b")
+        self.client.failing_urls.add("http://replica-a")
+        post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                  scu_port=self.scp.port,
+                                  scu_ae_title=self.scp.ae_title,
+                                  dicom_dir=self.test_case_dir)
+        self.daemon.fingerprint()
+        self.daemon.post_tasks()
+
+        task = self.db.get_tasks_by_kwargs({"status": 1}).first()
+        self.assertIsNotNone(task)
+        self.assertEqual("http://replica-b", task.inference_server_url)
+        self.assertEqual(["http://replica-a", "http://replica-b"], self.client.posted_urls)
+
+        # Polling and downloading go to the endpoint holding the task
+        self.daemon.get_tasks()
+        self.assertEqual(1, self.db.get_tasks_by_kwargs({"status": 2}).count())
+        self.assertIn("http://replica-b", self.daemon.router.turnaround)
+
+    def test_post_tasks_rejected_task_fails_without_failover(self):
+        fp = self.generate_fp()
+        self.db.add_trigger(fingerprint_id=fp.id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+        self.db.add_inference_endpoint(fingerprint_id=fp.id, url="http://replica-a")
+        self.db.add_inference_endpoint(fingerprint_id=fp.id, url="http://replica-b")
+        post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                  scu_port=self.scp.port,
+                                  scu_ae_title=self.scp.ae_title,
+                                  dicom_dir=self.test_case_dir)
+        self.daemon.fingerprint()
+        self.client.post_task = functools.partial(self.client.post_task, success=False)  # Answers 500
+        self.daemon.post_tasks()
+
+        self.assertEqual(1, self.db.get_tasks_by_kwargs({"status": -1}).count())
+        self.assertEqual(1, len(self.client.posted_urls))
+
+    def test_unavailable_inference_server_keeps_tasks_queued(self):
+        self.daemon.circuit_breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        fp = self.generate_fp()
+        self.db.add_trigger(fingerprint_id=fp.id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+        self.client.failing_urls.add("test")
+        post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                  scu_port=self.scp.port,
+                                  scu_ae_title=self.scp.ae_title,
+                                  dicom_dir=self.test_case_dir)
+        self.daemon.fingerprint()
+        self.daemon.post_tasks()
+        self.daemon.post_tasks()  # Circuit is open. Nothing is sent
+        self.assertEqual(["test"], self.client.posted_urls)
+        self.assertEqual(1, self.db.get_tasks_by_kwargs({"status": 0}).count())
+
+        self.daemon.probe_endpoints()  # Still down
+        self.assertFalse(self.daemon.circuit_breaker.available("test"))
+
+        self.client.failing_urls.clear()
+        self.daemon.probe_endpoints()
+        self.assertTrue(self.daemon.circuit_breaker.available("test"))
+        self.daemon.post_tasks()
+        self.assertEqual(1, self.db.get_tasks_by_kwargs({"status": 1}).count())
+
+    def test_small_tasks_are_uploaded_in_one_batch(self):
+        fp = self.db.add_fingerprint(human_readable_id="test",
+                                     inference_server_url="test",
+                                     batch_window=3600,
+                                     max_batch_size=2)
+        first = self.db.add_task(fingerprint_id=fp.id)
+        self.daemon.tar_dirs(first.tar_path, [self.ct_test])
+        self.daemon.post_tasks()
+        self.assertEqual(0, len(self.client.posted_urls))  # Waiting for the batch to fill
+
+        second = self.db.add_task(fingerprint_id=fp.id)
+        self.daemon.tar_dirs(second.tar_path, [self.mr_test])
+        self.daemon.post_tasks()
+        self.assertEqual(1, len(self.client.posted_urls))
+        tasks = list(self.db.get_tasks_by_kwargs({"status": 1}))
+        self.assertEqual(2, len(tasks))
+        self.assertEqual(1, len(set(task.inference_server_uid for task in tasks)))
+        self.assertEqual([2, 2], [task.batch_size for task in tasks])
+
+        self.daemon.get_tasks()
+        self.assertEqual(1, self.client.get_task_calls)
+        for task, folder in [(first, "ct"), (second, "mr")]:
+            with tarfile.open(task.tar_path) as tf_in, tarfile.open(task.inference_server_tar) as tf_out:
+                self.assertEqual(tf_in.getnames(), tf_out.getnames())
+                self.assertEqual(folder, tf_out.getnames()[0])
+
+    def test_batches_are_not_split_over_claimed_pages(self):
+        self.daemon.claim_batch_size = 1
+        single = self.db.add_fingerprint(human_readable_id="single", inference_server_url="test")
+        fp = self.db.add_fingerprint(human_readable_id="test",
+                                     inference_server_url="test",
+                                     batch_window=3600,
+                                     max_batch_size=2)
+        for fingerprint_id, folder in [(fp.id, self.ct_test), (single.id, self.ct_test), (fp.id, self.mr_test)]:
+            task = self.db.add_task(fingerprint_id=fingerprint_id)
+            self.daemon.tar_dirs(task.tar_path, [folder])
+        self.daemon.post_tasks()
+
+        self.assertEqual(2, len(self.client.posted_urls))
+        batch = list(self.db.get_tasks_by_kwargs({"fingerprint_id": fp.id}))
+        self.assertEqual([1, 1], [task.status for task in batch])
+        self.assertEqual(1, len(set(task.inference_server_uid for task in batch)))
+
+    def test_finished_callback_wakes_whole_batch(self):
+        fp = self.db.add_fingerprint(human_readable_id="test",
+                                     inference_server_url="test",
+                                     batch_window=3600,
+                                     max_batch_size=2)
+        for folder in [self.ct_test, self.mr_test]:
+            task = self.db.add_task(fingerprint_id=fp.id)
+            self.daemon.tar_dirs(task.tar_path, [folder])
+        self.daemon.post_tasks()
+        tasks = list(self.db.get_tasks_by_kwargs({"status": 1}))
+        uid = tasks[0].inference_server_uid
+        in_a_while = datetime.datetime.now() + datetime.timedelta(hours=1)
+        self.db.update_tasks({task.id: {"next_poll": in_a_while} for task in tasks})
+
+        api = TestClient(DicomNodeAPI(db=self.db, log_level=20))
+        res = api.post("/tasks/callback/", params={"uid": uid})
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(sorted(task.id for task in tasks), sorted(res.json()["ids"]))
+        self.assertEqual(2, self.db.get_tasks_due_for_poll(datetime.datetime.now()).count())
+
+    def test_unusable_batch_output_fails_tasks(self):
+        fp = self.db.add_fingerprint(human_readable_id="test",
+                                     inference_server_url="test",
+                                     batch_window=3600,
+                                     max_batch_size=2)
+        for folder in [self.ct_test, self.mr_test]:
+            task = self.db.add_task(fingerprint_id=fp.id)
+            self.daemon.tar_dirs(task.tar_path, [folder])
+        self.daemon.post_tasks()
+        uid = self.db.get_tasks().first().inference_server_uid
+        self.client.outputs[uid] = b"not a tar"
+
+        self.daemon.get_tasks()
+        self.assertEqual(2, self.db.get_tasks_by_kwargs({"status": 3}).count())
+
+    def test_tar_dirs_decompresses_unless_allowed(self):
+        source = os.path.join(self.tmp_db_base_dir, "deflated", "1.2.840.10008.5.1.4.1.1.2")
+        os.makedirs(source)
+        ct_file = os.path.join(self.ct_test, sorted(os.listdir(self.ct_test))[0])
+        ds = dcmread(ct_file)
+        ds.file_meta.TransferSyntaxUID = DeflatedExplicitVRLittleEndian
+        ds.save_as(os.path.join(source, "0.dcm"), write_like_original=False)
+        shutil.copy(ct_file, os.path.join(source, "1.dcm"))
+
+        for allow_compressed, expected in [(True, DeflatedExplicitVRLittleEndian),
+                                           (False, ExplicitVRLittleEndian)]:
+            tar_path = os.path.join(self.tmp_db_base_dir, f"{allow_compressed}.tar")
+            self.daemon.tar_dirs(tar_path, [source], allow_compressed=allow_compressed)
+            with tarfile.open(tar_path) as tf:
+                member = tf.extractfile("1.2.840.10008.5.1.4.1.1.2/0.dcm")
+                self.assertEqual(expected, dcmread(member).file_meta.TransferSyntaxUID)
+                self.assertIsNotNone(tf.getmember("1.2.840.10008.5.1.4.1.1.2/1.dcm"))
+
     def generate_fp(self):
         fp = self.db.add_fingerprint(human_readable_id="test",
                                      inference_server_url="test")
@@ -164,6 +424,68 @@ class TestDBDaemon(unittest.TestCase):
         print(task.inference_server_tar)
         self.assertTrue(os.path.isfile(task.inference_server_tar))
 
+    def test_get_tasks_batched_polling(self):
+        fp = self.generate_fp()
+        self.db.add_trigger(fingerprint_id=fp.id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+
+        post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                  scu_port=self.scp.port,
+                                  scu_ae_title=self.scp.ae_title,
+                                  dicom_dir=self.test_case_dir)
+        self.daemon.fingerprint()
+        self.daemon.post_tasks()
+        task = self.db.get_tasks_by_kwargs({"status": 1}).first()
+
+        # Pending tasks are polled in batch without downloading anything
+        self.client.statuses[task.inference_server_uid] = 551
+        self.daemon.get_tasks()
+        self.assertEqual(1, self.client.get_task_statuses_calls)
+        self.assertEqual(0, self.client.get_task_calls)
+        self.assertEqual(1, self.db.get_tasks_by_kwargs({"status": 1}).count())
+
+        # Pending tasks back off
+        echo_task = self.db.get_tasks_by_kwargs({"id": task.id}).first()
+        self.assertEqual(1, echo_task.poll_count)
+        self.assertGreater(echo_task.next_poll, datetime.datetime.now())
+        self.daemon.get_tasks()
+        self.assertEqual(1, self.client.get_task_statuses_calls)
+
+        # Finished tasks are downloaded
+        del self.client.statuses[task.inference_server_uid]
+        self.db.update_task(task.id, next_poll=datetime.datetime.now())
+        self.daemon.get_tasks()
+        self.assertEqual(2, self.client.get_task_statuses_calls)
+        self.assertEqual(1, self.client.get_task_calls)
+        self.assertEqual(1, self.db.get_tasks_by_kwargs({"status": 2}).count())
+        self.assertTrue(os.path.isfile(task.inference_server_tar))
+        self.assertIsNotNone(self.db.get_fingerprint(fp.id).average_inference_duration)
+
+    def test_post_and_get_tasks_async_client(self):
+        self.client = AsyncMockClient()
+        self.daemon = Daemon(client=self.client, db=self.db, scp=self.scp, log_level=10)
+
+        fp = self.generate_fp()
+        self.db.add_trigger(fingerprint_id=fp.id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+        self.db.add_trigger(fingerprint_id=self.generate_fp().id,
+                            sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.4")
+
+        post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                  scu_port=self.scp.port,
+                                  scu_ae_title=self.scp.ae_title,
+                                  dicom_dir=self.test_case_dir)
+        self.daemon.fingerprint()
+        self.assertEqual(2, self.db.get_tasks_by_kwargs({"status": 0}).count())
+
+        self.daemon.post_tasks()
+        self.assertEqual(2, self.db.get_tasks_by_kwargs({"status": 1}).count())
+
+        self.daemon.get_tasks()
+        self.assertEqual(2, self.db.get_tasks_by_kwargs({"status": 2}).count())
+        for task in self.db.get_tasks():
+            self.assertTrue(os.path.isfile(task.inference_server_tar))
+
     def test_post_to_final_destinations(self):
         fp = self.db.add_fingerprint(human_readable_id="test",
                                      inference_server_url="test")
@@ -200,5 +522,94 @@ class TestDBDaemon(unittest.TestCase):
 
         self.assertNotEqual(0, os.listdir(self.tmp_destination))
 
+    def post_and_get_task(self):
+        if self.db.get_fingerprints().count() == 0:
+            fp = self.generate_fp()
+            self.db.add_trigger(fingerprint_id=fp.id,
+                                sop_class_uid_exact="1.2.840.10008.5.1.4.1.1.2")
+        post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                  scu_port=self.scp.port,
+                                  scu_ae_title=self.scp.ae_title,
+                                  dicom_dir=self.test_case_dir)
+        self.daemon.fingerprint()
+        self.daemon.post_tasks()
+        for task in self.db.get_tasks_by_kwargs({"status": 1}):  # Do not wait for expected completion
+            self.db.update_task(task.id, next_poll=datetime.datetime.now())
+        self.daemon.get_tasks()
+        self.daemon.post_to_final_destinations()
+        self.assertEqual(1, self.db.get_tasks_by_kwargs({"status": 3}).count())
+        return self.db.get_tasks_by_kwargs({"status": 3}).first()
+
+    def test_result_cache_skips_inference_on_resend(self):
+        self.daemon.result_cache = ResultCache(path=os.path.join(self.tmp_db_base_dir, "result_cache"))
+        first = self.post_and_get_task()
+        self.assertIsNotNone(first.cache_key)
+        self.assertEqual(1, len(self.client.tasks))
+
+        post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                  scu_port=self.scp.port,
+                                  scu_ae_title=self.scp.ae_title,
+                                  dicom_dir=self.test_case_dir)
+        self.daemon.fingerprint()
+        task = self.db.get_tasks_by_kwargs({"status": 2}).first()
+        self.assertEqual(first.cache_key, task.cache_key)
+        self.assertIsNone(task.inference_server_uid)
+        self.assertEqual(1, len(self.client.tasks))  # Nothing new on the inference server
+        with open(task.inference_server_tar, "rb") as cached, open(first.inference_server_tar, "rb") as f:
+            self.assertEqual(f.read(), cached.read())
+
+    def test_clean_up(self):
+        task = self.post_and_get_task()
+        self.daemon.clean_up()
+
+        echo_task = self.db.get_tasks_by_kwargs({"id": task.id}).first()
+        self.assertEqual(10, echo_task.status)
+        self.assertTrue(echo_task.deleted_local)
+        self.assertTrue(echo_task.deleted_remote)
+        self.assertFalse(os.path.isfile(task.tar_path))
+        self.assertEqual(0, len(self.client.tasks))
+
+    def test_clean_up_keeps_batch_on_server_until_last_member(self):
+        fp = self.db.add_fingerprint(human_readable_id="test",
+                                     inference_server_url="test",
+                                     batch_window=3600,
+                                     max_batch_size=2)
+        first, second = [self.db.add_task(fingerprint_id=fp.id) for _ in range(2)]
+        self.daemon.tar_dirs(first.tar_path, [self.ct_test])
+        self.daemon.tar_dirs(second.tar_path, [self.mr_test])
+        self.daemon.post_tasks()
+
+        self.db.update_task(first.id, status=3)  # e.g. failed, while its batch is still on the server
+        self.daemon.clean_up()
+        self.assertEqual(0, self.client.delete_task_calls)
+        self.assertEqual(10, self.db.generic_get(Task, first.id).status)
+
+        self.daemon.get_tasks()
+        self.assertEqual(2, self.db.generic_get(Task, second.id).status)
+        self.db.update_task(second.id, status=3)
+        self.daemon.clean_up()
+        self.assertEqual(1, self.client.delete_task_calls)
+        self.assertTrue(self.db.generic_get(Task, second.id).deleted_remote)
+        self.assertEqual(0, len(self.client.tasks))
+
+    def test_clean_up_retries_remote_delete(self):
+        task = self.post_and_get_task()
+
+        # Failed deletes are tried again on the next clean up, not within one
+        self.client.failing_deletes = 1
+        self.daemon.clean_up()
+        self.assertEqual(1, self.client.delete_task_calls)
+        echo_task = self.db.get_tasks_by_kwargs({"id": task.id}).first()
+        self.assertEqual(3, echo_task.status)
+        self.assertTrue(echo_task.deleted_local)
+        self.assertFalse(echo_task.deleted_remote)
+
+        self.daemon.clean_up()
+        self.assertEqual(2, self.client.delete_task_calls)
+        echo_task = self.db.get_tasks_by_kwargs({"id": task.id}).first()
+        self.assertEqual(10, echo_task.status)
+        self.assertTrue(echo_task.deleted_remote)
+
+
 if __name__ == '__main__':
     unittest.main()
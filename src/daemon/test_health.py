@@ -0,0 +1,58 @@
+import unittest
+
+from daemon.health import CircuitBreaker, CLOSED, OPEN, PROBING
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30, max_reset_timeout=100, clock=self.clock)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure("a")
+        self.breaker.record_failure("a")
+        self.breaker.record_success("a")
+        self.breaker.record_failure("a")
+        self.breaker.record_failure("a")
+        self.assertTrue(self.breaker.available("a"))
+
+        self.breaker.record_failure("a")
+        self.assertEqual(OPEN, self.breaker.state("a"))
+        self.assertEqual({"a"}, self.breaker.open_urls())
+        self.assertTrue(self.breaker.available("b"))
+
+    def test_probes_after_reset_timeout_with_backoff(self):
+        for _ in range(3):
+            self.breaker.record_failure("a")
+        self.assertEqual([], self.breaker.due_probes())
+
+        self.clock.now = 30
+        self.assertEqual(["a"], self.breaker.due_probes())
+        self.assertEqual(PROBING, self.breaker.state("a"))
+        self.assertEqual([], self.breaker.due_probes())  # Only one probe at a time
+
+        self.breaker.record_failure("a")  # Failed probe doubles the wait
+        self.clock.now = 89
+        self.assertEqual([], self.breaker.due_probes())
+        self.clock.now = 90
+        self.assertEqual(["a"], self.breaker.due_probes())
+
+        self.breaker.record_failure("a")
+        self.clock.now = 190  # Capped at max_reset_timeout
+        self.assertEqual(["a"], self.breaker.due_probes())
+
+        self.breaker.record_success("a")
+        self.assertEqual(CLOSED, self.breaker.state("a"))
+        self.assertEqual(set(), self.breaker.open_urls())
+
+
+if __name__ == '__main__':
+    unittest.main()
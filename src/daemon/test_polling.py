@@ -0,0 +1,51 @@
+import datetime
+import unittest
+
+from daemon.polling import PollSchedule
+
+
+class TestPollSchedule(unittest.TestCase):
+    def setUp(self) -> None:
+        self.schedule = PollSchedule(base_interval=10, max_interval=600, jitter=0)
+        self.now = datetime.datetime.now()
+
+    def delay(self, poll_count, expected_duration=None, posted_at=None):
+        next_poll = self.schedule.next_poll(now=self.now,
+                                            posted_at=posted_at or self.now,
+                                            poll_count=poll_count,
+                                            expected_duration=expected_duration)
+        return (next_poll - self.now).total_seconds()
+
+    def test_first_poll_without_history(self):
+        self.assertEqual(self.now, self.schedule.first_poll(self.now))
+
+    def test_first_poll_at_expected_completion(self):
+        self.assertEqual(self.now + datetime.timedelta(seconds=120), self.schedule.first_poll(self.now, 120))
+
+    def test_exponential_backoff(self):
+        self.assertEqual([10, 20, 40, 80], [self.delay(i) for i in range(1, 5)])
+
+    def test_backoff_is_capped(self):
+        self.assertEqual(600, self.delay(20))
+
+    def test_poll_at_expected_completion(self):
+        posted_at = self.now - datetime.timedelta(seconds=30)
+        self.assertAlmostEqual(70, self.delay(1, expected_duration=100, posted_at=posted_at))
+
+    def test_backoff_past_expected_completion(self):
+        posted_at = self.now - datetime.timedelta(seconds=300)
+        self.assertEqual(20, self.delay(2, expected_duration=100, posted_at=posted_at))
+
+    def test_jitter(self):
+        schedule = PollSchedule(base_interval=10, jitter=0.5)
+        for _ in range(100):
+            delay = (schedule.next_poll(self.now, self.now, 1) - self.now).total_seconds()
+            self.assertTrue(5 <= delay <= 15)
+
+    def test_update_average(self):
+        self.assertEqual(100, self.schedule.update_average(None, 100))
+        self.assertAlmostEqual(120, self.schedule.update_average(100, 200))
+
+
+if __name__ == '__main__':
+    unittest.main()
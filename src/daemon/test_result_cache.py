@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from daemon.result_cache import ResultCache, content_key
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ResultCache(path=os.path.join(self.tmp_dir, "cache"), max_bytes=100, max_age=None)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path: str, content: bytes) -> str:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_content_key(self):
+        for assoc in ["assoc_1", "assoc_2"]:
+            self.write(os.path.join(self.tmp_dir, assoc, "1.2.840", "1.2.3", "a.dcm"), b"instance")
+        key = content_key("model", "1.0", [os.path.join(self.tmp_dir, "assoc_1", "1.2.840")])
+
+        # Same content in another association
+        self.assertEqual(key, content_key("model", "1.0", [os.path.join(self.tmp_dir, "assoc_2", "1.2.840")]))
+        # Other fingerprint version
+        self.assertNotEqual(key, content_key("model", "1.1", [os.path.join(self.tmp_dir, "assoc_1", "1.2.840")]))
+        # Other content
+        self.write(os.path.join(self.tmp_dir, "assoc_2", "1.2.840", "1.2.3", "a.dcm"), b"changed")
+        self.assertNotEqual(key, content_key("model", "1.0", [os.path.join(self.tmp_dir, "assoc_2", "1.2.840")]))
+
+    def test_put_and_fetch(self):
+        destination = os.path.join(self.tmp_dir, "task", "output.tar")
+        os.makedirs(os.path.dirname(destination))
+        self.assertFalse(self.cache.fetch("abc", destination))
+
+        self.cache.put("abc", self.write(os.path.join(self.tmp_dir, "output.tar"), b"output"))
+        self.assertTrue(self.cache.fetch("abc", destination))
+        with open(destination, "rb") as f:
+            self.assertEqual(b"output", f.read())
+
+    def test_evicts_least_recently_used_beyond_max_bytes(self):
+        for key in ["a", "b", "c"]:
+            self.cache.put(key, self.write(os.path.join(self.tmp_dir, f"{key}.tar"), b"x" * 40))
+            os.utime(self.cache.entry_path(key), (time.time() - 100 + len(os.listdir(self.cache.path)),) * 2)
+        self.assertFalse(os.path.isfile(self.cache.entry_path("a")))
+        self.assertTrue(os.path.isfile(self.cache.entry_path("b")))
+        self.assertTrue(os.path.isfile(self.cache.entry_path("c")))
+
+    def test_expired_entries_miss(self):
+        self.cache.max_age = 10
+        self.cache.put("abc", self.write(os.path.join(self.tmp_dir, "output.tar"), b"output"))
+        os.utime(self.cache.entry_path("abc"), (time.time() - 20,) * 2)
+        self.assertFalse(self.cache.fetch("abc", os.path.join(self.tmp_dir, "destination.tar")))
+        self.assertFalse(os.path.isfile(self.cache.entry_path("abc")))
+
+
+if __name__ == '__main__':
+    unittest.main()
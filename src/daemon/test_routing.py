@@ -0,0 +1,61 @@
+import random
+import unittest
+from types import SimpleNamespace
+
+from daemon.routing import EndpointRouter
+
+
+def make_fp(*endpoints):
+    return SimpleNamespace(inference_server_url="http://default",
+                           endpoints=[SimpleNamespace(url=url, weight=weight, enabled=enabled)
+                                      for url, weight, enabled in endpoints])
+
+
+class TestEndpointRouter(unittest.TestCase):
+    def test_falls_back_to_inference_server_url(self):
+        router = EndpointRouter()
+        self.assertEqual("http://default", router.route(make_fp(), {}))
+        self.assertEqual("http://default", router.route(make_fp(("http://a", 1.0, False)), {}))
+
+    def test_least_outstanding_spreads_a_batch(self):
+        router = EndpointRouter()
+        fp = make_fp(("http://a", 1.0, True), ("http://b", 1.0, True))
+        outstanding = {"http://a": 3}
+        urls = [router.route(fp, outstanding) for _ in range(5)]
+        self.assertEqual(["http://b", "http://b", "http://b"], urls[:3])
+        self.assertEqual({"http://a": 4, "http://b": 4}, outstanding)
+
+    def test_least_outstanding_accounts_for_weight_and_latency(self):
+        router = EndpointRouter()
+        fp = make_fp(("http://a", 2.0, True), ("http://b", 1.0, True), ("http://c", 1.0, True))
+        router.observe("http://c", 100)
+        router.observe("http://a", 10)
+        router.observe("http://b", 10)
+        outstanding = {}
+        for _ in range(12):
+            router.route(fp, outstanding)
+        self.assertEqual(8, outstanding["http://a"])
+        self.assertEqual(4, outstanding["http://b"])
+        self.assertNotIn("http://c", outstanding)
+
+    def test_weighted(self):
+        router = EndpointRouter(strategy="weighted", rng=random.Random(42))
+        fp = make_fp(("http://a", 3.0, True), ("http://b", 1.0, True))
+        outstanding = {}
+        for _ in range(1000):
+            router.route(fp, outstanding)
+        self.assertAlmostEqual(0.75, outstanding["http://a"] / 1000, delta=0.05)
+
+    def test_exclude(self):
+        router = EndpointRouter()
+        fp = make_fp(("http://a", 1.0, True), ("http://b", 1.0, True))
+        self.assertEqual("http://b", router.route(fp, {}, exclude={"http://a"}))
+        self.assertIsNone(router.route(fp, {}, exclude={"http://a", "http://b"}))
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            EndpointRouter(strategy="round_robin")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from daemon.scheduling import PriorityScheduler
+from database.db import DB
+
+
+class TestPriorityScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = DB(base_dir=self.tmp_dir)
+        self.scheduler = PriorityScheduler(aging_interval=600)
+        self.research_a = self.db.add_fingerprint(human_readable_id="research_a", inference_server_url="test")
+        self.research_b = self.db.add_fingerprint(human_readable_id="research_b", inference_server_url="test",
+                                                  weight=2)
+        self.clinical = self.db.add_fingerprint(human_readable_id="clinical", inference_server_url="test",
+                                                priority=10)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def claim(self, limit=100):
+        return self.db.claim_tasks(owner_id="worker", lease_duration=60, limit=limit, statuses=[0],
+                                   order_by=self.scheduler.order_by(datetime.datetime.now()))
+
+    def test_strict_priority(self):
+        for _ in range(5):
+            self.db.add_task(self.research_a.id)
+        clinical = self.db.add_task(self.clinical.id)
+        claimed = self.claim(limit=1)
+        self.assertEqual([clinical.id], [task.id for task in claimed])
+
+    def test_task_priority_overrides_fingerprint(self):
+        self.db.add_task(self.clinical.id)
+        rushed = self.db.add_task(self.research_a.id, priority=20)
+        self.assertEqual(rushed.id, self.claim()[0].id)
+
+    def test_weighted_fair_share(self):
+        for _ in range(6):
+            self.db.add_task(self.research_a.id)
+        for _ in range(6):
+            self.db.add_task(self.research_b.id)
+
+        first = [task.fingerprint_id for task in self.claim()][:6]
+        self.assertEqual(2, first.count(self.research_a.id))
+        self.assertEqual(4, first.count(self.research_b.id))
+
+    def test_aging(self):
+        clinical = self.db.add_task(self.clinical.id)
+        waiting = self.db.add_task(self.research_a.id)
+        self.db.update_tasks({waiting.id: {"timestamp": datetime.datetime.now() - datetime.timedelta(hours=3)}})
+        self.assertEqual([waiting.id, clinical.id], [task.id for task in self.claim()])  # 0 + 18 steps > 10
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import datetime
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+
+from client.mock_client import MockClient
+from daemon.daemon import Daemon
+from daemon.storage import StorageTiers
+from database.db import DB
+
+
+class TestStorageTiers(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fast_dir = os.path.join(self.tmp_dir, "fast")
+        self.bulk_dir = os.path.join(self.tmp_dir, "bulk")
+        self.db = DB(base_dir=os.path.join(self.tmp_dir, "database"), data_dir=self.fast_dir)
+        self.fp = self.db.add_fingerprint(human_readable_id="test", inference_server_url="test")
+        self.tasks = [self.add_task(status=10) for _ in range(3)]
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def add_task(self, status: int):
+        task = self.db.add_task(fingerprint_id=self.fp.id)
+        for path in [task.tar_path, task.inference_server_tar]:
+            with open(path, "w") as f:
+                f.write("tar")
+        self.db.update_tasks({task.id: {"status": status}})
+        return task
+
+    def folder_usage(self, path: str) -> float:
+        # Each task folder fills a quarter of the fast tier
+        return len(os.listdir(path)) / 4
+
+    def get_daemon(self, storage_tiers: StorageTiers, **kwargs) -> Daemon:
+        return Daemon(client=MockClient(), db=self.db, incoming_queue=queue.Queue(), storage_tiers=storage_tiers,
+                      **kwargs)
+
+    def migrated(self):
+        return [task.id for task in self.db.get_tasks() if task.tar_path.startswith(self.bulk_dir)]
+
+    def test_drains_oldest_until_low_watermark(self):
+        tiers = StorageTiers(fast_dir=self.fast_dir, bulk_dir=self.bulk_dir, high_watermark=0.7,
+                             low_watermark=0.5, max_age=None, usage=self.folder_usage)
+        self.get_daemon(tiers).migrate_storage()
+
+        self.assertEqual([self.tasks[0].id, self.tasks[1].id], self.migrated())
+        for task in self.db.get_tasks():
+            self.assertTrue(os.path.isfile(task.tar_path))
+            self.assertTrue(os.path.isfile(task.inference_server_tar))
+            self.assertIsNone(task.owner_id)
+
+    def test_drain_stalls_above_low_watermark(self):
+        # Most of the fast tier is e.g. received series, which are never moved
+        tiers = StorageTiers(fast_dir=self.fast_dir, bulk_dir=self.bulk_dir, high_watermark=0.7,
+                             low_watermark=0.5, max_age=None, usage=lambda path: 0.9)
+        daemon = self.get_daemon(tiers, timeout=3600)
+        with self.assertLogs(daemon.logger, level="WARNING"):
+            daemon.migrate_storage()
+        self.assertEqual([task.id for task in self.tasks], self.migrated())
+        self.assertIsNotNone(tiers.stalled_at)
+
+        # Stalled drains only walk tasks young enough to have finished since
+        finished_since = self.add_task(status=10)
+        long_finished = self.add_task(status=10)
+        self.db.update_tasks({long_finished.id: {"timestamp": tiers.stalled_at - datetime.timedelta(hours=2)}})
+        daemon.migrate_storage()
+        self.assertEqual([task.id for task in self.tasks] + [finished_since.id], self.migrated())
+
+        # Usage dropped, e.g. received series were cleaned up
+        tiers.usage = lambda path: 0.1
+        daemon.migrate_storage()
+        self.assertIsNone(tiers.stalled_at)
+
+    def test_below_high_watermark_nothing_moves(self):
+        tiers = StorageTiers(fast_dir=self.fast_dir, bulk_dir=self.bulk_dir, high_watermark=0.8,
+                             low_watermark=0.5, max_age=None, usage=self.folder_usage)
+        self.get_daemon(tiers).migrate_storage()
+        self.assertEqual([], self.migrated())
+
+    def test_old_finished_tasks_move_regardless_of_usage(self):
+        in_flight = self.add_task(status=1)
+        tiers = StorageTiers(fast_dir=self.fast_dir, bulk_dir=self.bulk_dir, max_age=0, usage=lambda path: 0)
+        self.get_daemon(tiers).migrate_storage()
+
+        self.assertEqual([task.id for task in self.tasks], self.migrated())
+        self.assertTrue(os.path.isfile(self.db.get_tasks_by_kwargs({"id": in_flight.id}).first().tar_path))
+        self.assertTrue(self.db.get_tasks_by_kwargs({"id": in_flight.id}).first().tar_path.startswith(self.fast_dir))
+
+    def test_watermarks_are_validated(self):
+        with self.assertRaises(ValueError):
+            StorageTiers(fast_dir=self.fast_dir, bulk_dir=self.bulk_dir, high_watermark=0.5, low_watermark=0.8)
+
+
+if __name__ == '__main__':
+    unittest.main()
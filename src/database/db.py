@@ -1,19 +1,23 @@
+import datetime
+import logging
 import os
 import secrets
-from typing import Union, List
+from typing import Union, List, Dict, Iterator
 
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker, scoped_session, Query
+from sqlalchemy.orm import sessionmaker, scoped_session, Query, lazyload
 
-from database.models import Destination, Fingerprint, Trigger, Task, \
-    DestinationFingerprintAssociation, TriggerFingerprintAssociation
-from database.models import Base
+from database.models import Destination, Fingerprint, Trigger, Task, InferenceEndpoint, \
+    DestinationFingerprintAssociation, TriggerFingerprintAssociation, CatalogSeries, RefingerprintRequest
+from database.migrations import upgrade
+from database.patterns import compile_trigger
 
 
 class DB:
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, data_dir: Union[str, None] = None):
         self.base_dir = base_dir
-        self.data_dir = os.path.join(self.base_dir, "data")
+        # Task tars. Point it to fast storage and let StorageTiers move finished tasks to bulk storage.
+        self.data_dir = data_dir or os.path.join(self.base_dir, "data")
         self.db_dir = os.path.join(self.base_dir, "db")
 
         os.makedirs(self.base_dir, exist_ok=True)
@@ -23,11 +27,11 @@ class DB:
         self.database_path = f'{self.db_dir}/database.db'
         self.database_url = f'sqlite:///{self.database_path}'
 
-        self.engine = sqlalchemy.create_engine(self.database_url, future=True)
+        # Several workers may share the database file. Wait for their write locks rather than failing right away.
+        self.engine = sqlalchemy.create_engine(self.database_url, future=True, connect_args={"timeout": 30})
 
-        # Check if database exists - if not, create scheme
-        if not os.path.isfile(self.database_path):
-            Base.metadata.create_all(self.engine)
+        # Creates the scheme of a new database, and upgrades an existing one to the current models
+        upgrade(self.engine)
 
         self.session_maker = sessionmaker(bind=self.engine, expire_on_commit=False)
         self.Session = scoped_session(self.session_maker)
@@ -55,13 +59,23 @@ class DB:
                         description: Union[str, None] = None,
                         delete_locally: Union[bool, None] = None,
                         delete_remotely: Union[bool, None] = None,
+                        allow_compressed: Union[bool, None] = None,
+                        priority: Union[int, None] = None,
+                        weight: Union[float, None] = None,
+                        batch_window: Union[float, None] = None,
+                        max_batch_size: Union[int, None] = None,
                         ) -> Fingerprint:
         fp = Fingerprint(version=version,
                          description=description,
                          human_readable_id=human_readable_id,
                          inference_server_url=inference_server_url,
                          delete_remotely=delete_remotely,
-                         delete_locally=delete_locally)
+                         delete_locally=delete_locally,
+                         allow_compressed=allow_compressed,
+                         priority=priority,
+                         weight=weight,
+                         batch_window=batch_window,
+                         max_batch_size=max_batch_size)
         fp = self.generic_add(fp)
 
         return self.get_fingerprint(fp.id)
@@ -71,6 +85,18 @@ class DB:
             inc = session.query(Fingerprint).filter_by(id=id).first()
         return inc
 
+    def update_fingerprint(self,
+                           fingerprint_id: int,
+                           average_inference_duration: Union[float, None] = None) -> Fingerprint:
+        with self.Session() as session:
+            fp = session.query(Fingerprint).filter_by(id=fingerprint_id).first()
+            if average_inference_duration is not None:
+                fp.average_inference_duration = average_inference_duration
+
+            session.commit()
+            session.refresh(fp)
+            return fp
+
     def get_fingerprints(self) -> Query:
         with self.Session() as session:
             return session.query(Fingerprint)
@@ -80,18 +106,41 @@ class DB:
                     series_description_pattern: Union[str, None] = None,
                     sop_class_uid_exact: Union[str, None] = None,
                     exclude_pattern: Union[str, None] = None,
-                    fingerprint_id: Union[int, None] = None) -> Trigger:
-
+                    fingerprint_id: Union[int, None] = None,
+                    ignore_case: Union[bool, None] = None) -> Trigger:
+        """
+        Patterns are regular expressions. They are compiled here, so invalid ones are never stored.
+        :raises ValueError: if a pattern does not compile
+        """
         trigger = Trigger(study_description_pattern=study_description_pattern,
                           series_description_pattern=series_description_pattern,
                           sop_class_uid_exact=sop_class_uid_exact,
-                          exclude_pattern=exclude_pattern)
+                          exclude_pattern=exclude_pattern,
+                          ignore_case=ignore_case)
+        compile_trigger(trigger)
         trigger = self.generic_add(trigger)
         if fingerprint_id:
             self.add_trigger_fingerprint_association(fingerprint_id=fingerprint_id, trigger_id=trigger.id)
         
         return trigger
 
+    def add_inference_endpoint(self,
+                               fingerprint_id: int,
+                               url: str,
+                               weight: Union[float, None] = None,
+                               enabled: Union[bool, None] = None) -> InferenceEndpoint:
+        endpoint = InferenceEndpoint(fingerprint_id=fingerprint_id,
+                                     url=url,
+                                     weight=weight,
+                                     enabled=enabled)
+        return self.generic_add(endpoint)
+
+    def delete_inference_endpoint(self, endpoint_id):
+        try:
+            return self.generic_delete(InferenceEndpoint, endpoint_id)
+        except:
+            return False
+
     def add_destination(self,
                         scu_ip: str,
                         scu_port: int,
@@ -108,26 +157,220 @@ class DB:
         return dest
     ##### DYNAMIC #####
     def add_task(self,
-                 fingerprint_id) -> Task:
+                 fingerprint_id,
+                 priority: Union[int, None] = None,
+                 owner_id: Union[str, None] = None,
+                 lease_duration: float = 600) -> Task:
+        """
+        :param owner_id: create the task leased to owner_id for lease_duration seconds, e.g. until its input is
+        written. Claimable by any worker right away when None.
+        """
         storage_fol = self.generate_storage_folder()
         task = Task(fingerprint_id=fingerprint_id,
+                    priority=priority,
                     tar_path=os.path.join(storage_fol, "input.tar"),
                     inference_server_tar=os.path.join(storage_fol, "output.tar"))
+        if owner_id is not None:
+            task.owner_id = owner_id
+            task.lease_expires = datetime.datetime.now() + datetime.timedelta(seconds=lease_duration)
         return self.generic_add(task)
 
     def get_tasks_by_kwargs(self, kwargs) -> Query:
         with self.Session() as session:
             return session.query(Task).filter_by(**kwargs)
 
+    def get_tasks_due_for_poll(self, now: datetime.datetime) -> Query:
+        with self.Session() as session:
+            return session.query(Task).filter(Task.status == 1,
+                                              (Task.next_poll == None) | (Task.next_poll <= now))
+
+    def claim_tasks(self,
+                    owner_id: str,
+                    lease_duration: float,
+                    limit: int,
+                    statuses: List[int],
+                    after_id: int = 0,
+                    due_at: Union[datetime.datetime, None] = None,
+                    in_dir: Union[str, None] = None,
+                    created_before: Union[datetime.datetime, None] = None,
+                    created_after: Union[datetime.datetime, None] = None,
+                    fingerprint_id: Union[int, None] = None,
+                    batching: Union[bool, None] = None,
+                    exclude_ids: Union[List[int], None] = None,
+                    order_by: Union[List, None] = None) -> List[Task]:
+        """
+        Atomically leases up to limit unleased tasks with a status in statuses and id above after_id to owner_id.
+        Leases which have expired, e.g. of a crashed worker, count as free.
+        :param due_at: only claim tasks due for polling at this time
+        :param in_dir: only claim tasks with their tars below this folder
+        :param created_before: only claim tasks created before this time
+        :param created_after: only claim tasks created at or after this time
+        :param fingerprint_id: only claim tasks of this fingerprint
+        :param batching: only claim tasks of fingerprints with (True) or without (False) a batch_window
+        :param exclude_ids: do not claim these tasks
+        :param order_by: which tasks to claim first. Clauses may refer to Task and its Fingerprint. Id order if None
+        :return: the claimed tasks in order
+        """
+        now = datetime.datetime.now()
+        lease_expires = now + datetime.timedelta(seconds=lease_duration)
+        lease_free = (Task.lease_expires == None) | (Task.lease_expires <= now)
+        criteria = [Task.status.in_(statuses), Task.id > after_id, lease_free]
+        if due_at is not None:
+            criteria.append((Task.next_poll == None) | (Task.next_poll <= due_at))
+        if in_dir is not None:
+            criteria.append(Task.tar_path.startswith(os.path.join(in_dir, ""), autoescape=True))
+        if created_before is not None:
+            criteria.append(Task.timestamp < created_before)
+        if created_after is not None:
+            criteria.append(Task.timestamp >= created_after)
+        if fingerprint_id is not None:
+            criteria.append(Task.fingerprint_id == fingerprint_id)
+        if batching is not None:
+            has_window = Fingerprint.batch_window > 0
+            criteria.append(has_window if batching else ((Fingerprint.batch_window == None) | ~has_window))
+        if exclude_ids:
+            criteria.append(Task.id.notin_(exclude_ids))
+        order_by = order_by or [Task.id]
+
+        def ordered_ids(*where):
+            return sqlalchemy.select(Task.id) \
+                .outerjoin(Fingerprint, Task.fingerprint_id == Fingerprint.id) \
+                .where(*where) \
+                .order_by(*order_by)
+
+        with self.Session() as session:
+            # A single UPDATE, so no two workers can claim the same row. The lease is checked again on the outer
+            # statement for databases which do not serialize writers like SQLite does.
+            claimable = ordered_ids(*criteria).limit(limit)
+            session.execute(sqlalchemy.update(Task)
+                            .where(Task.id.in_(claimable.scalar_subquery()), lease_free)
+                            .values(owner_id=owner_id, lease_expires=lease_expires)
+                            .execution_options(synchronize_session=False))
+            session.commit()
+
+            claimed = ordered_ids(Task.owner_id == owner_id, Task.lease_expires == lease_expires)
+            position = {task_id: i for i, task_id in enumerate(session.execute(claimed).scalars())}
+            tasks = session.query(Task).filter(Task.id.in_(list(position.keys()))).all()
+            return sorted(tasks, key=lambda task: position[task.id])
+
+    def renew_leases(self, owner_id: str, task_ids: List[int], lease_duration: float) -> int:
+        """
+        Extends leases of owner_id by lease_duration from now. Tasks which have since been claimed by others are
+        left alone.
+        :return: number of leases renewed
+        """
+        lease_expires = datetime.datetime.now() + datetime.timedelta(seconds=lease_duration)
+        with self.Session() as session:
+            res = session.execute(sqlalchemy.update(Task)
+                                  .where(Task.id.in_(task_ids), Task.owner_id == owner_id)
+                                  .values(lease_expires=lease_expires)
+                                  .execution_options(synchronize_session=False))
+            session.commit()
+            return res.rowcount
+
+    def release_tasks(self, owner_id: str, task_ids: List[int]):
+        """
+        Releases leases of owner_id. Tasks which have since been claimed by others are left alone.
+        """
+        with self.Session() as session:
+            session.execute(sqlalchemy.update(Task)
+                            .where(Task.id.in_(task_ids), Task.owner_id == owner_id)
+                            .values(owner_id=None, lease_expires=None)
+                            .execution_options(synchronize_session=False))
+            session.commit()
+
+    def retire_tasks(self, before: datetime.datetime, final_statuses: List[int]) -> int:
+        """
+        Flags unleased tasks older than before and not in final_statuses as failed (-1).
+        :return: number of retired tasks
+        """
+        now = datetime.datetime.now()
+        with self.Session() as session:
+            res = session.execute(sqlalchemy.update(Task)
+                                  .where(Task.timestamp < before,
+                                         Task.status.notin_(final_statuses),
+                                         (Task.lease_expires == None) | (Task.lease_expires <= now))
+                                  .values(status=-1)
+                                  .execution_options(synchronize_session=False))
+            session.commit()
+            return res.rowcount
+
+    def notify_task_finished(self, inference_server_uid: str) -> List[Task]:
+        """
+        Makes the tasks on the inference server with inference_server_uid due for polling right away. All members of
+        a batch share the uid, so they are woken together.
+        :return: the tasks made due, empty if none waits for inference under the uid
+        """
+        with self.Session() as session:
+            tasks = session.scalars(sqlalchemy.update(Task)
+                                    .where(Task.status == 1, Task.inference_server_uid == inference_server_uid)
+                                    .values(next_poll=datetime.datetime.now())
+                                    .returning(Task)
+                                    .execution_options(synchronize_session=False)).unique().all()
+            session.commit()
+            return tasks
+
     def get_tasks(self) -> Query:
         return self.generic_get_all(Task)
 
+    def count_outstanding_tasks(self) -> Dict[str, int]:
+        """
+        :return: Dict[inference_server_url: number of tasks on it awaiting results]
+        """
+        with self.Session() as session:
+            rows = session.query(Task.inference_server_url, sqlalchemy.func.count(Task.id)) \
+                .filter(Task.status == 1, Task.inference_server_url != None) \
+                .group_by(Task.inference_server_url)
+            return {url: count for url, count in rows}
+
+    def inference_server_uids_in_use(self, uids: List[str], exclude_ids: List[int]) -> set:
+        """
+        :return: those of uids still needed on their inference server (status 0, 1 or 2) by tasks not in
+        exclude_ids, e.g. by other members of a batch
+        """
+        if not uids:
+            return set()
+        with self.Session() as session:
+            rows = session.query(Task.inference_server_uid) \
+                .filter(Task.inference_server_uid.in_(uids),
+                        Task.status.in_([0, 1, 2]),
+                        Task.id.notin_(exclude_ids)) \
+                .distinct()
+            return set(uid for uid, in rows)
+
+    def get_tasks_page(self,
+                       after_id: Union[int, None] = None,
+                       limit: int = 100,
+                       status: Union[int, None] = None,
+                       fingerprint_id: Union[int, None] = None,
+                       since: Union[datetime.datetime, None] = None,
+                       until: Union[datetime.datetime, None] = None) -> List[Task]:
+        """
+        One page of tasks, optionally filtered on status, fingerprint and a timestamp range [since, until).
+        Tasks come without their fingerprint, which is served by the fingerprint listing.
+        """
+        criteria = []
+        if status is not None:
+            criteria.append(Task.status == status)
+        if fingerprint_id is not None:
+            criteria.append(Task.fingerprint_id == fingerprint_id)
+        if since is not None:
+            criteria.append(Task.timestamp >= since)
+        if until is not None:
+            criteria.append(Task.timestamp < until)
+        return self.generic_get_page(Task, after_id, limit, *criteria, options=[lazyload(Task.fingerprint)])
+
     def update_task(self,
                     task_id: int,
                     inference_server_uid: Union[str, None] = None,
                     deleted_local: Union[bool, None] = None,
                     deleted_remote: Union[bool, None] = None,
-                    status: Union[int, None] = None) -> Task:
+                    status: Union[int, None] = None,
+                    posted_at: Union[datetime.datetime, None] = None,
+                    next_poll: Union[datetime.datetime, None] = None,
+                    poll_count: Union[int, None] = None,
+                    priority: Union[int, None] = None,
+                    inference_server_url: Union[str, None] = None) -> Task:
         with self.Session() as session:
             t = session.query(Task).filter_by(id=task_id).first()
             if inference_server_uid:
@@ -138,11 +381,173 @@ class DB:
                 t.deleted_remote = deleted_remote
             if status:
                 t.status = status
+            if posted_at is not None:
+                t.posted_at = posted_at
+            if next_poll is not None:
+                t.next_poll = next_poll
+            if poll_count is not None:
+                t.poll_count = poll_count
+            if priority is not None:
+                t.priority = priority
+            if inference_server_url is not None:
+                t.inference_server_url = inference_server_url
 
             session.commit()
             session.refresh(t)
             return t
 
+    def update_tasks(self, updates: Dict[int, Dict]):
+        """
+        Updates many tasks in one transaction.
+        :param updates: Dict[task_id: Dict[column: value]]
+        """
+        if not updates:
+            return
+        with self.Session() as session:
+            for t in session.query(Task).filter(Task.id.in_(list(updates.keys()))):
+                for column, value in updates[t.id].items():
+                    setattr(t, column, value)
+            session.commit()
+
+    ################### Catalog ##################
+    def add_catalog_series(self, assocs: List) -> int:
+        """
+        Catalogs every series of the released associations in one transaction.
+        :param assocs: dicom_networking.scp.Assoc
+        :return: number of series added
+        """
+        rows = [CatalogSeries(assoc_id=assoc.assoc_id,
+                              received=assoc.timestamp,
+                              study_instance_uid=series_instance.study_instance_uid,
+                              series_instance_uid=series_instance.series_instance_uid,
+                              sop_class_uid=series_instance.sop_class_uid,
+                              study_description=series_instance.study_description,
+                              series_description=series_instance.series_description,
+                              instance_count=series_instance.instance_count,
+                              bytes=series_instance.bytes,
+                              duplicate_count=series_instance.duplicate_count,
+                              path=series_instance.path)
+                for assoc in assocs for series_instance in assoc.series_instances.values()]
+        if not rows:
+            return 0
+        with self.Session() as session:
+            session.add_all(rows)
+            session.commit()
+        return len(rows)
+
+    @staticmethod
+    def catalog_criteria(study_instance_uid: Union[str, None] = None,
+                         series_instance_uid: Union[str, None] = None,
+                         sop_class_uid: Union[str, None] = None,
+                         since: Union[datetime.datetime, None] = None,
+                         until: Union[datetime.datetime, None] = None) -> List:
+        criteria = []
+        if study_instance_uid is not None:
+            criteria.append(CatalogSeries.study_instance_uid == study_instance_uid)
+        if series_instance_uid is not None:
+            criteria.append(CatalogSeries.series_instance_uid == series_instance_uid)
+        if sop_class_uid is not None:
+            criteria.append(CatalogSeries.sop_class_uid == sop_class_uid)
+        if since is not None:
+            criteria.append(CatalogSeries.received >= since)
+        if until is not None:
+            criteria.append(CatalogSeries.received < until)
+        return criteria
+
+    def get_catalog_page(self,
+                         after_id: Union[int, None] = None,
+                         limit: int = 100,
+                         **filters) -> List[CatalogSeries]:
+        """
+        One page of catalogued series, optionally filtered on study, series, SOP class and a received range
+        [since, until). See catalog_criteria.
+        """
+        return self.generic_get_page(CatalogSeries, after_id, limit, *self.catalog_criteria(**filters))
+
+    def get_catalog_usage(self, group_by: str = "sop_class_uid", **filters) -> List[Dict]:
+        """
+        Received series, instances and bytes per SOP class or per day, without walking the storage.
+        :param group_by: "sop_class_uid" or "day"
+        """
+        if group_by == "sop_class_uid":
+            key = CatalogSeries.sop_class_uid
+        elif group_by == "day":
+            key = sqlalchemy.func.date(CatalogSeries.received)
+        else:
+            raise ValueError(f"Unknown grouping {group_by}. Must be sop_class_uid or day")
+
+        with self.Session() as session:
+            rows = session.query(key,
+                                 sqlalchemy.func.count(CatalogSeries.id),
+                                 sqlalchemy.func.sum(CatalogSeries.instance_count),
+                                 sqlalchemy.func.sum(CatalogSeries.duplicate_count),
+                                 sqlalchemy.func.sum(CatalogSeries.bytes)) \
+                .filter(*self.catalog_criteria(**filters)) \
+                .group_by(key) \
+                .order_by(key)
+            return [{group_by: value, "series": series, "instances": instances, "duplicate_instances": duplicates,
+                     "bytes": size}
+                    for value, series, instances, duplicates, size in rows]
+
+    def iter_catalog_series(self,
+                            since: Union[datetime.datetime, None] = None,
+                            until: Union[datetime.datetime, None] = None,
+                            batch_size: int = 1000) -> Iterator[CatalogSeries]:
+        """
+        Catalogued series received in [since, until), with the series of an association next to each other.
+        Read in keyset pages of batch_size rows, each in a session of its own, so callers may use the database
+        between rows.
+        """
+        order = (CatalogSeries.received, CatalogSeries.assoc_id, CatalogSeries.id)
+        criteria = self.catalog_criteria(since=since, until=until)
+        last = None
+        while True:
+            with self.Session() as session:
+                query = session.query(CatalogSeries).filter(*criteria)
+                if last is not None:
+                    query = query.filter(sqlalchemy.tuple_(*order) > sqlalchemy.tuple_(*last))
+                rows = query.order_by(*order).limit(batch_size).all()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last = (rows[-1].received, rows[-1].assoc_id, rows[-1].id)
+
+    def add_refingerprint_request(self,
+                                  fingerprint_id: int,
+                                  since: Union[datetime.datetime, None] = None,
+                                  until: Union[datetime.datetime, None] = None) -> RefingerprintRequest:
+        return self.generic_add(RefingerprintRequest(fingerprint_id=fingerprint_id, since=since, until=until))
+
+    def claim_refingerprint_request(self, owner_id: str) -> Union[RefingerprintRequest, None]:
+        """
+        Atomically takes the oldest request nobody has taken, so each request is run by one worker only.
+        """
+        with self.Session() as session:
+            oldest = sqlalchemy.select(RefingerprintRequest.id) \
+                .where(RefingerprintRequest.owner_id == None) \
+                .order_by(RefingerprintRequest.id) \
+                .limit(1)
+            res = session.execute(sqlalchemy.update(RefingerprintRequest)
+                                  .where(RefingerprintRequest.id.in_(oldest.scalar_subquery()),
+                                         RefingerprintRequest.owner_id == None)
+                                  .values(owner_id=owner_id)
+                                  .returning(RefingerprintRequest.id)
+                                  .execution_options(synchronize_session=False))
+            request_id = res.scalar()
+            session.commit()
+            if request_id is None:
+                return None
+            return session.query(RefingerprintRequest).filter_by(id=request_id).first()
+
+    def finish_refingerprint_request(self, request_id: int, task_count: int):
+        with self.Session() as session:
+            session.execute(sqlalchemy.update(RefingerprintRequest)
+                            .where(RefingerprintRequest.id == request_id)
+                            .values(finished_at=datetime.datetime.now(), task_count=task_count)
+                            .execution_options(synchronize_session=False))
+            session.commit()
+
     def generic_add(self, item):
         with self.Session() as session:
             session.add(item)
@@ -159,6 +564,18 @@ class DB:
         with self.Session() as session:
             return session.query(cls)
 
+    def generic_get_page(self, cls, after_id: Union[int, None] = None, limit: Union[int, None] = 100, *criteria,
+                         options=()) -> List:
+        """
+        Keyset pagination on id. Pass the id of the last item of a page as after_id to get the next page, so deep
+        pages cost an index seek instead of skipping over all previous rows. No limit with limit None.
+        """
+        with self.Session() as session:
+            query = session.query(cls).options(*options).filter(*criteria)
+            if after_id is not None:
+                query = query.filter(cls.id > after_id)
+            return query.order_by(cls.id).limit(limit).all()
+
     def generic_delete(self, cls, id):
         with self.Session() as session:
             try:
@@ -166,7 +583,7 @@ class DB:
                 session.commit()
                 return deleted_rows
             except Exception as e:
-                print(e)
+                logging.error("Could not delete %s %s: %s", cls.__name__, id, e)
                 return False
 
     def delete_destination(self, destination_id):
@@ -192,14 +609,17 @@ class DB:
             for t in fp.triggers:
                 self.generic_delete(Trigger, t.id)
 
+            for endpoint in fp.endpoints:
+                self.generic_delete(InferenceEndpoint, endpoint.id)
+
             with self.Session() as session:
                 try:
                     deleted_rows = session.query(DestinationFingerprintAssociation).filter_by(fingerprint_id=fp.id).delete()
                     session.commit()
                 except Exception as e:
-                    print(e)
+                    logging.error("Could not delete destination associations of fingerprint %s: %s", fp.id, e)
 
             return self.generic_delete(Fingerprint, fingerprint_id)
         except Exception as e:
-            print(e)
+            logging.error("Could not delete fingerprint %s: %s", fingerprint_id, e)
             raise e
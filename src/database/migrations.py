@@ -0,0 +1,101 @@
+import datetime
+import logging
+from typing import Callable, Dict, List, Set
+
+import sqlalchemy
+from sqlalchemy.engine import Connection
+
+from database.models import Base
+from database.patterns import escape
+
+# Bump on every change to database.models, so existing databases are upgraded on their next start
+SCHEMA_VERSION = 1
+
+
+def column_default(column: sqlalchemy.Column) -> str:
+    """
+    :return: DEFAULT clause filling a new column in existing rows, from the column's scalar Python side default
+    """
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if default is None:
+        return ""
+    if isinstance(default, bool):
+        return f" DEFAULT {int(default)}"
+    if isinstance(default, (int, float)):
+        return f" DEFAULT {default}"
+    if isinstance(default, (datetime.datetime, datetime.date)):
+        default = default.isoformat(sep=" ")
+    return " DEFAULT '{}'".format(str(default).replace("'", "''"))
+
+
+def add_column_statement(table: sqlalchemy.Table, column: sqlalchemy.Column, dialect) -> str:
+    default = column_default(column)
+    # SQLite can only add a NOT NULL column with a default. Without one, rows get NULL and the ORM fills it in
+    nullable = " NOT NULL" if default and not column.nullable else ""
+    column_type = column.type.compile(dialect=dialect)
+    return f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{nullable}{default}"
+
+
+def upgrade(engine: sqlalchemy.engine.Engine) -> List[str]:
+    """
+    Brings the database up to database.models. Missing tables are created, missing columns are added with
+    ALTER TABLE ... ADD COLUMN and missing indexes are created. Only additive changes are supported: columns added
+    to existing tables must be nullable or have a scalar default. Runs while PRAGMA user_version is below
+    SCHEMA_VERSION, so an up to date database costs one query.
+    :return: the ALTER TABLE statements executed
+    """
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        if version >= SCHEMA_VERSION:
+            return []
+
+        inspector = sqlalchemy.inspect(conn)
+        existing = {table: {column["name"] for column in inspector.get_columns(table)}
+                    for table in inspector.get_table_names()}  # Dict[table: column names] before the upgrade
+        Base.metadata.create_all(conn)
+
+        statements = []
+        for table in Base.metadata.sorted_tables:
+            for column in table.columns:
+                if table.name not in existing or column.name in existing[table.name]:
+                    continue
+                statement = add_column_statement(table, column, conn.dialect)
+                try:
+                    conn.exec_driver_sql(statement)
+                except sqlalchemy.exc.OperationalError as e:
+                    if "duplicate column" not in str(e):  # Another worker upgraded it first
+                        raise
+                    continue
+                statements.append(statement)
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+        for step in DATA_STEPS:
+            step(conn, existing)
+
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    if statements:
+        logging.info("Upgraded database schema from version %s to %s: %s", version, SCHEMA_VERSION, statements)
+    return statements
+
+
+def escape_substring_patterns(conn: Connection, existing: Dict[str, Set[str]]):
+    """
+    Triggers from before ignore_case held plain substrings, matched literally. Escapes them, so they keep their
+    meaning as regular expressions.
+    """
+    if "triggers" not in existing or "ignore_case" in existing["triggers"]:
+        return
+    columns = ["study_description_pattern", "series_description_pattern", "exclude_pattern"]
+    rows = conn.exec_driver_sql(f"SELECT id, {', '.join(columns)} FROM triggers").fetchall()
+    for trigger_id, *patterns in rows:
+        escaped = [escape(pattern) if pattern is not None else None for pattern in patterns]
+        if escaped != patterns:
+            conn.exec_driver_sql(f"UPDATE triggers SET {', '.join(f'{c} = ?' for c in columns)} WHERE id = ?",
+                                 (*escaped, trigger_id))
+
+
+# Data changes run after the schema upgrade, with the column names each table had before it. Steps must be safe to
+# run more than once.
+DATA_STEPS: List[Callable[[Connection, Dict[str, Set[str]]], None]] = [escape_substring_patterns]
@@ -1,7 +1,7 @@
 import datetime
 from typing import Optional, List
 
-from sqlalchemy import Integer, ForeignKey
+from sqlalchemy import Integer, ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, relationship, mapped_column, Mapped
 
 
@@ -41,6 +41,7 @@ class Trigger(Base):
     series_description_pattern: Mapped[Optional[str]]
     sop_class_uid_exact: Mapped[Optional[str]]
     exclude_pattern: Mapped[Optional[str]]
+    ignore_case: Mapped[bool] = mapped_column(default=False)
 
 
 class Destination(Base):
@@ -53,6 +54,18 @@ class Destination(Base):
     scu_port: Mapped[int]
     scu_ae_title: Mapped[str]
 
+class InferenceEndpoint(Base):
+    __tablename__ = "inference_endpoints"
+    id: Mapped[int] = mapped_column(unique=True, primary_key=True, autoincrement=True)
+    timestamp: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now)
+
+    # One replica of a fingerprint's inference server
+    fingerprint_id: Mapped[int] = mapped_column(ForeignKey("fingerprints.id"), index=True)
+    url: Mapped[str]
+    weight: Mapped[float] = mapped_column(default=1.0)  # Relative capacity, e.g. number of GPUs
+    enabled: Mapped[bool] = mapped_column(default=True)
+
+
 class Fingerprint(Base):
     __tablename__ = "fingerprints"
     id: Mapped[int] = mapped_column(unique=True, primary_key=True, autoincrement=True)
@@ -66,9 +79,10 @@ class Fingerprint(Base):
                                                      viewonly=True)
     trigger_associations: Mapped[List[TriggerFingerprintAssociation]] = relationship(back_populates="fingerprint")
 
-    # Inference Server
+    # Inference Server. Tasks are spread over endpoints when there are any, otherwise all go to inference_server_url
     inference_server_url: Mapped[str]
     human_readable_id: Mapped[str]
+    endpoints: Mapped[List["InferenceEndpoint"]] = relationship(lazy="selectin")
 
     destinations: Mapped[List["Destination"]] = relationship(lazy="joined",
                                                              secondary="destination_fingerprint_associations",
@@ -77,24 +91,98 @@ class Fingerprint(Base):
     delete_remotely: Mapped[bool] = mapped_column(default=True)
     delete_locally: Mapped[bool] = mapped_column(default=True)
 
+    # Send compressed transfer syntaxes to the inference server as received. Otherwise they are decompressed.
+    allow_compressed: Mapped[bool] = mapped_column(default=False)
+
+    # Scheduling of uploads and deliveries. Higher priorities go first. Equal ones share by weight.
+    priority: Mapped[int] = mapped_column(default=0)
+    weight: Mapped[float] = mapped_column(default=1.0)
+
+    # Micro-batching. Tasks arriving within batch_window seconds are uploaded together, up to max_batch_size.
+    # Off when None. The inference server must accept uploads with a manifest (see daemon.batching).
+    batch_window: Mapped[Optional[float]] = mapped_column(nullable=True, default=None)
+    max_batch_size: Mapped[int] = mapped_column(default=8)
+
+    # Moving average of inference durations in seconds. Used to poll near expected completion.
+    average_inference_duration: Mapped[Optional[float]] = mapped_column(nullable=True, default=None)
+
+########## Catalog ##########
+class CatalogSeries(Base):
+    __tablename__ = "catalog_series"
+    id: Mapped[int] = mapped_column(unique=True, primary_key=True, autoincrement=True)
+    timestamp: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now)
+
+    # The association the series was received on. SCP thread ids are reused, so only both together identify it.
+    assoc_id: Mapped[str]
+    received: Mapped[datetime.datetime] = mapped_column(index=True)
+
+    study_instance_uid: Mapped[str] = mapped_column(index=True)
+    series_instance_uid: Mapped[str] = mapped_column(index=True)
+    sop_class_uid: Mapped[str] = mapped_column(index=True)
+    study_description: Mapped[str]
+    series_description: Mapped[str]
+
+    instance_count: Mapped[int] = mapped_column(default=0)
+    bytes: Mapped[int] = mapped_column(default=0)
+    duplicate_count: Mapped[int] = mapped_column(default=0)
+    path: Mapped[str]  # As received by the SCP. Gone once cleaned up, which re-fingerprinting skips
+
+    __table_args__ = (Index("ix_catalog_series_association", "received", "assoc_id"),)
+
+
+class RefingerprintRequest(Base):
+    __tablename__ = "refingerprint_requests"
+    id: Mapped[int] = mapped_column(unique=True, primary_key=True, autoincrement=True)
+    timestamp: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now)
+
+    # Runs fingerprint_id against the catalogued series received in [since, until). Unbounded when None
+    fingerprint_id: Mapped[int] = mapped_column(ForeignKey("fingerprints.id"))
+    since: Mapped[Optional[datetime.datetime]] = mapped_column(nullable=True, default=None)
+    until: Mapped[Optional[datetime.datetime]] = mapped_column(nullable=True, default=None)
+
+    # Worker which took the request, and the outcome once it is done
+    owner_id: Mapped[Optional[str]] = mapped_column(nullable=True, default=None, index=True)
+    finished_at: Mapped[Optional[datetime.datetime]] = mapped_column(nullable=True, default=None)
+    task_count: Mapped[int] = mapped_column(default=0)
+
+
 ########## Tasks ##########
 class Task(Base):
     __tablename__ = "tasks"
     id: Mapped[int] = mapped_column(unique=True, primary_key=True, autoincrement=True)
-    timestamp: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now)
+    timestamp: Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now, index=True)
 
-    fingerprint_id: Mapped[int] = mapped_column(ForeignKey("fingerprints.id"))
+    fingerprint_id: Mapped[int] = mapped_column(ForeignKey("fingerprints.id"), index=True)
     fingerprint: Mapped["Fingerprint"] = relationship(lazy="joined", uselist=False)
 
     # tarped on pull from SCP. Ready to post.
     tar_path: Mapped[str]
 
     # Status stamp
-    status: Mapped[int] = mapped_column(Integer, default=0)
+    status: Mapped[int] = mapped_column(Integer, default=0, index=True)
+
+    # Overrides the fingerprint's priority when set
+    priority: Mapped[Optional[int]] = mapped_column(nullable=True, default=None)
 
     # Inference server uid
     inference_server_uid: Mapped[str] = mapped_column(nullable=True, default=None)
     inference_server_tar: Mapped[str] = mapped_column(nullable=True, default=None)
+    # Number of tasks uploaded together with this one, sharing inference_server_uid. 1 if uploaded alone.
+    batch_size: Mapped[int] = mapped_column(default=1)
+    # Endpoint the task was posted to. Falls back to fingerprint.inference_server_url when None
+    inference_server_url: Mapped[Optional[str]] = mapped_column(nullable=True, default=None, index=True)
+
+    # Poll schedule while on inference server
+    posted_at: Mapped[Optional[datetime.datetime]] = mapped_column(nullable=True, default=None)
+    next_poll: Mapped[Optional[datetime.datetime]] = mapped_column(nullable=True, default=None)
+    poll_count: Mapped[int] = mapped_column(default=0)
+
+    # Result cache entry of the input and fingerprint version. Outputs are stored under it once downloaded.
+    cache_key: Mapped[Optional[str]] = mapped_column(nullable=True, default=None)
+
+    # Lease of the worker currently acting on the task. Free when lease_expires is None or in the past.
+    owner_id: Mapped[Optional[str]] = mapped_column(nullable=True, default=None)
+    lease_expires: Mapped[Optional[datetime.datetime]] = mapped_column(nullable=True, default=None)
 
     # Toggles check for final deletes
     deleted_local: Mapped[bool] = mapped_column(default=False)
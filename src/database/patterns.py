@@ -0,0 +1,82 @@
+import functools
+import re
+from typing import Union
+
+try:
+    import re2  # google-re2. Optional. Matches in linear time, so no pattern can stall ingest.
+except ImportError:
+    re2 = None
+
+ENGINES = ["re", "re2"]
+CACHE_SIZE = 4096
+
+_default_engine = "re"
+
+
+def set_default_engine(engine: str):
+    global _default_engine
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown regex engine {engine}. Must be one of {ENGINES}")
+    if engine == "re2" and re2 is None:
+        raise ImportError("Regex engine re2 requires the google-re2 package")
+    _default_engine = engine
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _compile(pattern: str, ignore_case: bool, engine: str):
+    """
+    :return: (compiled pattern, None) or (None, error message). Failures are cached too, so an invalid pattern is
+    not compiled again on every evaluation.
+    """
+    if engine == "re2":
+        try:
+            return re2.compile(f"(?i){pattern}" if ignore_case else pattern), None
+        except re2.error as e:
+            return None, f"Invalid pattern {pattern}: {e}"
+    try:
+        return re.compile(pattern, re.IGNORECASE if ignore_case else 0), None
+    except re.error as e:
+        return None, f"Invalid pattern {pattern}: {e}"
+
+
+def compile_pattern(pattern: str, ignore_case: bool = False, engine: Union[str, None] = None):
+    """
+    Compiled patterns are kept in a bounded LRU cache keyed on pattern, flags and engine. Editing a trigger changes
+    the key, so stale compilations are never used.
+    :raises ValueError: if the pattern does not compile
+    """
+    compiled, error = _compile(pattern, bool(ignore_case), engine or _default_engine)
+    if error is not None:
+        raise ValueError(error)
+    return compiled
+
+
+def compile_trigger(trigger):
+    """
+    Compiles all patterns of a trigger up front, so invalid patterns are rejected when the trigger is created and
+    evaluation only hits the cache.
+    :raises ValueError: if a pattern does not compile
+    """
+    for pattern in [trigger.study_description_pattern,
+                    trigger.series_description_pattern,
+                    trigger.exclude_pattern]:
+        if pattern is not None:
+            compile_pattern(pattern, trigger.ignore_case)
+
+
+def escape(pattern: str) -> str:
+    """
+    A pattern matching pattern literally. Only metacharacters are escaped, so the result means the same in re and re2.
+    """
+    return re.sub(r"([.^$*+?{}\[\]\\|()])", r"\\\1", pattern)
+
+
+def search(pattern: Union[str, None], text: Union[str, None], ignore_case: bool = False) -> bool:
+    """
+    :return: True if pattern is found anywhere in text. A None pattern matches everything, a None text nothing.
+    """
+    if pattern is None:
+        return True
+    if text is None:
+        return False
+    return compile_pattern(pattern, ignore_case).search(text) is not None
@@ -1,10 +1,28 @@
+import datetime
+import multiprocessing
 import os
 import shutil
 import tempfile
 import unittest
 
 from database.db import DB
-from database.models import Fingerprint, Trigger, Destination, DestinationFingerprintAssociation
+from database.models import Fingerprint, Trigger, Destination, DestinationFingerprintAssociation, RefingerprintRequest
+from dicom_networking.scp import Assoc, SeriesInstance
+
+
+def claim_until_empty(base_dir: str, owner_id: str):
+    """
+    Worker process of test_claim_tasks_multiprocess. Moves tasks from status 0 to 1 and reports what it claimed.
+    """
+    db = DB(base_dir=base_dir)
+    claimed = []
+    while True:
+        tasks = db.claim_tasks(owner_id=owner_id, lease_duration=60, limit=5, statuses=[0])
+        if not tasks:
+            return claimed
+        claimed += [task.id for task in tasks]
+        db.update_tasks({task.id: {"status": 1} for task in tasks})
+        db.release_tasks(owner_id, [task.id for task in tasks])
 
 
 class TestDB(unittest.TestCase):
@@ -90,6 +108,187 @@ class TestDB(unittest.TestCase):
         self.assertEqual(echo_task.status, 2)
         return echo_task
 
+    def test_notify_task_finished(self):
+        task = self.test_add_task()
+        self.assertEqual([], self.db.notify_task_finished("ABC"))  # Not on inference server yet
+
+        in_a_while = datetime.datetime.now() + datetime.timedelta(hours=1)
+        self.db.update_task(task_id=task.id, inference_server_uid="ABC", status=1, next_poll=in_a_while)
+        self.assertEqual(0, self.db.get_tasks_due_for_poll(datetime.datetime.now()).count())
+
+        echo_tasks = self.db.notify_task_finished("ABC")
+        self.assertEqual([task.id], [t.id for t in echo_tasks])
+        self.assertEqual(1, self.db.get_tasks_due_for_poll(datetime.datetime.now()).count())
+
+    def test_update_tasks(self):
+        task1 = self.test_add_task()
+        task2 = self.db.add_task(task1.fingerprint_id)
+        self.db.update_tasks({task1.id: {"deleted_local": True, "status": 10},
+                              task2.id: {"deleted_remote": True, "status": 11}})
+
+        echo_task1 = self.db.get_tasks_by_kwargs({"id": task1.id}).first()
+        echo_task2 = self.db.get_tasks_by_kwargs({"id": task2.id}).first()
+        self.assertTrue(echo_task1.deleted_local)
+        self.assertFalse(echo_task1.deleted_remote)
+        self.assertEqual(10, echo_task1.status)
+        self.assertFalse(echo_task2.deleted_local)
+        self.assertTrue(echo_task2.deleted_remote)
+        self.assertEqual(11, echo_task2.status)
+
+    def test_claim_tasks(self):
+        task1 = self.test_add_task()
+        task2 = self.db.add_task(task1.fingerprint_id)
+        self.db.update_task(task1.id, status=1)
+        self.db.update_task(task2.id, status=1)
+
+        claimed = self.db.claim_tasks(owner_id="a", lease_duration=60, limit=1, statuses=[1])
+        self.assertEqual([task1.id], [task.id for task in claimed])
+        self.assertEqual("a", claimed[0].owner_id)
+
+        # Leased tasks are not handed out again
+        claimed = self.db.claim_tasks(owner_id="b", lease_duration=60, limit=10, statuses=[1])
+        self.assertEqual([task2.id], [task.id for task in claimed])
+        self.assertEqual([], self.db.claim_tasks(owner_id="c", lease_duration=60, limit=10, statuses=[1]))
+
+        # Until released
+        self.db.release_tasks("a", [task1.id])
+        claimed = self.db.claim_tasks(owner_id="c", lease_duration=60, limit=10, statuses=[1])
+        self.assertEqual([task1.id], [task.id for task in claimed])
+
+    def test_claim_tasks_recovers_expired_leases(self):
+        task = self.test_add_task()
+        self.db.update_task(task.id, status=1)
+        self.assertEqual(1, len(self.db.claim_tasks(owner_id="crashed", lease_duration=-1, limit=10, statuses=[1])))
+
+        claimed = self.db.claim_tasks(owner_id="b", lease_duration=60, limit=10, statuses=[1])
+        self.assertEqual([task.id], [t.id for t in claimed])
+        self.assertEqual("b", claimed[0].owner_id)
+
+        # Releases of the former owner do not touch the new lease
+        self.db.release_tasks("crashed", [task.id])
+        self.assertEqual([], self.db.claim_tasks(owner_id="c", lease_duration=60, limit=10, statuses=[1]))
+
+    def test_add_task_leased(self):
+        fp = self.test_add_fingerprint()
+        task = self.db.add_task(fp.id, owner_id="a", lease_duration=60)
+        self.assertEqual([], self.db.claim_tasks(owner_id="b", lease_duration=60, limit=10, statuses=[0]))
+        self.db.release_tasks("a", [task.id])
+        self.assertEqual([task.id], [t.id for t in self.db.claim_tasks(owner_id="b", lease_duration=60, limit=10,
+                                                                       statuses=[0])])
+
+    def test_renew_leases(self):
+        task = self.test_add_task()
+        self.assertEqual(1, len(self.db.claim_tasks(owner_id="a", lease_duration=-1, limit=10, statuses=[0])))
+        self.assertEqual(1, self.db.renew_leases("a", [task.id], lease_duration=60))
+        self.assertEqual([], self.db.claim_tasks(owner_id="b", lease_duration=60, limit=10, statuses=[0]))
+        self.assertEqual(0, self.db.renew_leases("b", [task.id], lease_duration=60))
+
+    def test_claim_tasks_due_at(self):
+        task = self.test_add_task()
+        in_a_while = datetime.datetime.now() + datetime.timedelta(hours=1)
+        self.db.update_task(task.id, status=1, next_poll=in_a_while)
+        self.assertEqual([], self.db.claim_tasks(owner_id="a", lease_duration=60, limit=10, statuses=[1],
+                                                 due_at=datetime.datetime.now()))
+        self.assertEqual(1, len(self.db.claim_tasks(owner_id="a", lease_duration=60, limit=10, statuses=[1],
+                                                    due_at=in_a_while)))
+
+    def test_claim_tasks_multiprocess(self):
+        fp = self.db.add_fingerprint(inference_server_url="https://awesome-server.org", human_readable_id="test")
+        task_ids = [self.db.add_task(fp.id).id for _ in range(60)]
+
+        with multiprocessing.Pool(4) as pool:
+            claims = pool.starmap(claim_until_empty, [(self.tmp_dir, f"worker-{i}") for i in range(4)])
+
+        claimed = [task_id for worker_claims in claims for task_id in worker_claims]
+        self.assertEqual(sorted(task_ids), sorted(claimed))  # Every task claimed exactly once
+        self.assertEqual(60, self.db.get_tasks_by_kwargs({"status": 1}).count())
+
+    def test_retire_tasks(self):
+        task = self.test_add_task()
+        leased = self.db.add_task(task.fingerprint_id)
+        self.db.claim_tasks(owner_id="a", lease_duration=60, limit=10, statuses=[0], after_id=task.id)
+
+        self.assertEqual(0, self.db.retire_tasks(before=task.timestamp, final_statuses=[10, 11, -1]))
+        self.assertEqual(1, self.db.retire_tasks(before=datetime.datetime.now(), final_statuses=[10, 11, -1]))
+        self.assertEqual(-1, self.db.get_tasks_by_kwargs({"id": task.id}).first().status)
+        self.assertEqual(0, self.db.get_tasks_by_kwargs({"id": leased.id}).first().status)
+
+    def test_catalog(self):
+        received = datetime.datetime(2024, 1, 1, 12)
+        assocs = [Assoc(assoc_id="1",
+                        timestamp=received + datetime.timedelta(days=i),
+                        path=f"/storage/{i}",
+                        series_instances={
+                            f"1.2.{i}.{j}": SeriesInstance(series_instance_uid=f"1.2.{i}.{j}",
+                                                           study_instance_uid=f"1.2.{i}",
+                                                           study_description="Study",
+                                                           series_description=f"Series {j}",
+                                                           sop_class_uid=sop_class_uid,
+                                                           path=f"/storage/{i}/{sop_class_uid}/1.2.{i}.{j}",
+                                                           instance_count=10,
+                                                           bytes=1000)
+                            for j, sop_class_uid in enumerate(["1.2.840.10008.5.1.4.1.1.2",
+                                                               "1.2.840.10008.5.1.4.1.1.4"])})
+                  for i in range(3)]
+        self.assertEqual(6, self.db.add_catalog_series(assocs))
+        self.assertEqual(0, self.db.add_catalog_series([]))
+
+        self.assertEqual(["1.2.1.0", "1.2.1.1"],
+                         [s.series_instance_uid for s in self.db.get_catalog_page(study_instance_uid="1.2.1")])
+        self.assertEqual(3, len(self.db.get_catalog_page(sop_class_uid="1.2.840.10008.5.1.4.1.1.4")))
+        self.assertEqual(2, len(self.db.get_catalog_page(since=received + datetime.timedelta(days=2))))
+
+        usage = self.db.get_catalog_usage()
+        self.assertEqual([{"sop_class_uid": "1.2.840.10008.5.1.4.1.1.2", "series": 3, "instances": 30,
+                           "duplicate_instances": 0, "bytes": 3000},
+                          {"sop_class_uid": "1.2.840.10008.5.1.4.1.1.4", "series": 3, "instances": 30,
+                           "duplicate_instances": 0, "bytes": 3000}], usage)
+        usage = self.db.get_catalog_usage(group_by="day", until=received + datetime.timedelta(days=1))
+        self.assertEqual([{"day": "2024-01-01", "series": 2, "instances": 20, "duplicate_instances": 0,
+                           "bytes": 2000}], usage)
+        self.assertRaises(ValueError, self.db.get_catalog_usage, group_by="week")
+
+        # Series of an association come next to each other. Same assoc_id, as SCP thread ids are reused
+        rows = list(self.db.iter_catalog_series(batch_size=2))
+        self.assertEqual(6, len(rows))
+        self.assertEqual([r.received for r in rows], sorted(r.received for r in rows))
+
+    def test_iter_catalog_series_allows_writes_between_rows(self):
+        # Re-fingerprinting adds tasks while it reads the catalog, over more rows than fit in one page
+        assocs = [Assoc(assoc_id=str(i % 3),
+                        timestamp=datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=i // 3),
+                        path=f"/storage/{i}",
+                        series_instances={f"1.2.{i}": SeriesInstance(series_instance_uid=f"1.2.{i}",
+                                                                     study_description="Study",
+                                                                     series_description="Series",
+                                                                     sop_class_uid="1.2.840.10008.5.1.4.1.1.2",
+                                                                     path=f"/storage/{i}/1.2.{i}")})
+                  for i in range(25)]
+        self.db.add_catalog_series(assocs)
+        fp = self.db.add_fingerprint(inference_server_url="https://awesome-server.org", human_readable_id="test")
+
+        uids = []
+        for row in self.db.iter_catalog_series(batch_size=4):
+            uids.append(row.series_instance_uid)
+            self.db.add_task(fingerprint_id=fp.id)
+        self.assertEqual(sorted(f"1.2.{i}" for i in range(25)), sorted(uids))
+        self.assertEqual(25, len(set(uids)))
+        self.assertEqual(25, self.db.get_tasks().count())
+
+    def test_claim_refingerprint_request(self):
+        fp = self.db.add_fingerprint(inference_server_url="https://awesome-server.org", human_readable_id="test")
+        first = self.db.add_refingerprint_request(fingerprint_id=fp.id)
+        second = self.db.add_refingerprint_request(fingerprint_id=fp.id)
+
+        self.assertEqual(first.id, self.db.claim_refingerprint_request("worker-1").id)
+        self.assertEqual(second.id, self.db.claim_refingerprint_request("worker-2").id)
+        self.assertIsNone(self.db.claim_refingerprint_request("worker-1"))
+
+        self.db.finish_refingerprint_request(first.id, task_count=3)
+        request = self.db.generic_get(RefingerprintRequest, first.id)
+        self.assertEqual(3, request.task_count)
+        self.assertEqual("worker-1", request.owner_id)
+        self.assertIsNotNone(request.finished_at)
 
     def test_delete_destination(self):
         dest = self.test_add_destination()
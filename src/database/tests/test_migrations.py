@@ -0,0 +1,91 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from database.patterns import search
+from database.db import DB
+from database.migrations import SCHEMA_VERSION, upgrade
+from database.models import Trigger
+
+# Schema of the first release, before any column was added
+BASELINE_SCHEMA = """
+CREATE TABLE triggers (id INTEGER NOT NULL, timestamp DATETIME NOT NULL, study_description_pattern VARCHAR,
+    series_description_pattern VARCHAR, sop_class_uid_exact VARCHAR, exclude_pattern VARCHAR, PRIMARY KEY (id),
+    UNIQUE (id));
+CREATE TABLE destinations (id INTEGER NOT NULL, timestamp DATETIME NOT NULL, scu_ip VARCHAR NOT NULL,
+    scu_port INTEGER NOT NULL, scu_ae_title VARCHAR NOT NULL, PRIMARY KEY (id), UNIQUE (id));
+CREATE TABLE fingerprints (id INTEGER NOT NULL, timestamp DATETIME NOT NULL, version VARCHAR NOT NULL,
+    description VARCHAR NOT NULL, inference_server_url VARCHAR NOT NULL, human_readable_id VARCHAR NOT NULL,
+    delete_remotely BOOLEAN NOT NULL, delete_locally BOOLEAN NOT NULL, PRIMARY KEY (id), UNIQUE (id));
+CREATE TABLE destination_fingerprint_associations (timestamp DATETIME NOT NULL, destination_id INTEGER NOT NULL,
+    fingerprint_id INTEGER NOT NULL, PRIMARY KEY (destination_id, fingerprint_id),
+    FOREIGN KEY(destination_id) REFERENCES destinations (id), FOREIGN KEY(fingerprint_id) REFERENCES fingerprints (id));
+CREATE TABLE trigger_fingerprint_associations (timestamp DATETIME NOT NULL, trigger_id INTEGER NOT NULL,
+    fingerprint_id INTEGER NOT NULL, PRIMARY KEY (trigger_id, fingerprint_id),
+    FOREIGN KEY(trigger_id) REFERENCES triggers (id), FOREIGN KEY(fingerprint_id) REFERENCES fingerprints (id));
+CREATE TABLE tasks (id INTEGER NOT NULL, timestamp DATETIME NOT NULL, fingerprint_id INTEGER NOT NULL,
+    tar_path VARCHAR NOT NULL, status INTEGER NOT NULL, inference_server_uid VARCHAR, inference_server_tar VARCHAR,
+    deleted_local BOOLEAN NOT NULL, deleted_remote BOOLEAN NOT NULL, PRIMARY KEY (id), UNIQUE (id),
+    FOREIGN KEY(fingerprint_id) REFERENCES fingerprints (id));
+
+INSERT INTO fingerprints VALUES (1, '2024-01-01 00:00:00', '1.0', '', 'http://inference-server', 'test', 1, 1);
+INSERT INTO triggers VALUES (1, '2024-01-01 00:00:00', 'Study', NULL, '1.2.840.10008.5.1.4.1.1.2', NULL);
+INSERT INTO triggers VALUES (2, '2024-01-01 00:00:00', NULL, 'C++ (head)', NULL, '[old]');
+INSERT INTO trigger_fingerprint_associations VALUES ('2024-01-01 00:00:00', 1, 1);
+INSERT INTO tasks VALUES (1, '2024-01-01 00:00:00', 1, '/data/input.tar', 0, NULL, '/data/output.tar', 0, 0);
+"""
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp_dir, "db"))
+        self.database_path = os.path.join(self.tmp_dir, "db", "database.db")
+        with sqlite3.connect(self.database_path) as conn:
+            conn.executescript(BASELINE_SCHEMA)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_upgrade_baseline_database(self):
+        db = DB(base_dir=self.tmp_dir)
+
+        task = db.get_tasks().first()
+        self.assertEqual(1, task.id)
+        self.assertIsNone(task.next_poll)
+        self.assertEqual(0, task.poll_count)
+        self.assertEqual(1, task.batch_size)
+        self.assertFalse(task.fingerprint.allow_compressed)
+        self.assertEqual(8, task.fingerprint.max_batch_size)
+        self.assertFalse(task.fingerprint.triggers[0].ignore_case)
+
+        # Stages of the daemon work on upgraded rows
+        self.assertEqual([1], [t.id for t in db.claim_tasks(owner_id="a", lease_duration=60, limit=10,
+                                                            statuses=[0])])
+        self.assertEqual(2, db.add_task(fingerprint_id=1).id)
+        db.add_catalog_series([])
+
+        with sqlite3.connect(self.database_path) as conn:
+            self.assertEqual(SCHEMA_VERSION, conn.execute("PRAGMA user_version").fetchone()[0])
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertTrue({"ix_tasks_status", "ix_tasks_timestamp", "ix_tasks_inference_server_url"} <= indexes)
+
+    def test_upgrade_escapes_substring_patterns(self):
+        db = DB(base_dir=self.tmp_dir)
+        trigger = db.generic_get(Trigger, 2)
+        self.assertEqual("C\\+\\+ \\(head\\)", trigger.series_description_pattern)
+        self.assertTrue(search(trigger.series_description_pattern, "Neuro C++ (head) 1mm"))
+        self.assertTrue(search(trigger.exclude_pattern, "an [old] series"))
+        self.assertFalse(search(trigger.exclude_pattern, "an o series"))
+        self.assertEqual("Study", db.generic_get(Trigger, 1).study_description_pattern)
+
+    def test_upgrade_runs_once(self):
+        db = DB(base_dir=self.tmp_dir)
+        self.assertEqual([], upgrade(db.engine))
+        self.assertEqual(1, DB(base_dir=self.tmp_dir).get_tasks().count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from database import patterns
+from database.models import Trigger
+from database.patterns import compile_pattern, compile_trigger, search, set_default_engine
+
+
+class TestPatterns(unittest.TestCase):
+    def tearDown(self) -> None:
+        set_default_engine("re")
+
+    def test_search(self):
+        self.assertTrue(search(None, "anything"))
+        self.assertFalse(search("a", None))
+        self.assertTrue(search("T1.*POST", "T1 AX POST"))
+        self.assertFalse(search("t1", "T1 AX POST"))
+        self.assertTrue(search("t1", "T1 AX POST", ignore_case=True))
+
+    def test_compiled_once(self):
+        compile_pattern("^cached pattern$")
+        hits = patterns._compile.cache_info().hits
+        for _ in range(10):
+            search("^cached pattern$", "cached pattern")
+        self.assertEqual(hits + 10, patterns._compile.cache_info().hits)
+
+    def test_cache_is_bounded(self):
+        self.assertEqual(patterns.CACHE_SIZE, patterns._compile.cache_info().maxsize)
+
+    def test_invalid_pattern(self):
+        self.assertRaises(ValueError, compile_pattern, "(unclosed")
+        self.assertRaises(ValueError, compile_trigger, Trigger(exclude_pattern="[z-a]", ignore_case=False))
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, set_default_engine, "perl")
+
+    @unittest.skipIf(patterns.re2 is None, "google-re2 is not installed")
+    def test_re2(self):
+        set_default_engine("re2")
+        self.assertTrue(search("t1.*post", "T1 AX POST", ignore_case=True))
+        self.assertFalse(search("t1.*post", "T1 AX POST"))
+        # Catastrophic backtracking in re. Linear in re2.
+        self.assertFalse(search("(a+)+$", "a" * 5000 + "!"))
+        self.assertRaises(ValueError, compile_pattern, "(unclosed")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,31 @@
+import asyncio
+import functools
 import logging
 
 
 def log(func):
+    """
+    Logs entry and exit of func at debug level. Costs one level check per call when debug logging is off.
+    """
+    logger = logging.getLogger(func.__module__)
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not logger.isEnabledFor(logging.DEBUG):
+                return await func(*args, **kwargs)
+            logger.debug("[ ] Running func: %s", func.__qualname__)
+            ret = await func(*args, **kwargs)
+            logger.debug("[X] Running func: %s", func.__qualname__)
+            return ret
+        return async_wrapper
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        logging.debug(f"[ ] Running func: {func}")
+        if not logger.isEnabledFor(logging.DEBUG):
+            return func(*args, **kwargs)
+        logger.debug("[ ] Running func: %s", func.__qualname__)
         ret = func(*args, **kwargs)
-        logging.debug(f"[X] Running func: {func}")
+        logger.debug("[X] Running func: %s", func.__qualname__)
         return ret
-    return wrapper
\ No newline at end of file
+    return wrapper
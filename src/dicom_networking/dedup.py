@@ -0,0 +1,72 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Union, Tuple
+
+
+def content_hash(data) -> str:
+    """
+    :param data: bytes-like encoded dataset
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class InstanceIndex:
+    """
+    Persistent index of recently received SOPInstanceUIDs, their content hash and where they were stored.
+    Bounded to max_entries. The oldest entries are evicted in chunks once it grows past that.
+    Plain sqlite3, so the receiver does not need sqlalchemy. Safe to share between the SCP's association threads.
+    """
+    def __init__(self, path: str, max_entries: int = 1000000, eviction_chunk: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.eviction_chunk = eviction_chunk
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")  # The index is a cache. Losing the last writes is fine
+        self.connection.execute("CREATE TABLE IF NOT EXISTS instances ("
+                                "sop_instance_uid TEXT PRIMARY KEY, "
+                                "content_hash TEXT NOT NULL, "
+                                "path TEXT NOT NULL, "
+                                "seen_at REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS instances_seen_at ON instances (seen_at)")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COUNT(*) FROM instances").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, sop_instance_uid: str) -> Union[Tuple[str, str], None]:
+        """
+        :return: (content_hash, path) of the last copy of sop_instance_uid received, or None
+        """
+        with self.lock:
+            return self.connection.execute("SELECT content_hash, path FROM instances WHERE sop_instance_uid = ?",
+                                           (sop_instance_uid,)).fetchone()
+
+    def put(self, sop_instance_uid: str, content_hash: str, path: str):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)",
+                                    (sop_instance_uid, content_hash, path, time.time()))
+            self.size += 1  # Upper bound. Replaced rows are counted as well until the next eviction recounts.
+            if self.size > self.max_entries:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        excess = self.connection.execute("SELECT COUNT(*) FROM instances").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.connection.execute("DELETE FROM instances WHERE sop_instance_uid IN "
+                                    "(SELECT sop_instance_uid FROM instances ORDER BY seen_at LIMIT ?)",
+                                    (excess + self.eviction_chunk,))
+        self.size = self.connection.execute("SELECT COUNT(*) FROM instances").fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM instances").fetchone()[0]
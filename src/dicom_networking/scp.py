@@ -2,12 +2,16 @@ import datetime
 import logging
 import os
 import queue
-from typing import Dict
+from typing import Dict, Union, List
 
 import pydantic
-from pynetdicom import AE, evt, StoragePresentationContexts, _config
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom import AE, evt, StoragePresentationContexts, _config, build_context
 
 from decorators.logging import log
+from dicom_networking.dedup import InstanceIndex, content_hash
+from dicom_networking.trace import TraceWriter
+from dicom_networking.transfer_syntaxes import SCP_TRANSFER_SYNTAXES
 
 LOG_FORMAT = ('%(levelname)s:%(asctime)s:%(message)s')
 
@@ -18,6 +22,10 @@ class SeriesInstance(pydantic.BaseModel):
     series_description: str
     sop_class_uid: str
     path: str  # Direct folder to this SeriesInstance
+    instance_count: int = 0
+    bytes: int = 0  # Encoded size of the received datasets
+    duplicate_count: int = 0  # Instances identical to ones received before. Hard linked instead of written
+    study_instance_uid: str = "None"
 
 
 class Assoc(pydantic.BaseModel):
@@ -25,6 +33,93 @@ class Assoc(pydantic.BaseModel):
     timestamp: datetime.datetime
     path: str  # Base folder
     series_instances: Dict[str, SeriesInstance]  # Dict[series_instance_uid: SeriesInstance]
+    duplicate: bool = False  # Every instance was received before with identical content
+
+
+class SeriesRecord:
+    """
+    Ingest time bookkeeping of a series. Kept as a plain slotted object, as it is touched on every C-STORE.
+    Converted to SeriesInstance when the association is released.
+    """
+    __slots__ = ("series_instance_uid", "study_description", "series_description", "sop_class_uid", "path",
+                 "instance_count", "bytes", "duplicate_count", "study_instance_uid")
+
+    def __init__(self, series_instance_uid: str, study_description: str, series_description: str,
+                 sop_class_uid: str, path: str, study_instance_uid: str = "None"):
+        self.series_instance_uid = series_instance_uid
+        self.study_instance_uid = study_instance_uid
+        self.study_description = study_description
+        self.series_description = series_description
+        self.sop_class_uid = sop_class_uid
+        self.path = path
+        self.instance_count = 0
+        self.bytes = 0
+        self.duplicate_count = 0
+
+    def to_series_instance(self) -> SeriesInstance:
+        return SeriesInstance(series_instance_uid=self.series_instance_uid,
+                              study_description=self.study_description,
+                              series_description=self.series_description,
+                              sop_class_uid=self.sop_class_uid,
+                              path=self.path,
+                              instance_count=self.instance_count,
+                              bytes=self.bytes,
+                              duplicate_count=self.duplicate_count,
+                              study_instance_uid=self.study_instance_uid)
+
+
+class AssocRecord:
+    """
+    Ingest time bookkeeping of an association. Converted to Assoc when the association is released.
+    """
+    __slots__ = ("assoc_id", "timestamp", "path", "series_records")
+
+    def __init__(self, assoc_id: str, timestamp: datetime.datetime, path: str):
+        self.assoc_id = assoc_id
+        self.timestamp = timestamp
+        self.path = path
+        self.series_records: Dict[str, SeriesRecord] = {}
+
+    def to_assoc(self) -> Assoc:
+        return Assoc(assoc_id=self.assoc_id,
+                     timestamp=self.timestamp,
+                     path=self.path,
+                     series_instances={uid: record.to_series_instance()
+                                       for uid, record in self.series_records.items()},
+                     duplicate=all(record.duplicate_count == record.instance_count
+                                   for record in self.series_records.values()))
+
+
+def encoded_size(event) -> int:
+    """
+    :return: size of the encoded dataset of a C-STORE request without decoding it
+    """
+    try:
+        return event.request.DataSet.getbuffer().nbytes
+    except AttributeError:  # Received to file with _config.STORE_RECV_CHUNKED_DATASET
+        return os.path.getsize(event.dataset_path)
+
+
+def encoded_dataset(event):
+    """
+    :return: the encoded dataset of a C-STORE request as a bytes-like object
+    """
+    try:
+        return event.request.DataSet.getbuffer()
+    except AttributeError:  # Received to file with _config.STORE_RECV_CHUNKED_DATASET
+        with open(event.dataset_path, "rb") as f:
+            return f.read()
+
+
+def write_encoded(path: str, event, encoded: Union[bytes, memoryview, None] = None):
+    """
+    Writes the dataset of a C-STORE request as the sender encoded it, so compressed data stays compressed and
+    nothing is decoded and re-encoded.
+    """
+    with open(path, "wb") as f:
+        f.write(b"\x00" * 128 + b"DICM")
+        write_file_meta_info(f, event.file_meta, enforce_standard=True)
+        f.write(encoded_dataset(event) if encoded is None else encoded)
 
 
 class SCP:
@@ -35,6 +130,11 @@ class SCP:
                  temporary_storage: str,
                  log_level=10,
                  pynetdicom_log_level="standard",
+                 incoming_queue=None,
+                 instance_index: Union[InstanceIndex, None] = None,
+                 transfer_syntaxes: Union[List[str], None] = None,
+                 maximum_pdu_size: int = 0,
+                 trace: Union[TraceWriter, None] = None,
                  ):
 
         logging.basicConfig(level=log_level, format=LOG_FORMAT)
@@ -47,7 +147,21 @@ class SCP:
         self.ae = None
 
         self.established_assoc_objs = {}  # container for finished associations
-        self.released_assoc_objs = queue.Queue()  # container for finished associations. Should be reached through self.get_incoming()
+        # container for finished associations. Should be reached through self.get_incoming_queue()
+        # Pass a SpoolQueue to hand associations to daemons in other processes.
+        self.released_assoc_objs = incoming_queue if incoming_queue is not None else queue.Queue()
+
+        # Recently received instances. Resent instances are hard linked to their earlier copy when given.
+        self.instance_index = instance_index
+
+        # Accepted transfer syntaxes in order of preference. Compressed ones are stored compressed.
+        self.transfer_syntaxes = transfer_syntaxes or SCP_TRANSFER_SYNTAXES
+
+        # Largest P-DATA PDU the SCP accepts. 0 for no limit, so senders may use PDUs as large as they like.
+        self.maximum_pdu_size = maximum_pdu_size
+
+        # Records metadata of every released association for benchmarks.replay. Off when None.
+        self.trace = trace
 
     def __del__(self):
         if self.ae:
@@ -57,63 +171,94 @@ class SCP:
     def get_incoming_queue(self):
         return self.released_assoc_objs
 
-    @log
-    def update_assoc_obj(self, event, series_instance_uid, study_description, series_description,
-                         sop_class_uid):
-
+    def get_assoc_record(self, event) -> AssocRecord:
         # Thread id of incoming
         assoc_id = event.assoc.native_id
+        record = self.established_assoc_objs.get(assoc_id)
+        if record is None:
+            logging.info("Inserting assoc_id: %s to established_assoc_objs", assoc_id)
+            record = AssocRecord(assoc_id=str(assoc_id),
+                                 timestamp=datetime.datetime.now(),
+                                 path=os.path.join(self.temporary_storage, str(assoc_id)))
+            self.established_assoc_objs[assoc_id] = record
+        return record
 
-        # If top level assoc obj does not exist, create it
-        if assoc_id not in self.established_assoc_objs.keys():
-            logging.info(f"Inserting assoc_id: {assoc_id} to established_assoc_objs")
-            self.established_assoc_objs[assoc_id] = Assoc(assoc_id=assoc_id,
-                                                          timestamp=datetime.datetime.now(),
-                                                          series_instances={},
-                                                          path=os.path.join(self.temporary_storage, str(assoc_id)))
+    def update_assoc_obj(self, event, ds) -> SeriesRecord:
+        """
+        :return: the SeriesRecord ds belongs to. Only the first instance of a series reads the descriptions and
+        creates the series folder.
+        """
+        assoc_record = self.get_assoc_record(event)
+        series_instance_uid = ds.get("SeriesInstanceUID", "None")
+        series_record = assoc_record.series_records.get(series_instance_uid)
+        if series_record is not None:
+            return series_record
+
+        logging.info("Inserting series_instance_uid: %s on assoc_id: %s to established_assoc_objs",
+                     series_instance_uid, assoc_record.assoc_id)
+        sop_class_uid = ds.get("SOPClassUID", "None")
+        series_record = SeriesRecord(series_instance_uid=series_instance_uid,
+                                     study_description=ds.get("StudyDescription", "None"),
+                                     series_description=ds.get("SeriesDescription", "None"),
+                                     sop_class_uid=sop_class_uid,
+                                     path=os.path.join(assoc_record.path, sop_class_uid, series_instance_uid),
+                                     study_instance_uid=ds.get("StudyInstanceUID", "None"))
+        os.makedirs(series_record.path, exist_ok=True)
+        assoc_record.series_records[series_instance_uid] = series_record
+        return series_record
 
-        ## If not SeriesInstance exist in self.assoc_obj.series_instances.keys()
-        if series_instance_uid not in self.established_assoc_objs[assoc_id].series_instances.keys():
-            logging.info(
-                f"Inserting series_instance_uid: {series_instance_uid} on assoc_id: {assoc_id} to established_assoc_objs")
-            self.established_assoc_objs[assoc_id].series_instances[series_instance_uid] = SeriesInstance(
-                series_instance_uid=series_instance_uid,
-                study_description=study_description,
-                series_description=series_description,
-                sop_class_uid=sop_class_uid,
-                path=os.path.join(self.established_assoc_objs[assoc_id].path, sop_class_uid, series_instance_uid)
-            )
-        return self.established_assoc_objs[assoc_id]
     @log
     def handle_store(self, event):
         """Handle EVT_C_STORE events."""
-        assoc_id = event.assoc.native_id
-        # Get data set from event
+        # Get data set from event. Only read for series bookkeeping
         ds = event.dataset
-
-        # Add the File Meta Information
-        ds.file_meta = event.file_meta
-        series_instance_uid = ds.get("SeriesInstanceUID", "None")
-        self.update_assoc_obj(event=event,
-                              series_instance_uid=series_instance_uid,
-                              study_description=ds.get("StudyDescription", "None"),
-                              series_description=ds.get("SeriesDescription", "None"),
-                              sop_class_uid=ds.get("SOPClassUID", "None")
-                              )
+        series_record = self.update_assoc_obj(event=event, ds=ds)
 
         # Save the dataset using the SOP Instance UID as the filename
-        series_instance_folder = os.path.join(
-            self.established_assoc_objs[assoc_id].series_instances[series_instance_uid].path)
-        os.makedirs(series_instance_folder, exist_ok=True)
-        ds.save_as(os.path.join(series_instance_folder, ds.SOPInstanceUID + ".dcm"), write_like_original=False)
+        sop_instance_uid = event.request.AffectedSOPInstanceUID
+        path = os.path.join(series_record.path, sop_instance_uid + ".dcm")
+        if self.instance_index is None:
+            write_encoded(path, event)
+        else:
+            encoded = encoded_dataset(event)
+            digest = content_hash(encoded)
+            if self.link_duplicate(sop_instance_uid, digest, path):
+                series_record.duplicate_count += 1
+            else:
+                write_encoded(path, event, encoded)
+            self.instance_index.put(sop_instance_uid, digest, path)
+        series_record.instance_count += 1
+        series_record.bytes += encoded_size(event)
 
         # Return a 'Success' status
         return 0x0000
+
+    def link_duplicate(self, sop_instance_uid: str, digest: str, path: str) -> bool:
+        """
+        :return: True if an identical copy of the instance was received before and is now hard linked to path
+        """
+        known = self.instance_index.get(sop_instance_uid)
+        if known is None or known[0] != digest:
+            return False
+        known_path = known[1]
+        if known_path == path:  # Resent on the same association
+            return os.path.isfile(path)
+        try:
+            os.link(known_path, path)
+        except OSError:  # Earlier copy is gone, on another volume or path is taken. Write it again
+            return False
+        return True
+
     @log
     def handle_release(self, event):
-        logging.debug(f"Length of self.established_assoc_objs: {len(self.established_assoc_objs)}")
-        self.released_assoc_objs.put(self.established_assoc_objs[event.assoc.native_id], block=True)
-        del self.established_assoc_objs[event.assoc.native_id]
+        logging.debug("Length of self.established_assoc_objs: %s", len(self.established_assoc_objs))
+        record = self.established_assoc_objs.pop(event.assoc.native_id, None)
+        if record is None:  # Nothing was stored, e.g. a C-ECHO
+            return
+        assoc = record.to_assoc()
+        if self.trace is not None:
+            self.trace.association(assoc, released=datetime.datetime.now())
+        self.released_assoc_objs.put(assoc, block=True)
 
     @log
     def run_scp(self, blocking=True):
@@ -128,8 +273,9 @@ class SCP:
 
             # Create and run
             self.ae = AE(ae_title=self.ae_title)
-            self.ae.supported_contexts = StoragePresentationContexts
-            self.ae.maximum_pdu_size = 0
+            self.ae.supported_contexts = [build_context(cx.abstract_syntax, self.transfer_syntaxes)
+                                          for cx in StoragePresentationContexts]
+            self.ae.maximum_pdu_size = self.maximum_pdu_size
             self.ae.start_server((self.ip, self.port), block=blocking, evt_handlers=handler)
 
         except OSError as ose:
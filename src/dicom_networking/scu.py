@@ -1,43 +1,142 @@
 import logging
 import os
+from pathlib import Path
+from typing import List, NamedTuple, Dict
 
 from pydicom import dcmread
 from pydicom.errors import InvalidDicomError
-from pynetdicom import AE, StoragePresentationContexts
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pynetdicom import AE, _config, build_context
+from pynetdicom.dsutils import split_dataset
+from pynetdicom.presentation import PresentationContext
+
+MAX_CONTEXTS = 128  # Presentation contexts per association (DICOM PS3.8)
+UNCOMPRESSED = [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+
+
+class DicomFile(NamedTuple):
+    path: str
+    sop_class_uid: str
+    transfer_syntax_uid: str
+
+
+def scan_folder(dicom_dir) -> List[DicomFile]:
+    """
+    Reads only the file meta information of every file below dicom_dir. Files which are not DICOM files or lack
+    the file meta needed to send them as they are, are skipped.
+    """
+    dicom_files = []
+    for fol, subs, files in os.walk(dicom_dir):
+        for file in files:
+            p = os.path.join(fol, file)
+            try:
+                file_meta, _ = split_dataset(Path(p))
+            except (InvalidDicomError, EOFError):
+                logging.debug(f"Skipping {p}. Not a DICOM file")
+                continue
+
+            sop_class_uid = file_meta.get("MediaStorageSOPClassUID")
+            transfer_syntax_uid = file_meta.get("TransferSyntaxUID")
+            if not sop_class_uid or not transfer_syntax_uid or "MediaStorageSOPInstanceUID" not in file_meta:
+                logging.warning(f"Skipping {p}. Incomplete file meta information")
+                continue
+            dicom_files.append(DicomFile(path=p, sop_class_uid=sop_class_uid, transfer_syntax_uid=transfer_syntax_uid))
+    return dicom_files
+
+
+def group_by_contexts(dicom_files: List[DicomFile]) -> List[List[DicomFile]]:
+    """
+    Splits dicom_files into groups which fit in one association each. Every SOP class gets a context for each of
+    its transfer syntaxes, so files are sent as stored, and one uncompressed context to fall back on.
+    """
+    by_sop_class: Dict[str, Dict[str, List[DicomFile]]] = {}
+    for f in dicom_files:
+        by_sop_class.setdefault(f.sop_class_uid, {}).setdefault(f.transfer_syntax_uid, []).append(f)
+
+    groups, group, contexts = [], [], 0
+    for sop_class_uid, by_transfer_syntax in by_sop_class.items():
+        needed = len(by_transfer_syntax) + 1
+        if group and contexts + needed > MAX_CONTEXTS:
+            groups.append(group)
+            group, contexts = [], 0
+        for files in by_transfer_syntax.values():
+            group += files
+        contexts += needed
+    if group:
+        groups.append(group)
+    return groups
+
+
+def requested_contexts(dicom_files: List[DicomFile]) -> List[PresentationContext]:
+    contexts = []
+    for sop_class_uid in dict.fromkeys(f.sop_class_uid for f in dicom_files):
+        for transfer_syntax_uid in dict.fromkeys(f.transfer_syntax_uid for f in dicom_files
+                                                 if f.sop_class_uid == sop_class_uid):
+            contexts.append(build_context(sop_class_uid, transfer_syntax_uid))
+        contexts.append(build_context(sop_class_uid, UNCOMPRESSED))
+    return contexts
+
+
+def send_file(assoc, dicom_file: DicomFile):
+    """
+    Sends the file as stored when the peer accepted its transfer syntax, else decoded and uncompressed.
+    :return: the C-STORE response status as send_c_store, None if the file could not be sent
+    """
+    # send_c_store(path) streams the encoded dataset from the file instead of decoding and re-encoding it.
+    # Only affects sends of paths. Datasets are sent as before.
+    _config.STORE_SEND_CHUNKED_DATASET = True
+    try:
+        return assoc.send_c_store(dicom_file.path)  # Raw bytes, as stored
+    except ValueError:
+        pass
+
+    # The peer did not accept the stored transfer syntax. pynetdicom sends an uncompressed dataset in any accepted
+    # uncompressed transfer syntax, but does not decompress, so compressed pixel data is decompressed here.
+    logging.debug(f"Converting {dicom_file.path} from {dicom_file.transfer_syntax_uid}")
+    ds = dcmread(dicom_file.path)
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        try:
+            ds.decompress()
+        except Exception as e:  # No pixel data handler for the transfer syntax
+            logging.error(f"Skipping {dicom_file.path}. Cannot decompress {dicom_file.transfer_syntax_uid}: {e}")
+            return None
+    try:
+        return assoc.send_c_store(ds)
+    except ValueError as e:  # Still no accepted context, e.g. the peer accepted nothing for the SOP class
+        logging.error(f"Skipping {dicom_file.path}: {e}")
+        return None
 
 
 def post_folder_to_dicom_node(scu_ip, scu_port, scu_ae_title, dicom_dir) -> bool:
-    ae = AE()
-    ae.requested_contexts = StoragePresentationContexts
+    """
+    :return: False if an association was not established or a file could not be sent
+    """
+    sent_all = True
+    for dicom_files in group_by_contexts(scan_folder(dicom_dir)) or [[]]:
+        ae = AE()
+        ae.requested_contexts = requested_contexts(dicom_files) or [build_context("1.2.840.10008.1.1")]  # Verification
+
+        assoc = ae.associate(scu_ip, scu_port, ae_title=scu_ae_title)
+        if not assoc.is_established:
+            logging.error('Association rejected, aborted or never connected')
+            return False
 
-    assoc = ae.associate(scu_ip, scu_port, ae_title=scu_ae_title)
-    if assoc.is_established:
         # Use the C-STORE service to send the dataset
         # returns the response status as a pydicom Dataset
-        logging.info(f'Posting {dicom_dir} to {scu_ae_title} on: {scu_ip}:{scu_port}')
-        for fol, subs, files in os.walk(dicom_dir):
-            for file in files:
-                p = os.path.join(fol, file)
-                try:
-                    ds = dcmread(p)
-                    status = assoc.send_c_store(ds)
-                    # Check the status of the storage request
-                    if status:
-                        pass
-                        # If the storage request succeeded this will be 0x0000
-                        # logging.info('C-STORE request status: 0x{0:04x}'.format(status.Status))
-                    else:
-                        logging.info('Connection timed out, was aborted or received invalid response')
-
-                except InvalidDicomError as e:
-                    pass
-                except Exception as e:
-                    logging.error(str(e))
-                    raise e
+        logging.info(f'Posting {len(dicom_files)} files of {dicom_dir} to {scu_ae_title} on: {scu_ip}:{scu_port}')
+        try:
+            for dicom_file in dicom_files:
+                status = send_file(assoc, dicom_file)
+                # Check the status of the storage request. If it succeeded this will be 0x0000
+                if status is None:
+                    sent_all = False
+                elif not status:
+                    logging.info('Connection timed out, was aborted or received invalid response')
+        except Exception as e:
+            logging.error(str(e))
+            assoc.abort()
+            raise e
 
         # Release the association
         assoc.release()
-        return True
-    else:
-        logging.error('Association rejected, aborted or never connected')
-        return False
\ No newline at end of file
+    return sent_all
@@ -0,0 +1,89 @@
+import collections
+import logging
+import os
+import queue
+import secrets
+import time
+from typing import Union
+
+from dicom_networking.scp import Assoc
+
+
+class SpoolQueue:
+    """
+    Directory backed stand-in for queue.Queue of released Assoc objects. Lets a receiver process hand associations
+    to worker processes on the same host. Items are claimed with an atomic rename, so every item is handed out to
+    exactly one consumer even with several worker processes.
+
+    Claimed items stay in claimed/ until the consumer calls task_done(), as with queue.Queue. Items a crashed
+    consumer never finished are put back in the queue by the next SpoolQueue created on the path once they have
+    been claimed for stale_after seconds.
+    """
+    def __init__(self, path: str, poll_interval: float = 0.2, stale_after: Union[float, None] = 600):
+        self.path = path
+        self.claimed_path = os.path.join(self.path, "claimed")
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after  # Should outlast the slowest consumer of an item. Never requeue when None
+        self.unfinished = collections.deque()  # Paths of items claimed by this instance, in order of get()
+        os.makedirs(self.claimed_path, exist_ok=True)
+        if self.stale_after is not None:
+            self.requeue_stale()
+
+    def put(self, assoc: Assoc, block=True, timeout=None):
+        name = f"{time.time_ns()}-{secrets.token_hex(4)}.json"
+        tmp_path = os.path.join(self.path, f".{name}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(assoc.json())
+        os.replace(tmp_path, os.path.join(self.path, name))  # Never expose half written files
+
+    def pending(self):
+        return sorted([f for f in os.listdir(self.path) if f.endswith(".json")])
+
+    def get(self, block=True, timeout: Union[float, None] = None) -> Assoc:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for name in self.pending():
+                claimed = os.path.join(self.claimed_path, name)
+                try:
+                    os.rename(os.path.join(self.path, name), claimed)
+                except FileNotFoundError:  # Claimed by someone else
+                    continue
+                os.utime(claimed)  # Time of the claim, for requeue_stale
+                with open(claimed) as f:
+                    assoc = Assoc.parse_raw(f.read())
+                self.unfinished.append(claimed)
+                return assoc
+
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise queue.Empty
+            time.sleep(self.poll_interval)
+
+    def empty(self) -> bool:
+        return len(self.pending()) == 0
+
+    def task_done(self):
+        """
+        Removes the oldest item returned by get() and not yet done. Call once the item is fully processed.
+        """
+        if not self.unfinished:
+            raise ValueError("task_done() called too many times")
+        os.remove(self.unfinished.popleft())
+
+    def requeue_stale(self) -> int:
+        """
+        Puts items claimed more than stale_after seconds ago back in the queue.
+        :return: number of items put back
+        """
+        requeued = 0
+        for name in os.listdir(self.claimed_path):
+            claimed = os.path.join(self.claimed_path, name)
+            try:
+                if time.time() - os.path.getmtime(claimed) < self.stale_after:
+                    continue
+                os.rename(claimed, os.path.join(self.path, name))
+            except FileNotFoundError:  # Finished or requeued by someone else
+                continue
+            requeued += 1
+        if requeued:
+            logging.warning(f"Requeued {requeued} associations of {self.path} which were never finished")
+        return requeued
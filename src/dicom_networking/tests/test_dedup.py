@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dicom_networking.dedup import InstanceIndex, content_hash
+
+
+class TestInstanceIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "index", "instances.db")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_and_get(self):
+        index = InstanceIndex(self.path)
+        self.assertIsNone(index.get("1.2.3"))
+        index.put("1.2.3", content_hash(b"dataset"), "/a/1.2.3.dcm")
+        self.assertEqual((content_hash(b"dataset"), "/a/1.2.3.dcm"), index.get("1.2.3"))
+
+        index.put("1.2.3", content_hash(b"dataset"), "/b/1.2.3.dcm")  # Latest copy wins
+        self.assertEqual("/b/1.2.3.dcm", index.get("1.2.3")[1])
+        self.assertEqual(1, len(index))
+
+    def test_persistent(self):
+        index = InstanceIndex(self.path)
+        index.put("1.2.3", content_hash(b"dataset"), "/a/1.2.3.dcm")
+        index.close()
+        self.assertIsNotNone(InstanceIndex(self.path).get("1.2.3"))
+
+    def test_bounded(self):
+        index = InstanceIndex(self.path, max_entries=10, eviction_chunk=5)
+        for i in range(25):
+            index.put(f"1.2.{i}", content_hash(str(i).encode()), f"/a/{i}.dcm")
+            self.assertLessEqual(len(index), 10)
+        self.assertIsNone(index.get("1.2.0"))  # Oldest are evicted first
+        self.assertIsNotNone(index.get("1.2.24"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,10 @@ from io import BytesIO
 from multiprocessing.pool import ThreadPool
 
 import requests
+from pydicom import dcmread
+from pydicom.uid import DeflatedExplicitVRLittleEndian, JPEGLSLossless
 
+from dicom_networking.dedup import InstanceIndex
 from dicom_networking.scp import SCP
 from dicom_networking.scu import post_folder_to_dicom_node
 
@@ -64,6 +67,59 @@ class TestSCP(unittest.TestCase):
         t.join()
         self.assertGreater(len(os.listdir(self.tmp_source)), 0)
 
+    def test_released_assoc_counts_instances_and_bytes(self):
+        self.assertTrue(post_folder_to_dicom_node(scu_ip=self.scp.ip, scu_port=self.scp.port,
+                                                  scu_ae_title=self.scp.ae_title, dicom_dir=self.ct_test))
+        assoc = self.scp.get_incoming_queue().get(timeout=10)
+        self.assertEqual(self.scp.established_assoc_objs, {})
+        for series_instance in assoc.series_instances.values():
+            files = os.listdir(series_instance.path)
+            self.assertEqual(series_instance.instance_count, len(files))
+            self.assertGreater(series_instance.bytes, 0)
+
+    def test_resent_instances_are_linked_and_flagged(self):
+        self.scp.instance_index = InstanceIndex(os.path.join(self.tmp_dir, "instances.db"))
+        post = dict(scu_ip=self.scp.ip, scu_port=self.scp.port, scu_ae_title=self.scp.ae_title, dicom_dir=self.ct_test)
+
+        self.assertTrue(post_folder_to_dicom_node(**post))
+        first = self.scp.get_incoming_queue().get(timeout=10)
+        self.assertFalse(first.duplicate)
+
+        self.assertTrue(post_folder_to_dicom_node(**post))
+        second = self.scp.get_incoming_queue().get(timeout=10)
+        self.assertTrue(second.duplicate)
+        for series_instance in second.series_instances.values():
+            self.assertEqual(series_instance.instance_count, series_instance.duplicate_count)
+            first_path = first.series_instances[series_instance.series_instance_uid].path
+            for name in os.listdir(series_instance.path):  # Hard links to the first copy
+                self.assertTrue(os.path.samefile(os.path.join(series_instance.path, name),
+                                                 os.path.join(first_path, name)))
+
+    def test_received_transfer_syntax_is_preserved(self):
+        source = os.path.join(self.tmp_dir, "deflated")
+        os.makedirs(source)
+        source_path = os.path.join(source, "0.dcm")
+        ds = dcmread(os.path.join(self.ct_test, sorted(os.listdir(self.ct_test))[0]))
+        ds.file_meta.TransferSyntaxUID = DeflatedExplicitVRLittleEndian
+        ds.save_as(source_path, write_like_original=False)
+
+        self.assertTrue(post_folder_to_dicom_node(scu_ip=self.scp.ip, scu_port=self.scp.port,
+                                                  scu_ae_title=self.scp.ae_title, dicom_dir=source))
+        assoc = self.scp.get_incoming_queue().get(timeout=10)
+        series_instance = list(assoc.series_instances.values())[0]
+        stored_path = os.path.join(series_instance.path, os.listdir(series_instance.path)[0])
+
+        stored = dcmread(stored_path)
+        self.assertEqual(DeflatedExplicitVRLittleEndian, stored.file_meta.TransferSyntaxUID)
+        self.assertEqual(ds.SOPInstanceUID, stored.SOPInstanceUID)
+        with open(source_path, "rb") as f, open(stored_path, "rb") as g:  # Same encoded dataset after file meta
+            self.assertTrue(f.read().endswith(g.read()[-series_instance.bytes:]))
+
+    def test_compressed_transfer_syntaxes_are_accepted(self):
+        for cx in self.scp.ae.supported_contexts:
+            self.assertIn(JPEGLSLossless, cx.transfer_syntax)
+            self.assertEqual(self.scp.transfer_syntaxes, cx.transfer_syntax)
+
 
 if __name__ == '__main__':
     unittest.main()
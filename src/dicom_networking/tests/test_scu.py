@@ -0,0 +1,95 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from pydicom import dcmread
+from pydicom.encaps import encapsulate
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian, JPEGLSLossless
+
+from dicom_networking.scp import SCP
+from dicom_networking.scu import post_folder_to_dicom_node, scan_folder, group_by_contexts, DicomFile, \
+    MAX_CONTEXTS
+
+
+class TestSCU(unittest.TestCase):
+    def setUp(self) -> None:
+        os.makedirs(".tmp", exist_ok=True)
+        self.tmp_dir = tempfile.mkdtemp(dir=".tmp", prefix=f"{datetime.datetime.now()}_")
+        self.ct_test = ".tmp/test_images/ct"
+
+        self.source = os.path.join(self.tmp_dir, "source")
+        shutil.copytree(self.ct_test, self.source)
+        with open(os.path.join(self.source, "README.txt"), "w") as f:
+            f.write("Not DICOM")
+
+        self.scp = SCP(ae_title="DESTINATION",
+                       ip="localhost",
+                       port=11112,
+                       temporary_storage=os.path.join(self.tmp_dir, "destination"),
+                       pynetdicom_log_level="Normal",
+                       log_level=20)
+        self.scp.run_scp(blocking=False)
+
+    def tearDown(self) -> None:
+        self.scp.ae.shutdown()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_scan_folder_skips_non_dicom(self):
+        dicom_files = scan_folder(self.source)
+        self.assertNotIn("README.txt", [os.path.basename(f.path) for f in dicom_files])
+        self.assertEqual(len(os.listdir(self.source)) - 1, len(dicom_files))
+
+    def test_post_folder_without_decoding(self):
+        with mock.patch("dicom_networking.scu.dcmread", side_effect=AssertionError("Decoded a dataset")):
+            self.assertTrue(post_folder_to_dicom_node(scu_ip=self.scp.ip,
+                                                      scu_port=self.scp.port,
+                                                      scu_ae_title=self.scp.ae_title,
+                                                      dicom_dir=self.source))
+        assoc = self.scp.get_incoming_queue().get(timeout=10)
+        self.assertEqual(len(scan_folder(self.source)),
+                         sum(s.instance_count for s in assoc.series_instances.values()))
+
+    def test_post_folder_converts_or_skips_unaccepted_transfer_syntaxes(self):
+        uncompressed_scp = SCP(ae_title="UNCOMPRESSED",
+                               ip="localhost",
+                               port=11113,
+                               temporary_storage=os.path.join(self.tmp_dir, "uncompressed"),
+                               transfer_syntaxes=[ExplicitVRLittleEndian, ImplicitVRLittleEndian],
+                               log_level=20)
+        uncompressed_scp.run_scp(blocking=False)
+        try:
+            ds = dcmread(os.path.join(self.ct_test, sorted(os.listdir(self.ct_test))[0]))
+            for transfer_syntax, sent in [(DeflatedExplicitVRLittleEndian, True), (JPEGLSLossless, False)]:
+                folder = os.path.join(self.tmp_dir, transfer_syntax.keyword)
+                os.makedirs(folder)
+                ds.file_meta.TransferSyntaxUID = transfer_syntax
+                if transfer_syntax.is_compressed:
+                    ds.PixelData = encapsulate([ds.PixelData])  # Not valid JPEG-LS, but never decoded
+                    ds["PixelData"].is_undefined_length = True
+                ds.save_as(os.path.join(folder, "0.dcm"), write_like_original=False)
+
+                # Deflated is decoded and sent uncompressed. JPEG-LS cannot be decompressed here and is skipped
+                self.assertEqual(sent, post_folder_to_dicom_node(scu_ip=uncompressed_scp.ip,
+                                                                 scu_port=uncompressed_scp.port,
+                                                                 scu_ae_title=uncompressed_scp.ae_title,
+                                                                 dicom_dir=folder))
+            assoc = uncompressed_scp.get_incoming_queue().get(timeout=10)
+            self.assertEqual(1, sum(s.instance_count for s in assoc.series_instances.values()))
+            self.assertTrue(uncompressed_scp.get_incoming_queue().empty())  # Nothing stored from the skipped file
+        finally:
+            uncompressed_scp.ae.shutdown()
+
+    def test_group_by_contexts(self):
+        dicom_files = [DicomFile(path=f"{i}.dcm", sop_class_uid=f"1.2.{i}", transfer_syntax_uid="1.2.840.10008.1.2.1")
+                       for i in range(100)]
+        groups = group_by_contexts(dicom_files)
+        self.assertEqual(2, len(groups))  # Two contexts per SOP class
+        self.assertLessEqual(len(groups[0]) * 2, MAX_CONTEXTS)
+        self.assertEqual(dicom_files, groups[0] + groups[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
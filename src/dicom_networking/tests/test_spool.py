@@ -0,0 +1,94 @@
+import datetime
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from dicom_networking.scp import Assoc, SeriesInstance
+from dicom_networking.spool import SpoolQueue
+
+
+def get_assoc(assoc_id: str) -> Assoc:
+    series_instance = SeriesInstance(series_instance_uid="1.2.3",
+                                     study_description="Interesting Study",
+                                     series_description="What a series",
+                                     sop_class_uid="1.2.840.10008.5.1.4.1.1.2",
+                                     path="path/to/1")
+    return Assoc(assoc_id=assoc_id,
+                 timestamp=datetime.datetime.now(),
+                 path="some/path",
+                 series_instances={series_instance.series_instance_uid: series_instance})
+
+
+class TestSpoolQueue(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = SpoolQueue(self.tmp_dir, poll_interval=0.01)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_get(self):
+        self.assertTrue(self.queue.empty())
+        assoc = get_assoc("1")
+        self.queue.put(assoc)
+        self.assertFalse(self.queue.empty())
+
+        echo = self.queue.get(timeout=1)
+        self.assertEqual(assoc, echo)
+        self.assertTrue(self.queue.empty())
+
+    def test_fifo(self):
+        for i in range(5):
+            self.queue.put(get_assoc(str(i)))
+        self.assertEqual([str(i) for i in range(5)], [self.queue.get().assoc_id for _ in range(5)])
+
+    def test_empty_raises(self):
+        self.assertRaises(queue.Empty, self.queue.get, timeout=0.05)
+        self.assertRaises(queue.Empty, self.queue.get, block=False)
+
+    def test_claimed_until_done(self):
+        self.queue.put(get_assoc("1"))
+        self.queue.get(timeout=1)
+        self.assertEqual(1, len(os.listdir(self.queue.claimed_path)))
+        self.queue.task_done()
+        self.assertEqual([], os.listdir(self.queue.claimed_path))
+        self.assertRaises(ValueError, self.queue.task_done)
+
+    def test_requeue_stale(self):
+        for i in range(2):
+            self.queue.put(get_assoc(str(i)))
+        self.queue.get(timeout=1)
+        self.queue.get(timeout=1)
+        self.queue.task_done()  # The second is never finished, as by a crashed worker
+
+        # Claimed recently, so possibly still in progress
+        self.assertTrue(SpoolQueue(self.tmp_dir, stale_after=600).empty())
+
+        restarted = SpoolQueue(self.tmp_dir, poll_interval=0.01, stale_after=0)
+        self.assertEqual("1", restarted.get(timeout=1).assoc_id)
+        self.assertTrue(restarted.empty())
+
+    def test_shared_between_consumers(self):
+        for i in range(50):
+            self.queue.put(get_assoc(str(i)))
+
+        def consume(_):
+            # Separate instances, as in separate worker processes
+            q = SpoolQueue(self.tmp_dir, poll_interval=0.01)
+            received = []
+            while True:
+                try:
+                    received.append(q.get(timeout=0.1).assoc_id)
+                except queue.Empty:
+                    return received
+
+        with ThreadPool(4) as pool:
+            received = sum(pool.map(consume, range(4)), [])
+        self.assertEqual(sorted([str(i) for i in range(50)]), sorted(received))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import datetime
+import hashlib
+import json
+import os
+import secrets
+import tempfile
+import threading
+from typing import Dict, Iterator, List
+
+SALT_SUFFIX = ".salt"
+SALT_BYTES = 16
+
+
+def load_salt(path: str) -> bytes:
+    """
+    Salt of the trace at path. Created on first use and shared by every process writing the trace, so a receiver
+    and its workers agree on keys. The salt is written to a temporary file and linked into place, so no process
+    ever reads a partly written one.
+    """
+    salt_path = path + SALT_SUFFIX
+    if not os.path.exists(salt_path):
+        salt = secrets.token_bytes(SALT_BYTES)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(salt_path)), prefix=".salt_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(salt)
+                f.flush()
+                os.fsync(f.fileno())
+            os.link(tmp_path, salt_path)  # Fails if another process got there first. Its salt is used then
+            return salt
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    with open(salt_path, "rb") as f:
+        salt = f.read()
+    if len(salt) != SALT_BYTES:
+        raise ValueError(f"Salt file {salt_path} is corrupt. Remove it together with the trace")
+    return salt
+
+
+class TraceWriter:
+    """
+    Appends ingest events to a json lines file for benchmarks.replay. Entries hold metadata only: timing, SOP classes,
+    instance counts and sizes, and fingerprint matches. UIDs are replaced by salted hashes, which tell series and
+    studies apart within a trace but can not be traced back. Descriptions are left out unless include_descriptions
+    is set, as they may hold patient data.
+    """
+    def __init__(self, path: str, include_descriptions: bool = False):
+        self.path = path
+        self.include_descriptions = include_descriptions
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.salt = load_salt(path)
+        self.lock = threading.Lock()
+
+    def key(self, value: str) -> str:
+        return hashlib.blake2b(value.encode(), key=self.salt, digest_size=8).hexdigest()
+
+    def association_key(self, assoc) -> str:
+        return self.key(f"{assoc.assoc_id}/{assoc.timestamp.isoformat()}")  # Thread ids of associations are reused
+
+    def write(self, entry: Dict):
+        line = json.dumps(entry) + "\n"
+        with self.lock, open(self.path, "a") as f:
+            f.write(line)
+
+    def association(self, assoc, released: datetime.datetime):
+        series = []
+        for series_instance in assoc.series_instances.values():
+            entry = {"study": self.key(series_instance.study_instance_uid),
+                     "series": self.key(series_instance.series_instance_uid),
+                     "sop_class_uid": series_instance.sop_class_uid,
+                     "instance_count": series_instance.instance_count,
+                     "bytes": series_instance.bytes,
+                     "duplicate_count": series_instance.duplicate_count}
+            if self.include_descriptions:
+                entry["study_description"] = series_instance.study_description
+                entry["series_description"] = series_instance.series_description
+            series.append(entry)
+
+        self.write({"type": "association",
+                    "association": self.association_key(assoc),
+                    "started": assoc.timestamp.isoformat(),
+                    "released": released.isoformat(),
+                    "series": series})
+
+    def match(self, assoc, fp, series_instances: List):
+        self.write({"type": "match",
+                    "time": datetime.datetime.now().isoformat(),
+                    "association": self.association_key(assoc),
+                    "fingerprint_id": fp.id,
+                    "fingerprint": fp.human_readable_id,
+                    "version": fp.version,
+                    "series": [self.key(series_instance.series_instance_uid) for series_instance in series_instances]})
+
+
+def read_trace(path: str) -> Iterator[Dict]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
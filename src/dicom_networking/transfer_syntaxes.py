@@ -0,0 +1,57 @@
+import io
+from pathlib import Path
+from typing import List, Union
+
+import pydicom.uid
+from pydicom import dcmread
+from pydicom.uid import UID, ExplicitVRLittleEndian, ImplicitVRLittleEndian, ExplicitVRBigEndian, JPEGLSLossless, JPEGLSNearLossless, JPEG2000Lossless, JPEG2000, RLELossless, \
+    JPEGLosslessSV1, JPEGBaseline8Bit, JPEGExtended12Bit
+from pynetdicom import DEFAULT_TRANSFER_SYNTAXES
+from pynetdicom.dsutils import split_dataset
+
+# Accepted by the SCP in this order of preference. The SCP picks the first of these a sender proposes.
+# Uncompressed first like pynetdicom's default, so senders proposing both keep sending as before.
+COMPRESSED_TRANSFER_SYNTAXES = [JPEGLSLossless, JPEG2000Lossless, RLELossless, JPEGLosslessSV1,
+                                JPEGLSNearLossless, JPEG2000, JPEGBaseline8Bit, JPEGExtended12Bit]
+SCP_TRANSFER_SYNTAXES = DEFAULT_TRANSFER_SYNTAXES + COMPRESSED_TRANSFER_SYNTAXES
+
+# What inference servers have always been sent
+UNCOMPRESSED_TRANSFER_SYNTAXES = [ImplicitVRLittleEndian, ExplicitVRLittleEndian, ExplicitVRBigEndian]
+
+
+def parse_transfer_syntaxes(value: Union[str, List[str]]) -> List[str]:
+    """
+    :param value: UIDs or pydicom keywords (e.g. JPEGLSLossless), as a list or comma separated
+    :raises ValueError: on names which are neither
+    """
+    if isinstance(value, str):
+        value = [v.strip() for v in value.split(",") if v.strip()]
+    transfer_syntaxes = []
+    for name in value:
+        uid = UID(getattr(pydicom.uid, name, name))
+        if not uid.is_transfer_syntax:
+            raise ValueError(f"Unknown transfer syntax {name}")
+        transfer_syntaxes.append(uid)
+    return transfer_syntaxes
+
+
+def is_uncompressed(path: str) -> bool:
+    """
+    Reads only the file meta of path.
+    """
+    file_meta, _ = split_dataset(Path(path))
+    return file_meta.get("TransferSyntaxUID") in UNCOMPRESSED_TRANSFER_SYNTAXES
+
+
+def to_uncompressed(path: str) -> bytes:
+    """
+    :return: the file at path in Explicit VR Little Endian. Compressed pixel data needs a pydicom pixel data handler
+    for its transfer syntax (e.g. pylibjpeg or gdcm).
+    """
+    ds = dcmread(path)
+    if ds.file_meta.TransferSyntaxUID.is_compressed:
+        ds.decompress()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    buffer = io.BytesIO()
+    ds.save_as(buffer, write_like_original=False)
+    return buffer.getvalue()
@@ -0,0 +1,127 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from typing import Dict, Tuple, Union
+
+TEXT_FORMAT = '%(levelname)s:%(asctime)s:%(message)s'
+
+# Attributes every LogRecord has. Anything else on a record came in through extra= and is logged as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per line with time, level, logger, thread and message, plus any fields passed with extra=.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per call site (logger, file and line), so a message logged for every instance or task in a burst
+    is capped at rate per second after the first burst records. The next record let through from a call site
+    carries the number of records dropped before it as suppressed.
+    """
+    def __init__(self, rate: float = 20, burst: int = 100, clock=time.monotonic):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets: Dict[Tuple, list] = {}  # Dict[call site: [tokens, last refill, suppressed]]
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.pathname, record.lineno)
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a QueueListener thread which formats and writes them. Unlike QueueHandler, records are not
+    formatted before they are queued, so messages are only built off the logging thread. Arguments must therefore
+    not be changed after they are logged. Records are dropped rather than blocking when the queue is full.
+    """
+    def __init__(self, queue_size: int = 10000):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level: int = logging.INFO,
+                  json_format: bool = True,
+                  rate: Union[float, None] = 20,
+                  burst: int = 100,
+                  queue_size: int = 10000,
+                  stream=None) -> logging.handlers.QueueListener:
+    """
+    Replaces the handlers of the root logger with an AsyncQueueHandler, rate limited per call site unless rate is
+    None, and starts the listener writing to stream (stderr by default). The listener is stopped, and the queue
+    flushed, on exit.
+    """
+    output = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    output.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    handler = AsyncQueueHandler(queue_size=queue_size)
+    if rate:
+        handler.addFilter(RateLimitFilter(rate=rate, burst=burst))
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_listener, listener)
+    return listener
+
+
+def stop_listener(listener: logging.handlers.QueueListener):
+    """
+    Writes out all queued records and stops the listener. Safe to call more than once.
+    """
+    if listener._thread is not None:
+        listener.stop()
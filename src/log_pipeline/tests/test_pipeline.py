@@ -0,0 +1,99 @@
+import io
+import json
+import logging
+import unittest
+
+from log_pipeline.pipeline import setup_logging, stop_listener, RateLimitFilter, AsyncQueueHandler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Unformattable:
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "unformattable"
+
+
+class TestLogPipeline(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = logging.getLogger()
+        self.saved = (list(self.root.handlers), self.root.level)
+        self.stream = io.StringIO()
+
+    def tearDown(self) -> None:
+        for h in list(self.root.handlers):
+            self.root.removeHandler(h)
+        handlers, level = self.saved
+        for h in handlers:
+            self.root.addHandler(h)
+        self.root.setLevel(level)
+
+    def lines(self):
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_json_records(self):
+        listener = setup_logging(level=logging.INFO, stream=self.stream)
+        logger = logging.getLogger("test_pipeline")
+        logger.info("Posted %s tasks", 3, extra={"fingerprint_id": 7})
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("Failed")
+        stop_listener(listener)
+        stop_listener(listener)
+
+        posted, failed = self.lines()
+        self.assertEqual("Posted 3 tasks", posted["message"])
+        self.assertEqual("INFO", posted["level"])
+        self.assertEqual("test_pipeline", posted["logger"])
+        self.assertEqual(7, posted["fingerprint_id"])
+        self.assertIn("ValueError: boom", failed["exc_info"])
+
+    def test_disabled_levels_are_not_formatted(self):
+        listener = setup_logging(level=logging.INFO, stream=self.stream)
+        arg = Unformattable()
+        logging.getLogger("test_pipeline").debug("Not shown %s", arg)
+        stop_listener(listener)
+        self.assertEqual(0, arg.formatted)
+        self.assertEqual([], self.lines())
+
+    def test_rate_limit_per_call_site(self):
+        clock = FakeClock()
+        rate_limit = RateLimitFilter(rate=1, burst=2, clock=clock)
+
+        def record(lineno):
+            return logging.LogRecord("test", logging.INFO, "file.py", lineno, "msg", (), None)
+
+        self.assertEqual([True, True, False, False], [rate_limit.filter(record(1)) for _ in range(4)])
+        self.assertTrue(rate_limit.filter(record(2)))  # Other call sites have their own bucket
+
+        clock.now = 1
+        passed = record(1)
+        self.assertTrue(rate_limit.filter(passed))
+        self.assertEqual(2, passed.suppressed)
+        self.assertFalse(rate_limit.filter(record(1)))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = AsyncQueueHandler(queue_size=1)
+        records = [logging.LogRecord("test", logging.INFO, "file.py", 1, "msg", (), None) for _ in range(3)]
+        for r in records[:2]:
+            handler.handle(r)
+        self.assertEqual(1, handler.dropped)
+
+        handler.queue.get_nowait()
+        handler.handle(records[2])
+        self.assertEqual(1, records[2].dropped)
+        self.assertEqual(0, handler.dropped)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,77 +1,281 @@
 import logging
 import os
+import sys
 from typing import Union
 
-import uvicorn as uvicorn
-
-from api.fast_api import DicomNodeAPI
-from client.client import Client
-from daemon.daemon import Daemon
-
-from database.db import DB
-from dicom_networking.scp import SCP
+# Heavy dependencies are imported in the role that needs them, so e.g. a receiver does not load fastapi and
+# sqlalchemy, and an API process does not load pynetdicom.
+ROLES = ["all", "receiver", "worker", "api"]
 
 
 class Main:
     def __init__(self,
+                 ROLE: str = "all",
+                 INCOMING_QUEUE_DIR: str = "/opt/app/queue",
                  SCP_IP: str = "localhost",
                  SCP_PORT: int = 10000,
                  SCP_AE_TITLE: str = "DICOM_RECEIVER",
+                 SCP_TRANSFER_SYNTAXES: Union[str, None] = None,
+                 SCP_MAXIMUM_PDU_SIZE: int = 0,
                  TEMPORARY_STORAGE: str = "/opt/app/DICOM",
+                 DEDUP_INDEX_PATH: Union[str, None] = None,
+                 DEDUP_MAX_ENTRIES: int = 1000000,
+                 SKIP_DUPLICATE_ASSOCIATIONS: bool = False,
+                 INGEST_TRACE_PATH: Union[str, None] = None,
+                 INGEST_TRACE_DESCRIPTIONS: bool = False,
+                 CATALOG_BATCH_SIZE: int = 100,
                  LOG_LEVEL: int = 20,
+                 LOG_FORMAT: str = "json",
+                 LOG_RATE_LIMIT: float = 20,
+                 LOG_RATE_BURST: int = 100,
                  PYNETDICOM_LOG_LEVEL: str = "Normal",
                  DAEMON_RUN_INTERVAL: int = 10,
+                 REGEX_ENGINE: str = "re",
+                 POLL_MAX_INTERVAL: int = 600,
+                 CALLBACK_URL: Union[str, None] = None,
+                 CALLBACK_FALLBACK_POLL_INTERVAL: int = 300,
                  CERT_FILE: Union[str, bool] = "/opt/app/cert.crt",
+                 ASYNC_CLIENT: bool = True,
+                 MAX_CONCURRENT_REQUESTS: int = 32,
+                 WORKER_ID: Union[str, None] = None,
+                 LEASE_DURATION: int = 600,
+                 PRIORITY_AGING_INTERVAL: int = 600,
+                 ROUTING_STRATEGY: str = "least_outstanding",
+                 CONNECT_TIMEOUT: float = 10,
+                 READ_TIMEOUT: float = 600,
+                 CIRCUIT_FAILURE_THRESHOLD: int = 3,
+                 CIRCUIT_RESET_TIMEOUT: float = 30,
                  TIMEOUT: int = 7200,
                  DB_BASEDIR: str = "/opt/app/database",
+                 DATA_DIR: Union[str, None] = None,
+                 BULK_STORAGE: Union[str, None] = None,
+                 STORAGE_HIGH_WATERMARK: float = 0.8,
+                 STORAGE_LOW_WATERMARK: float = 0.6,
+                 STORAGE_MAX_AGE: int = 86400,
+                 RESULT_CACHE_DIR: Union[str, None] = None,
+                 RESULT_CACHE_MAX_BYTES: int = 10 * 1024 ** 3,
+                 RESULT_CACHE_MAX_AGE: int = 7 * 86400,
+                 API_HOST: str = "localhost",
                  API_PORT: int = 8124):
+        self.ROLE = ROLE  # One of ROLES. Receiver and worker processes share associations through INCOMING_QUEUE_DIR
+        self.INCOMING_QUEUE_DIR = INCOMING_QUEUE_DIR
         self.SCP_IP = SCP_IP
         self.SCP_PORT = SCP_PORT
         self.SCP_AE_TITLE = SCP_AE_TITLE
+        # Comma separated UIDs or pydicom keywords in order of preference, e.g. "JPEGLSLossless,ExplicitVRLittleEndian"
+        # Defaults to uncompressed first, then JPEG-LS, JPEG 2000, RLE and JPEG.
+        self.SCP_TRANSFER_SYNTAXES = SCP_TRANSFER_SYNTAXES
+        self.SCP_MAXIMUM_PDU_SIZE = SCP_MAXIMUM_PDU_SIZE  # Bytes. 0 for unlimited. See benchmarks.scp_load
         self.TEMPORARY_STORAGE= TEMPORARY_STORAGE
+        self.DEDUP_INDEX_PATH = DEDUP_INDEX_PATH  # e.g. /opt/app/database/instances.db. Resends are hard linked
+        self.DEDUP_MAX_ENTRIES = DEDUP_MAX_ENTRIES
+        self.SKIP_DUPLICATE_ASSOCIATIONS = SKIP_DUPLICATE_ASSOCIATIONS  # Ignore associations only holding resends
+        # Metadata only trace of received associations and fingerprint matches. Replay with benchmarks.replay
+        self.INGEST_TRACE_PATH = INGEST_TRACE_PATH
+        self.INGEST_TRACE_DESCRIPTIONS = INGEST_TRACE_DESCRIPTIONS  # Study and series descriptions may hold PHI
+        self.CATALOG_BATCH_SIZE = CATALOG_BATCH_SIZE  # Released associations written to the series catalog at once
         self.LOG_LEVEL = LOG_LEVEL
+        self.LOG_FORMAT = LOG_FORMAT  # "json" for one json object per line, "text" for the classic format
+        # Records per second and call site, after a burst of LOG_RATE_BURST. 0 to log everything.
+        self.LOG_RATE_LIMIT = LOG_RATE_LIMIT
+        self.LOG_RATE_BURST = LOG_RATE_BURST
         self.PYNETDICOM_LOG_LEVEL=PYNETDICOM_LOG_LEVEL
         self.DAEMON_RUN_INTERVAL=DAEMON_RUN_INTERVAL
+        self.REGEX_ENGINE = REGEX_ENGINE  # "re2" for linear time trigger matching. Requires google-re2.
+        self.POLL_MAX_INTERVAL = POLL_MAX_INTERVAL
+        self.CALLBACK_URL = CALLBACK_URL  # e.g. http://this-node:8124/tasks/callback/. Must reach the API.
+        self.CALLBACK_FALLBACK_POLL_INTERVAL = CALLBACK_FALLBACK_POLL_INTERVAL
         self.CERT_FILE = CERT_FILE
+        self.ASYNC_CLIENT = ASYNC_CLIENT
+        self.MAX_CONCURRENT_REQUESTS = MAX_CONCURRENT_REQUESTS
+        self.WORKER_ID = WORKER_ID  # Unique per worker sharing DB_BASEDIR. Defaults to host, pid and a random suffix
+        self.LEASE_DURATION = LEASE_DURATION
+        self.PRIORITY_AGING_INTERVAL = PRIORITY_AGING_INTERVAL  # Waiting tasks gain one priority step per interval
+        self.ROUTING_STRATEGY = ROUTING_STRATEGY  # "least_outstanding" or "weighted" over a fingerprint's endpoints
+        self.CONNECT_TIMEOUT = CONNECT_TIMEOUT  # Seconds. Requests to inference servers
+        self.READ_TIMEOUT = READ_TIMEOUT
+        # Inference servers failing this many requests in a row are skipped, and probed every CIRCUIT_RESET_TIMEOUT
+        # seconds (doubling while they stay down) until they answer again
+        self.CIRCUIT_FAILURE_THRESHOLD = CIRCUIT_FAILURE_THRESHOLD
+        self.CIRCUIT_RESET_TIMEOUT = CIRCUIT_RESET_TIMEOUT
         self.TIMEOUT=TIMEOUT
         self.DB_BASEDIR = DB_BASEDIR
+        # Storage tiers. Put TEMPORARY_STORAGE and DATA_DIR (task tars) on fast storage and set BULK_STORAGE to
+        # move finished tasks there. DATA_DIR defaults to DB_BASEDIR/data
+        self.DATA_DIR = DATA_DIR
+        self.BULK_STORAGE = BULK_STORAGE
+        self.STORAGE_HIGH_WATERMARK = STORAGE_HIGH_WATERMARK
+        self.STORAGE_LOW_WATERMARK = STORAGE_LOW_WATERMARK
+        self.STORAGE_MAX_AGE = STORAGE_MAX_AGE
+        self.RESULT_CACHE_DIR = RESULT_CACHE_DIR  # Reuse outputs of identical inputs to the same fingerprint version
+        self.RESULT_CACHE_MAX_BYTES = RESULT_CACHE_MAX_BYTES
+        self.RESULT_CACHE_MAX_AGE = RESULT_CACHE_MAX_AGE
+        self.API_HOST = API_HOST
         self.API_PORT = API_PORT
 
         for name in self.__dict__.keys():
             if name in os.environ.keys():
                 self.__setattr__(name, os.environ[name])
-        LOG_FORMAT = '%(levelname)s:%(asctime)s:%(message)s'
-
-        logging.basicConfig(level=int(self.LOG_LEVEL), format=LOG_FORMAT)
+        params = dict(self.__dict__)
+        from log_pipeline.pipeline import setup_logging
+        # Records are formatted and written on a listener thread, so logging never blocks receiving or the daemon
+        self.log_listener = setup_logging(level=int(self.LOG_LEVEL),
+                                          json_format=self.LOG_FORMAT == "json",
+                                          rate=float(self.LOG_RATE_LIMIT),
+                                          burst=int(self.LOG_RATE_BURST))
         self.logger = logging.getLogger(__name__)
-        self.logger.info(f"Instantiated Dicom Node with params: {self.__dict__}")
+        self.logger.info("Instantiated Dicom Node with params: %s", params)
 
-    def run(self):
-        scp = SCP(ip=self.SCP_IP,
-                  port=int(self.SCP_PORT),
-                  ae_title=self.SCP_AE_TITLE,
-                  temporary_storage=self.TEMPORARY_STORAGE,
-                  log_level=self.LOG_LEVEL,
-                  pynetdicom_log_level=self.PYNETDICOM_LOG_LEVEL)
+        from database.patterns import set_default_engine
+        set_default_engine(self.REGEX_ENGINE)
 
-        scp.run_scp(blocking=False)
+    def run(self, role: Union[str, None] = None):
+        role = role or self.ROLE
+        self.logger.info(f"Running Dicom Node as: {role}")
+        if role == "receiver":
+            self.run_receiver()
+        elif role == "worker":
+            self.run_worker()
+        elif role == "api":
+            self.run_api()
+        elif role == "all":
+            self.run_all()
+        else:
+            raise ValueError(f"Unknown role {role}. Must be one of {ROLES}")
 
-        db = DB(base_dir=self.DB_BASEDIR)
-        client = Client(cert=self.CERT_FILE)
-        daemon = Daemon(client=client,
-                        scp=scp,
-                        db=db,
-                        run_interval=int(self.DAEMON_RUN_INTERVAL),
-                        timeout=int(self.TIMEOUT))
-        daemon.start()
+    def get_instance_index(self):
+        if not self.DEDUP_INDEX_PATH:
+            return None
+        from dicom_networking.dedup import InstanceIndex
+        return InstanceIndex(path=self.DEDUP_INDEX_PATH, max_entries=int(self.DEDUP_MAX_ENTRIES))
+
+    def get_trace(self):
+        if not self.INGEST_TRACE_PATH:
+            return None
+        from dicom_networking.trace import TraceWriter
+        return TraceWriter(path=self.INGEST_TRACE_PATH,
+                           include_descriptions=str(self.INGEST_TRACE_DESCRIPTIONS).lower() in ["true", "1"])
+
+    def get_scp(self, incoming_queue=None):
+        from dicom_networking.scp import SCP
+        from dicom_networking.transfer_syntaxes import parse_transfer_syntaxes
+        return SCP(ip=self.SCP_IP,
+                   port=int(self.SCP_PORT),
+                   ae_title=self.SCP_AE_TITLE,
+                   temporary_storage=self.TEMPORARY_STORAGE,
+                   log_level=self.LOG_LEVEL,
+                   pynetdicom_log_level=self.PYNETDICOM_LOG_LEVEL,
+                   incoming_queue=incoming_queue,
+                   instance_index=self.get_instance_index(),
+                   transfer_syntaxes=parse_transfer_syntaxes(self.SCP_TRANSFER_SYNTAXES)
+                   if self.SCP_TRANSFER_SYNTAXES else None,
+                   maximum_pdu_size=int(self.SCP_MAXIMUM_PDU_SIZE),
+                   trace=self.get_trace())
+
+    def get_spool_queue(self):
+        from dicom_networking.spool import SpoolQueue
+        return SpoolQueue(path=self.INCOMING_QUEUE_DIR, stale_after=int(self.LEASE_DURATION))
+
+    def get_db(self):
+        from database.db import DB
+        return DB(base_dir=self.DB_BASEDIR, data_dir=self.DATA_DIR)
+
+    def get_storage_tiers(self, db):
+        if not self.BULK_STORAGE:
+            return None
+        from daemon.storage import StorageTiers
+        return StorageTiers(fast_dir=db.data_dir,
+                            bulk_dir=self.BULK_STORAGE,
+                            high_watermark=float(self.STORAGE_HIGH_WATERMARK),
+                            low_watermark=float(self.STORAGE_LOW_WATERMARK),
+                            max_age=int(self.STORAGE_MAX_AGE))
+
+    def get_client(self):
+        if str(self.ASYNC_CLIENT).lower() in ["true", "1"]:
+            from client.async_client import AsyncClient
+            return AsyncClient(cert=self.CERT_FILE,
+                               callback_url=self.CALLBACK_URL,
+                               connect_timeout=float(self.CONNECT_TIMEOUT),
+                               read_timeout=float(self.READ_TIMEOUT))
+        else:
+            from client.client import Client
+            return Client(cert=self.CERT_FILE,
+                          callback_url=self.CALLBACK_URL,
+                          connect_timeout=float(self.CONNECT_TIMEOUT),
+                          read_timeout=float(self.READ_TIMEOUT))
+
+    def get_result_cache(self):
+        if not self.RESULT_CACHE_DIR:
+            return None
+        from daemon.result_cache import ResultCache
+        return ResultCache(path=self.RESULT_CACHE_DIR,
+                           max_bytes=int(self.RESULT_CACHE_MAX_BYTES),
+                           max_age=int(self.RESULT_CACHE_MAX_AGE))
 
-        app = DicomNodeAPI(db=db, log_level=self.LOG_LEVEL)
+    def get_daemon(self, db, incoming_queue):
+        from daemon.daemon import Daemon
+        from daemon.health import CircuitBreaker
+        from daemon.polling import PollSchedule
+        from daemon.routing import EndpointRouter
+        from daemon.scheduling import PriorityScheduler
+
+        if self.CALLBACK_URL:  # Results are pushed. Polling is only a slow fallback.
+            poll_schedule = PollSchedule(base_interval=int(self.CALLBACK_FALLBACK_POLL_INTERVAL),
+                                         max_interval=int(self.POLL_MAX_INTERVAL),
+                                         initial_delay=int(self.CALLBACK_FALLBACK_POLL_INTERVAL))
+        else:
+            poll_schedule = PollSchedule(base_interval=int(self.DAEMON_RUN_INTERVAL),
+                                         max_interval=int(self.POLL_MAX_INTERVAL))
+
+        return Daemon(client=self.get_client(),
+                      db=db,
+                      incoming_queue=incoming_queue,
+                      run_interval=int(self.DAEMON_RUN_INTERVAL),
+                      timeout=int(self.TIMEOUT),
+                      poll_schedule=poll_schedule,
+                      max_concurrent_requests=int(self.MAX_CONCURRENT_REQUESTS),
+                      worker_id=self.WORKER_ID,
+                      lease_duration=int(self.LEASE_DURATION),
+                      storage_tiers=self.get_storage_tiers(db),
+                      skip_duplicate_associations=str(self.SKIP_DUPLICATE_ASSOCIATIONS).lower() in ["true", "1"],
+                      result_cache=self.get_result_cache(),
+                      scheduler=PriorityScheduler(aging_interval=int(self.PRIORITY_AGING_INTERVAL)),
+                      router=EndpointRouter(strategy=self.ROUTING_STRATEGY),
+                      circuit_breaker=CircuitBreaker(failure_threshold=int(self.CIRCUIT_FAILURE_THRESHOLD),
+                                                     reset_timeout=float(self.CIRCUIT_RESET_TIMEOUT)),
+                      trace=self.get_trace(),
+                      catalog_batch_size=int(self.CATALOG_BATCH_SIZE))
+
+    def run_receiver(self):
+        scp = self.get_scp(incoming_queue=self.get_spool_queue())
+        scp.run_scp(blocking=True)
+
+    def run_worker(self):
+        daemon = self.get_daemon(db=self.get_db(), incoming_queue=self.get_spool_queue())
+        daemon.run()  # Blocks
+
+    def run_api(self, db=None):
+        import uvicorn
+        from api.fast_api import DicomNodeAPI
+
+        app = DicomNodeAPI(db=db or self.get_db(), log_level=self.LOG_LEVEL)
         uvicorn.run(app=app,  # Blocks
-                    host="localhost",
+                    host=self.API_HOST,
                     port=int(self.API_PORT))
+
+    def run_all(self):
+        scp = self.get_scp()
+        scp.run_scp(blocking=False)
+
+        db = self.get_db()
+        daemon = self.get_daemon(db=db, incoming_queue=scp.get_incoming_queue())
+        daemon.start()
+
+        self.run_api(db=db)  # Blocks
         daemon.kill()
 
 
 if __name__ == "__main__":
+    # python main.py [all|receiver|worker|api]. Falls back to ROLE env var.
     m = Main()
-    m.run()
+    m.run(*sys.argv[1:2])
@@ -0,0 +1,34 @@
+import json
+import subprocess
+import sys
+import unittest
+
+
+def imported_modules(code: str):
+    modules = ["fastapi", "uvicorn", "pynetdicom", "sqlalchemy", "requests", "httpx"]
+    out = subprocess.check_output([sys.executable, "-c", f"import json, sys\n{code}\n"
+                                   f"print(json.dumps([m for m in {modules} if m in sys.modules]))"])
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+class TestMain(unittest.TestCase):
+    def test_import_main_is_light(self):
+        self.assertEqual([], imported_modules("import main"))
+
+    def test_receiver_imports(self):
+        modules = imported_modules("import dicom_networking.scp, dicom_networking.spool")
+        self.assertNotIn("fastapi", modules)
+        self.assertNotIn("sqlalchemy", modules)
+
+    def test_api_imports(self):
+        modules = imported_modules("import api.fast_api")
+        self.assertNotIn("pynetdicom", modules)
+
+    def test_worker_imports(self):
+        modules = imported_modules("import daemon.daemon, client.async_client")
+        self.assertNotIn("fastapi", modules)
+        self.assertNotIn("uvicorn", modules)
+
+
+if __name__ == '__main__':
+    unittest.main()